@@ -0,0 +1,69 @@
+import asyncio
+import io
+import sys
+import falcon.asgi
+import uvicorn
+from api_rest import DataBase, routes
+from checkpoint import Checkpoint
+from metrics import RequestMetrics
+
+
+# Body of an ASGI request given to the controllers of api_rest
+class BufferedRequest(object):
+    def __init__(self, req, body):
+        self.req = req
+        self.bounded_stream = io.BytesIO(body)
+
+    def __getattr__(self, name):
+        return getattr(self.req, name)
+
+
+# Controller exposing the responders of an api_rest controller as coroutines
+class AsyncController(object):
+    def __init__(self, controller):
+        self.controller = controller
+        for name in dir(controller):
+            if name.startswith('on_'):
+                setattr(self, name, self.responder(getattr(controller, name)))
+
+    def responder(self, sync_responder):
+        async def on_request(req, resp, **params):
+            # The body is received without blocking the other requests, then the request is handled in one step
+            body = await req.stream.read()
+            sync_responder(BufferedRequest(req, body), resp, **params)
+        return on_request
+
+
+# Middleware saving the database from the event loop, where no request is half handled
+class CheckpointMiddleware(object):
+    def __init__(self, checkpoint, period=1):
+        self.checkpoint = checkpoint
+        self.period = period
+        self.task = None
+
+    async def process_startup(self, scope, event):
+        self.checkpoint.restore()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.period)
+            self.checkpoint.tick()
+
+    async def process_shutdown(self, scope, event):
+        self.task.cancel()
+        self.checkpoint.close()
+
+
+bdd = DataBase()
+request_metrics = RequestMetrics()
+api = falcon.asgi.App(middleware=[request_metrics])
+for uri_template, controller, suffix in routes(bdd, request_metrics):
+    request_metrics.register([uri_template])
+    api.add_route(uri_template, AsyncController(controller), suffix=suffix)
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    if len(sys.argv) > 2:
+        api.add_middleware(CheckpointMiddleware(Checkpoint(bdd, sys.argv[2])))
+    uvicorn.run(api, host='127.0.0.1', port=port, log_level='warning')
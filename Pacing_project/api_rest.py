@@ -1,11 +1,145 @@
+import csv
+import functools
 import json
+import signal
+import sys
+import threading
 import falcon
-from pacing_class_tz import GlobalPacing
+import numpy as np
+import schemas
+from checkpoint import Checkpoint
+from metrics import MetricsEndpoint, RequestMetrics
+from pacing_class_tz import Campaign, GlobalPacing
+from profiling import ProfileEndpoint
+from traffic_model import TrafficProfiles
 from datetime import datetime
 from loguru import logger
+from concurrent.futures import ThreadPoolExecutor
 from wsgiref import simple_server
 
-api = falcon.API()
+
+# Decode and validate the body of a request
+def parse(req, decoder):
+    """ Decode a JSON body with the compiled decoder of its schema
+
+    :param req: request
+    :param decoder: decoder of the schemas module
+    :return: payload
+    """
+    try:
+        return decoder.decode(req.bounded_stream.read())
+    except schemas.PayloadError as e:
+        raise falcon.HTTPUnprocessableEntity(description=str(e))
+
+
+# Read the body of a batch request
+def read_batch(req, decoder):
+    """ Parse a JSON array or NDJSON (one JSON object per line) body
+
+    :param req: request
+    :param decoder: decoder of the schemas module for an item
+    :return: list of items, an item that cannot be decoded is replaced by the exception
+    """
+    try:
+        return schemas.decode_batch(req.bounded_stream.read(), decoder)
+    except schemas.PayloadError as e:
+        raise falcon.HTTPUnprocessableEntity(description=f"Unable to decode the batch: {e}")
+
+
+# Read a date of a line item (line items created together often share their dates)
+@functools.lru_cache(maxsize=1024)
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+# Check the parameters of a new line item
+def line_item_params(data, instances):
+    """ Validate the parameters of a line item
+
+    :param data: LineItemInit or ProvisionRow
+    :param instances: line items already created
+    :return: budget, start date and end date
+    """
+    if data.liid in instances:
+        raise ValueError(f"Line item {data.liid} already created")
+    try:
+        budget = int(data.budget)
+    except (TypeError, ValueError):
+        raise ValueError(f"Unable to interpret budget={data.budget}")
+    try:
+        start_date = parse_date(data.start)
+    except (TypeError, ValueError):
+        raise ValueError(f"Unable to interpret start={data.start}")
+    try:
+        end_date = parse_date(data.end)
+    except (TypeError, ValueError):
+        raise ValueError(f"Unable to interpret end={data.end}")
+    return budget, start_date, end_date
+
+
+# Levels of detail of the status of a campaign
+STATUS_DETAILS = ('line_items', 'tz')
+
+
+# Status of a line item read from its snapshot
+def line_item_status(pacing, detail=False):
+    """ Return the totals of a line item, kept up to date by each decision and notification
+
+    :param pacing: GlobalPacing
+    :param detail: add the spent and remaining budget of each time zone
+    :return: dictionary
+    """
+    total_budget, tz_status, nb_engaged, nb_expired, spent, engaged = pacing.snapshot
+    status = {
+        'budget': total_budget,
+        'spent': spent,
+        'remaining': total_budget - spent,
+        'engaged': engaged,
+        'engaged_br': nb_engaged,
+        'expired_br': nb_expired
+    }
+    if detail:
+        status['tz'] = {tz: {'spent': tz_spent, 'remaining': objective - tz_spent}
+                        for tz, (tz_spent, _, _, objective, _) in tz_status.items()}
+    return status
+
+
+# Status of a campaign
+def campaign_status(bdd, campaign, detail=None):
+    """ Return the totals of a campaign, kept up to date by its line items: the line items are only visited when the
+    detail is asked
+
+    :param bdd: DataBase
+    :param campaign: Campaign
+    :param detail: None for the totals, 'line_items' to add the status of each line item, 'tz' to add the time zones
+    of each line item too
+    :return: dictionary
+    """
+    budget, spent, engaged, nb_engaged, nb_expired = campaign.totals
+    status = {
+        'budget': budget,
+        'spent': spent,
+        'remaining': budget - spent,
+        'engaged': engaged,
+        'engaged_br': nb_engaged,
+        'expired_br': nb_expired
+    }
+    if detail is not None:
+        line_items = {}
+        for liid in list(campaign.line_items):
+            pacing = bdd.instances.get(liid)
+            if pacing is not None:
+                line_items[liid] = line_item_status(pacing, detail == 'tz')
+        status['line_items'] = line_items
+    return status
+
+
+# Level of detail asked in the query string of a status request
+def status_detail(req):
+    detail = req.get_param('detail')
+    if detail is not None and detail not in STATUS_DETAILS:
+        raise falcon.HTTPInvalidParam(f"Must be one of {', '.join(STATUS_DETAILS)}", 'detail')
+    return detail
 
 
 # Store data
@@ -13,6 +147,10 @@ class DataBase(object):
     def __init__(self):
         self.campaigns = {}
         self.instances = {}
+        # Traffic of the time zones learned from the bid requests of all the line items
+        self.traffic_profiles = TrafficProfiles()
+        # Creations and deletions of campaigns and line items (each line item has its own lock)
+        self.lock = threading.Lock()
 
 
 # Controller to initialise a campaign
@@ -21,38 +159,50 @@ class InitCampaign(object):
         self.bdd = bdd
 
     def check_params(self, req):
-        required_argument = {"cpid"}
-        missing_argument = required_argument.difference(req.keys())
-        if missing_argument:
-            raise KeyError(f"Missing argument {str(missing_argument)}")
-        logger.info(f"Received argument {req.keys()}")
-        if req['cpid'] in bdd.campaigns.keys():
-            raise ValueError(f"Campaign {req['cpid']} already created")
+        if req.cpid in self.bdd.campaigns.keys():
+            raise ValueError(f"Campaign {req.cpid} already created")
 
     def on_post(self, req, resp):
-        data = json.loads(req.bounded_stream.read())
-        try:
-            self.check_params(data)
-        except Exception as e:
-            raise falcon.HTTPUnprocessableEntity(description=str(e))
-        self.bdd.campaigns[data['cpid']] = []
-        resp.body = json.dumps({
+        data = parse(req, schemas.campaign)
+        with self.bdd.lock:
+            try:
+                self.check_params(data)
+            except Exception as e:
+                raise falcon.HTTPUnprocessableEntity(description=str(e))
+            logger.info(f"Create campaign {data.cpid}")
+            self.bdd.campaigns[data.cpid] = Campaign()
+        resp.text = json.dumps({
             "status": "ok",
         })
 
     def on_get(self, req, resp):
-        length_dict = {key: len(value) for key, value in self.bdd.campaigns.items()}
-        resp.body = json.dumps({
+        length_dict = {key: len(value.line_items) for key, value in self.bdd.campaigns.items()}
+        resp.text = json.dumps({
             "campaigns": length_dict
         })
 
-    def on_delete(self, req, resp):
-        data = json.loads(req.bounded_stream.read())
+    def on_get_status(self, req, resp, cpid):
         try:
-            del self.bdd.campaigns[data['cpid']]
+            campaign = self.bdd.campaigns[cpid]
         except KeyError:
-            raise falcon.HTTPNotFound(description=f"Campaign {data['cpid']} doesn't exist")
-        resp.body = json.dumps({
+            raise falcon.HTTPNotFound(description=f"Campaign {cpid} doesn't exist")
+        resp.text = json.dumps(campaign_status(self.bdd, campaign, status_detail(req)))
+
+    def on_get_tree(self, req, resp):
+        detail = status_detail(req)
+        resp.text = json.dumps({
+            "campaigns": {cpid: campaign_status(self.bdd, campaign, detail)
+                          for cpid, campaign in list(self.bdd.campaigns.items())}
+        })
+
+    def on_delete(self, req, resp):
+        data = parse(req, schemas.campaign)
+        with self.bdd.lock:
+            try:
+                del self.bdd.campaigns[data.cpid]
+            except KeyError:
+                raise falcon.HTTPNotFound(description=f"Campaign {data.cpid} doesn't exist")
+        resp.text = json.dumps({
             "status": "ok",
         })
         resp.status = falcon.HTTP_200
@@ -65,69 +215,98 @@ class InitLineItem(object):
         self.bdd = bdd
 
     def check_params(self, req):
-        required_argument = {"budget", "start", "end", "liid"}
-        missing_argument = required_argument.difference(req.keys())
-        if missing_argument:
-            raise KeyError(f"Missing argument {str(missing_argument)}\n"
-                           f"Possible arguments are: \n"
-                           f"\t budget (integer) \n"
-                           f"\t start (string format: %Y-%M-%d \n"
-                           f"\t end (string format: %Y-%M-%d \n"
-                           f"\t cpid")
-        logger.info(f"Received arguments {req.keys()}")
-        if req['liid'] in self.bdd.instances.keys():
-            raise ValueError(f"Line item {req['liid']} already created")
-        try:
-            int(req['budget'])
-        except SyntaxError:
-            raise ValueError(f"Unable to interpret budget={req['budget']}")
-        try:
-            datetime.strptime(req['start'], '%Y-%m-%d')
-        except ValueError:
-            raise ValueError(f"Unable to interpret start={req['start']}")
-        try:
-            datetime.strptime(req['end'], '%Y-%m-%d')
-        except ValueError:
-            raise ValueError(f"Unable to interpret start={req['end']}")
+        return line_item_params(req, self.bdd.instances)
 
     def on_post(self, req, resp, cpid):
-        data = json.loads(req.bounded_stream.read())
-        if cpid not in self.bdd.campaigns.keys():
-            raise falcon.HTTPNotFound(description=f"Campaign {cpid} doesn't exist")
-        try:
-            self.check_params(data)
-        except Exception as e:
-            raise falcon.HTTPUnprocessableEntity(description=str(e))
-        try:
-            pacing = GlobalPacing(total_budget=int(data['budget']),
-                                  start_date=datetime.strptime(data['start'], '%Y-%m-%d'),
-                                  end_date=datetime.strptime(data['end'], '%Y-%m-%d'))
-            self.bdd.instances[data['liid']] = pacing
-            self.bdd.campaigns[cpid].append(data['liid'])
-            output = json.dumps({
-                "status": "ok",
-            })
-        except ValueError:
-            raise falcon.HTTPUnprocessableEntity(description='Budget could be negative OR start date superior to end '
-                                                             'date')
+        data = parse(req, schemas.line_item_init)
+        with self.bdd.lock:
+            if cpid not in self.bdd.campaigns.keys():
+                raise falcon.HTTPNotFound(description=f"Campaign {cpid} doesn't exist")
+            try:
+                budget, start_date, end_date = self.check_params(data)
+            except Exception as e:
+                raise falcon.HTTPUnprocessableEntity(description=str(e))
+            logger.info(f"Create line item {data.liid} in campaign {cpid}")
+            try:
+                pacing = GlobalPacing(total_budget=budget, start_date=start_date, end_date=end_date,
+                                      notification_timeout=data.notification_timeout,
+                                      expired_status=data.expired_status,
+                                      traffic_profiles=self.bdd.traffic_profiles)
+                self.bdd.instances[data.liid] = pacing
+                self.bdd.campaigns[cpid].add(data.liid, pacing)
+                output = json.dumps({
+                    "status": "ok",
+                })
+            except ValueError:
+                raise falcon.HTTPUnprocessableEntity(description='Budget could be negative OR start date superior '
+                                                                 'to end date')
         resp.status = falcon.HTTP_200
-        resp.body = output
+        resp.text = output
 
     def on_delete(self, req, resp, cpid):
-        data = json.loads(req.bounded_stream.read())
-        if cpid not in self.bdd.campaigns.keys():
-            raise falcon.HTTPNotFound(description=f"Campaign {cpid} doesn't exist")
-        try:
-            del self.bdd.instances[data['liid']]
-        except KeyError:
-            raise falcon.HTTPNotFound(description=f"line item {data['liid']} doesn't exist")
-        self.bdd.campaigns[cpid].remove(data['liid'])
-        resp.body = json.dumps({
+        data = parse(req, schemas.line_item_id)
+        with self.bdd.lock:
+            if cpid not in self.bdd.campaigns.keys():
+                raise falcon.HTTPNotFound(description=f"Campaign {cpid} doesn't exist")
+            try:
+                pacing = self.bdd.instances.pop(data.liid)
+            except KeyError:
+                raise falcon.HTTPNotFound(description=f"line item {data.liid} doesn't exist")
+            self.bdd.campaigns[cpid].remove(data.liid, pacing)
+        resp.text = json.dumps({
             "status": "ok",
         })
         resp.status = falcon.HTTP_200
 
 
+# Controller to create campaigns and line items in bulk
+class Provision(object):
+    def __init__(self, bdd):
+        self.bdd = bdd
+
+    def on_post(self, req, resp):
+        try:
+            rows = schemas.decode_provision(req.bounded_stream.read(), req.content_type)
+        except (schemas.PayloadError, UnicodeDecodeError, csv.Error) as e:
+            raise falcon.HTTPUnprocessableEntity(description=f"Unable to decode the rows: {e}")
+        results = [None] * len(rows)
+        campaigns = {}
+        instances = {}
+        # Rows are checked in one pass, the new line items are added together
+        with self.bdd.lock:
+            for i, row in enumerate(rows):
+                try:
+                    if isinstance(row, Exception):
+                        raise row
+                    cpid = str(row.cpid)
+                    if row.liid is not None:
+                        row.liid = str(row.liid)
+                        if row.liid in instances:
+                            raise ValueError(f"Line item {row.liid} already created")
+                        budget, start_date, end_date = line_item_params(row, self.bdd.instances)
+                        instances[row.liid] = (cpid, GlobalPacing(total_budget=budget, start_date=start_date,
+                                                                  end_date=end_date,
+                                                                  notification_timeout=row.notification_timeout,
+                                                                  expired_status=row.expired_status,
+                                                                  traffic_profiles=self.bdd.traffic_profiles))
+                    if cpid not in self.bdd.campaigns and cpid not in campaigns:
+                        campaigns[cpid] = Campaign()
+                    results[i] = {'status': 'ok'}
+                except Exception as e:
+                    results[i] = {'status': 'error', 'description': str(e)}
+            self.bdd.campaigns.update(campaigns)
+            for liid, (cpid, pacing) in instances.items():
+                self.bdd.instances[liid] = pacing
+                self.bdd.campaigns[cpid].add(liid, pacing)
+        logger.info(f"Create {len(campaigns)} campaigns and {len(instances)} line items, "
+                    f"{sum(result['status'] == 'error' for result in results)} rows rejected")
+        resp.text = json.dumps({
+            'status': 'ok',
+            'results': results
+        })
+        resp.status = falcon.HTTP_200
+
+
 # Controller to have the status of a line item
 class LineItem(object):
     def __init__(self, bdd):
@@ -135,7 +314,7 @@ class LineItem(object):
 
     def on_get(self, req, resp):
         li_list = list(self.bdd.instances.keys())
-        resp.body = json.dumps({
+        resp.text = json.dumps({
             'status': 'ok',
             'LineItems': li_list
         })
@@ -146,12 +325,13 @@ class LineItem(object):
             good_instance = self.bdd.instances[liid]
         except KeyError:
             raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
-        spents = good_instance.pacing_performance()
-        total_spent = sum(spents)
-        remaining = good_instance.total_budget - total_spent
-        resp.body = json.dumps({
+        total_budget, _, nb_engaged, nb_expired, total_spent, _ = good_instance.snapshot
+        remaining = total_budget - total_spent
+        resp.text = json.dumps({
             'spent': total_spent,
-            'remaining': remaining
+            'remaining': remaining,
+            'engaged_br': nb_engaged,
+            'expired_br': nb_expired
         })
 
     def on_get_status_all(self, req, resp, liid):
@@ -161,11 +341,10 @@ class LineItem(object):
             raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
         spents = {}
         remainings = {}
-        for tz in good_instance.tz_list:
-            good_tz = good_instance.instances[tz]
-            spents[tz] = good_tz.budget_spent_total
-            remainings[tz] = good_tz.budget_objective - good_tz.budget_spent_total
-        resp.body = json.dumps({
+        for tz, (spent, _, _, objective, _) in good_instance.snapshot[1].items():
+            spents[tz] = spent
+            remainings[tz] = objective - spent
+        resp.text = json.dumps({
             'spent': spents,
             'remaining': remainings
         })
@@ -177,12 +356,12 @@ class LineItem(object):
         except KeyError:
             raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
         try:
-            good_tz = good_instance.instances[tz]
+            spent, _, _, objective, _ = good_instance.snapshot[1][tz]
         except KeyError:
             raise falcon.HTTPNotFound(description=f"time zone {tz} doesn't exist")
-        resp.body = json.dumps({
-            'spent': good_tz.budget_spent_total,
-            'remaining': good_tz.budget_objective - good_tz.budget_spent_total
+        resp.text = json.dumps({
+            'spent': spent,
+            'remaining': objective - spent
         })
 
 
@@ -191,61 +370,87 @@ class ReceiveBR(object):
     def __init__(self, bdd):
         self.bdd = bdd
 
-    def check_and_parse_parameters(self, req):
-        required_argument = {"tz", "cpm", "imps", "brid"}
-        missing_argument = required_argument.difference(req.keys())
-        if missing_argument:
-            raise KeyError(f"Missing argument {str(missing_argument)} in URL")
-        logger.info(f"Received arguments {req.keys()}")
-
     def on_post(self, req, resp, liid):
-        data = json.loads(req.bounded_stream.read())
-        ts = datetime.timestamp(datetime.utcnow())
-        # ts = data['ts']
-        try:
-            self.check_and_parse_parameters(data)
-        except Exception as e:
-            raise falcon.HTTPUnprocessableEntity(description=str(e))
+        data = parse(req, schemas.bid_request)
         try:
             good_instance = self.bdd.instances[liid]
         except KeyError:
             raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
-        try:
-            buying, *_ = good_instance.choose_pacing(ts, data['tz'], data['cpm'], data['imps'], data['brid'])
-        except Exception as e:
-            raise falcon.HTTPUnprocessableEntity(description=str(e))
-        resp.body = json.dumps({
+        # The time is taken with the lock held: a line item sees the bid requests in chronological order
+        with good_instance.lock:
+            ts = datetime.timestamp(datetime.utcnow())
+            # ts = data['ts']
+            try:
+                buying, *_ = good_instance.choose_pacing(ts, data.tz, data.cpm, data.imps, data.brid)
+            except Exception as e:
+                raise falcon.HTTPUnprocessableEntity(description=str(e))
+        resp.text = json.dumps({
             'status': 'ok',
             'buying': buying
         })
         resp.status = falcon.HTTP_200
 
+    def on_post_batch(self, req, resp, liid):
+        items = read_batch(req, schemas.bid_request)
+        try:
+            good_instance = self.bdd.instances[liid]
+        except KeyError:
+            raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
+        logger.info(f"Received a batch of {len(items)} bid requests")
+        results = [None] * len(items)
+        rows = []
+        tz_codes = {}
+        with good_instance.lock:
+            ts = datetime.timestamp(datetime.utcnow())
+            for i, item in enumerate(items):
+                try:
+                    if isinstance(item, Exception):
+                        raise item
+                    tz = item.tz
+                    if tz not in tz_codes:
+                        tz_cache = good_instance.timezone_cache(tz)
+                        if ts < tz_cache.start_ts:
+                            raise ValueError("BR before campaign start date")
+                        if ts > tz_cache.end_ts:
+                            raise ValueError("BR after campaign end date")
+                        tz_codes[tz] = len(tz_codes)
+                    rows.append(i)
+                except Exception as e:
+                    results[i] = {'status': 'error', 'description': str(e)}
+            # Valid bid requests are sent in order to the pacing
+            valid = [items[i] for i in rows]
+            buying, *_ = good_instance.choose_pacing_batch(np.full(len(valid), ts),
+                                                           [tz_codes[item.tz] for item in valid],
+                                                           [item.cpm for item in valid],
+                                                           [item.imps for item in valid],
+                                                           np.array([item.brid for item in valid], dtype=object),
+                                                           list(tz_codes))
+        for i, decision in zip(rows, buying.tolist()):
+            results[i] = {'status': 'ok', 'buying': decision}
+        resp.text = json.dumps({
+            'status': 'ok',
+            'results': results
+        })
+        resp.status = falcon.HTTP_200
+
 
 # Controller to change the setup of a campaign
 class ChangeSetup(object):
     def __init__(self, bdd):
         self.bdd = bdd
 
-    def check_params(self, req):
-        required_argument = {"new_budget"}
-        missing_argument = required_argument.difference(req.keys())
-        if missing_argument:
-            raise KeyError(f"Missing argument {str(missing_argument)} in URL")
-        logger.info(f"Received arguments {req.keys()}")
-        if req['new_budget'] < 0:
-            raise ValueError(f"New budget cannot be negative")
-
     def on_post(self, req, resp, liid):
-        data = json.loads(req.bounded_stream.read())
+        data = parse(req, schemas.reset)
         try:
             good_instance = self.bdd.instances[liid]
         except KeyError:
             raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
+        logger.info(f"Change the budget of line item {liid} to {data.new_budget}")
         try:
-            good_instance.change_setup(data['new_budget'])
+            good_instance.update_budget(data.new_budget)
         except Exception as e:
             raise falcon.HTTPUnprocessableEntity(description=f"Exception {e}")
-        resp.body = json.dumps({
+        resp.text = json.dumps({
             'status': 'ok'
         })
         resp.status = falcon.HTTP_200
@@ -256,52 +461,123 @@ class ReceiveNotification(object):
     def __init__(self, bdd):
         self.bdd = bdd
 
-    def check_params(self, req):
-        required_argument = {"status", "brid"}
-        missing_argument = required_argument.difference(req.keys())
-        if missing_argument:
-            raise KeyError(f"Missing argument {str(missing_argument)} in URL")
-        logger.info(f"Received arguments {req.keys()}")
-        if req['status'] not in ["win", "lose"]:
-            raise ValueError(f"Status should be win or lose. {req['status']} was given")
-
     def on_post(self, req, resp, liid):
-        data = json.loads(req.bounded_stream.read())
-        try:
-            self.check_params(data)
-        except Exception as e:
-            raise falcon.HTTPUnprocessableEntity(description=str(e))
+        data = parse(req, schemas.notification)
         try:
             good_instance = self.bdd.instances[liid]
         except KeyError:
             raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
         try:
-            good_instance.dispatch_notifications(data['brid'], data['status'])
+            good_instance.dispatch_notifications(data.brid, data.status)
         except KeyError:
-            raise falcon.HTTPNotFound(description=f"br with id {data['brid']} doesn't exist")
-        resp.body = json.dumps({
+            raise falcon.HTTPNotFound(description=f"br with id {data.brid} doesn't exist")
+        resp.text = json.dumps({
             'status': 'ok'
         })
         resp.status = falcon.HTTP_200
 
+    def on_post_batch(self, req, resp, liid):
+        items = read_batch(req, schemas.notification)
+        try:
+            good_instance = self.bdd.instances[liid]
+        except KeyError:
+            raise falcon.HTTPNotFound(description=f"line item {liid} doesn't exist")
+        logger.info(f"Received a batch of {len(items)} notifications")
+        results = []
+        for item in items:
+            if isinstance(item, Exception):
+                results.append({'status': 'error', 'description': str(item)})
+                continue
+            try:
+                good_instance.dispatch_notifications(item.brid, item.status)
+                results.append({'status': 'ok'})
+            except KeyError:
+                results.append({'status': 'error', 'description': f"br with id {item.brid} doesn't exist"})
+        resp.text = json.dumps({
+            'status': 'ok',
+            'results': results
+        })
+        resp.status = falcon.HTTP_200
+
+
+# Routes of the API, shared by the WSGI and the ASGI applications
+def routes(bdd, request_metrics):
+    """ Create the controllers of a database
+
+    :param bdd: DataBase
+    :param request_metrics: RequestMetrics of the application
+    :return: list of (uri template, controller, suffix)
+    """
+    init_campaign = InitCampaign(bdd)
+    init_pacing = InitLineItem(bdd)
+    br = ReceiveBR(bdd)
+    notif = ReceiveNotification(bdd)
+    li = LineItem(bdd)
+    reset_setup = ChangeSetup(bdd)
+    metrics = MetricsEndpoint(bdd, request_metrics)
+    provision = Provision(bdd)
+    return [("/campaign", init_campaign, None),
+            ("/campaign/{cpid}/status", init_campaign, "status"),
+            ("/status", init_campaign, "tree"),
+            ("/campaign/{cpid}/init", init_pacing, None),
+            ("/provision", provision, None),
+            ("/li", li, None),
+            ("/li/{liid}/status", li, "status"),
+            ("/li/{liid}/status/tz", li, "status_all"),
+            ("/li/{liid}/status/tz/{tz}", li, "status_tz"),
+            ("/li/{liid}/br", br, None),
+            ("/li/{liid}/br/batch", br, "batch"),
+            ("/li/{liid}/notif", notif, None),
+            ("/li/{liid}/notif/batch", notif, "batch"),
+            ("/li/{liid}/reset", reset_setup, None),
+            ("/metrics", metrics, None),
+            ("/debug/profile", ProfileEndpoint(), None)]
+
 
 bdd = DataBase()
-init_campaign = InitCampaign(bdd)
-init_pacing = InitLineItem(bdd)
-br = ReceiveBR(bdd)
-notif = ReceiveNotification(bdd)
-li = LineItem(bdd)
-reset_setup = ChangeSetup(bdd)
-api.add_route("/campaign", init_campaign)
-api.add_route("/campaign/{cpid}/init", init_pacing)
-api.add_route("/li", li)
-api.add_route("/li/{liid}/status", li, suffix="status")
-api.add_route("/li/{liid}/status/tz", li, suffix="status_all")
-api.add_route("/li/{liid}/status/tz/{tz}", li, suffix="status_tz")
-api.add_route("/li/{liid}/br", br)
-api.add_route("/li/{liid}/notif", notif)
-api.add_route("/li/{liid}/reset", reset_setup)
+request_metrics = RequestMetrics()
+api = falcon.App(middleware=[request_metrics])
+for uri_template, controller, suffix in routes(bdd, request_metrics):
+    request_metrics.register([uri_template])
+    api.add_route(uri_template, controller, suffix=suffix)
+
+
+# WSGI server handling the requests with a pool of threads and saving the database periodically
+class CheckpointServer(simple_server.WSGIServer):
+    checkpoint = None
+    threads = 8
+
+    def server_activate(self):
+        super().server_activate()
+        self.pool = ThreadPoolExecutor(self.threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def service_actions(self):
+        if self.checkpoint is not None:
+            self.checkpoint.tick()
+
 
 if __name__ == '__main__':
-    httpd = simple_server.make_server('127.0.0.1', 8000, api)
-    httpd.serve_forever()
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    httpd = simple_server.make_server('127.0.0.1', port, api, server_class=CheckpointServer)
+    if len(sys.argv) > 2:
+        httpd.checkpoint = Checkpoint(bdd, sys.argv[2])
+        httpd.checkpoint.restore()
+        # A deployment stops the server with SIGTERM: exit normally to write the last checkpoint
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.pool.shutdown()
+        if httpd.checkpoint is not None:
+            httpd.checkpoint.close()
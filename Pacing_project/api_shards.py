@@ -0,0 +1,425 @@
+import asyncio
+import csv
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import zlib
+import falcon
+import falcon.asgi
+import msgspec
+import uvicorn
+import schemas
+
+
+# Worker owning a line item
+def shard_of(liid, nb_shards):
+    """ Stable hash of a line item id: the same line item always goes to the same worker
+
+    :param liid: id of the line item (given in the URL or in a JSON body)
+    :param nb_shards: number of workers
+    :return: index of the worker
+    """
+    return zlib.crc32(str(liid).encode()) % nb_shards
+
+
+# Keep-alive HTTP connections to a worker
+class Shard(object):
+    def __init__(self, port):
+        self.port = port
+        self.idle = []
+
+    async def request(self, method, path, body=b''):
+        """ Send a request to the worker and return its response
+
+        :param method: HTTP method
+        :param path: path of the route
+        :param body: body of the request
+        :return: status code and body of the response
+        """
+        message = (f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                   f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        while self.idle:
+            reader, writer = self.idle.pop()
+            # The worker closes the connections left idle longer than its keep-alive timeout
+            if reader.at_eof():
+                writer.close()
+                continue
+            response = await self.exchange(reader, writer, message, reused=True)
+            if response is not None:
+                return response
+            # The worker closed the connection before answering: retry once on a new connection
+            break
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        return await self.exchange(reader, writer, message)
+
+    async def exchange(self, reader, writer, message, reused=False):
+        """ Send a request on a connection and read its response, keeping the connection if the worker allows it
+
+        :param reader: StreamReader of the connection
+        :param writer: StreamWriter of the connection
+        :param message: encoded request
+        :param reused: True if the connection comes from the idle list
+        :return: status code and body of the response, None if a reused connection was closed before any byte of
+        the response
+        """
+        try:
+            try:
+                writer.write(message)
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError) as error:
+                if not reused or getattr(error, 'partial', b''):
+                    raise
+                writer.close()
+                return None
+            lines = head.decode('latin-1').split("\r\n")
+            headers = dict(line.lower().split(": ", 1) for line in lines[1:] if line)
+            content = await reader.readexactly(int(headers.get('content-length', 0)))
+        except BaseException:
+            writer.close()
+            raise
+        if headers.get('connection') == 'close':
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+        return int(lines[0].split()[1]), content
+
+
+# Router sending each request to the worker of its line item
+class Router(object):
+    def __init__(self, ports):
+        self.shards = [Shard(port) for port in ports]
+
+    def owner(self, liid):
+        return self.shards[shard_of(liid, len(self.shards))]
+
+    async def forward(self, shard, req, resp):
+        """ Forward a request to a worker and copy its response
+
+        :param shard: Shard
+        :param req: request
+        :param resp: response
+        """
+        body = await req.stream.read()
+        status, content = await shard.request(req.method, req.relative_uri, body)
+        resp.status = status
+        resp.data = content
+
+    async def broadcast(self, req):
+        """ Send a request to every worker
+
+        :param req: request
+        :return: list of (status, body) in the order of the workers
+        """
+        body = await req.stream.read()
+        return await asyncio.gather(*(shard.request(req.method, req.relative_uri, body) for shard in self.shards))
+
+    async def line_item(self, req, resp, liid):
+        await self.forward(self.owner(liid), req, resp)
+
+
+# Controller of the campaigns: campaigns exist on every worker
+class Campaigns(object):
+    def __init__(self, router):
+        self.router = router
+
+    async def write(self, req, resp):
+        responses = await self.router.broadcast(req)
+        # Workers answer the same thing, unless one of them failed
+        status, content = next((response for response in responses if response[0] != 200), responses[0])
+        resp.status = status
+        resp.data = content
+
+    async def on_post(self, req, resp):
+        await self.write(req, resp)
+
+    async def on_delete(self, req, resp):
+        await self.write(req, resp)
+
+    async def on_get(self, req, resp):
+        campaigns = {}
+        for _, content in await self.router.broadcast(req):
+            for cpid, nb_line_items in json.loads(content)['campaigns'].items():
+                campaigns[cpid] = campaigns.get(cpid, 0) + nb_line_items
+        resp.text = json.dumps({
+            "campaigns": campaigns
+        })
+
+
+# Controller of the creation and deletion of line items: the line item id is in the body
+class CampaignLineItems(object):
+    def __init__(self, router):
+        self.router = router
+
+    async def to_owner(self, req, resp):
+        body = await req.stream.read()
+        try:
+            shard = self.router.owner(schemas.line_item_id.decode(body).liid)
+        except schemas.PayloadError:
+            # Any worker answers with the validation error
+            shard = self.router.shards[0]
+        status, content = await shard.request(req.method, req.relative_uri, body)
+        resp.status = status
+        resp.data = content
+
+    async def on_post(self, req, resp, cpid):
+        await self.to_owner(req, resp)
+
+    async def on_delete(self, req, resp, cpid):
+        await self.to_owner(req, resp)
+
+
+# Controller of the list of line items
+class LineItems(object):
+    def __init__(self, router):
+        self.router = router
+
+    async def on_get(self, req, resp):
+        line_items = []
+        for _, content in await self.router.broadcast(req):
+            line_items.extend(json.loads(content)['LineItems'])
+        resp.text = json.dumps({
+            "status": "ok",
+            "LineItems": line_items
+        })
+
+
+# Controller of the bulk provisioning: line items go to their workers, campaigns to every worker
+class Provision(object):
+    def __init__(self, router):
+        self.router = router
+
+    async def on_post(self, req, resp):
+        body = await req.stream.read()
+        try:
+            rows = schemas.decode_provision(body, req.content_type)
+        except (schemas.PayloadError, UnicodeDecodeError, csv.Error) as e:
+            raise falcon.HTTPUnprocessableEntity(description=f"Unable to decode the rows: {e}")
+        results = [None] * len(rows)
+        campaigns = {}
+        positions = [[] for _ in self.router.shards]
+        for i, row in enumerate(rows):
+            if isinstance(row, Exception):
+                results[i] = {'status': 'error', 'description': str(row)}
+            elif row.liid is None:
+                campaigns[str(row.cpid)] = None
+                results[i] = {'status': 'ok'}
+            else:
+                positions[shard_of(row.liid, len(self.router.shards))].append(i)
+        # Each worker creates its line items, then the campaigns of the created line items are sent to every worker
+        targets = [(shard, rows_of_shard) for shard, rows_of_shard in zip(self.router.shards, positions)
+                   if rows_of_shard]
+        responses = await asyncio.gather(*(shard.request('POST', '/provision',
+                                                         msgspec.json.encode([rows[i] for i in rows_of_shard]))
+                                           for shard, rows_of_shard in targets))
+        for (_, rows_of_shard), (status, content) in zip(targets, responses):
+            if status != 200:
+                resp.status = status
+                resp.data = content
+                return
+            for i, result in zip(rows_of_shard, json.loads(content)['results']):
+                results[i] = result
+                if result['status'] == 'ok':
+                    campaigns[str(rows[i].cpid)] = None
+        if campaigns:
+            cpids = list(campaigns)
+            body = msgspec.json.encode([{'cpid': cpid} for cpid in cpids])
+            for status, content in await asyncio.gather(*(shard.request('POST', '/provision', body)
+                                                          for shard in self.router.shards)):
+                if status != 200:
+                    resp.status = status
+                    resp.data = content
+                    return
+                for cpid, result in zip(cpids, json.loads(content)['results']):
+                    if result['status'] != 'ok':
+                        campaigns[cpid] = result
+            # The rows of a campaign missing on a worker are reported with the error of the worker
+            for i, row in enumerate(rows):
+                if results[i]['status'] == 'ok' and campaigns.get(str(row.cpid)) is not None:
+                    results[i] = campaigns[str(row.cpid)]
+        resp.text = json.dumps({
+            'status': 'ok',
+            'results': results
+        })
+
+
+# Merge the status of a campaign on several workers
+def merge_status(statuses):
+    """ Sum the totals of the workers and gather their line items
+
+    :param statuses: status of the campaign on each worker (campaign_status of api_rest)
+    :return: status of the campaign
+    """
+    merged = {}
+    for status in statuses:
+        for key, value in status.items():
+            if isinstance(value, dict):
+                merged.setdefault(key, {}).update(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+# Controller of the status of the campaigns: their line items are spread over the workers
+class CampaignStatus(object):
+    def __init__(self, router):
+        self.router = router
+
+    async def statuses(self, req, resp):
+        """ Send a status request to every worker
+
+        :param req: request
+        :param resp: response, given the error of a worker if one of them failed
+        :return: list of the decoded bodies (None if a worker failed)
+        """
+        responses = await self.router.broadcast(req)
+        # Campaigns exist on every worker, a worker that does not know it gives the error
+        status, content = next((response for response in responses if response[0] != 200), responses[0])
+        if status != 200:
+            resp.status = status
+            resp.data = content
+            return None
+        return [json.loads(content) for _, content in responses]
+
+    async def on_get(self, req, resp, cpid):
+        statuses = await self.statuses(req, resp)
+        if statuses is not None:
+            resp.text = json.dumps(merge_status(statuses))
+
+    async def on_get_tree(self, req, resp):
+        statuses = await self.statuses(req, resp)
+        if statuses is None:
+            return
+        campaigns = {}
+        for tree in statuses:
+            for cpid, status in tree['campaigns'].items():
+                campaigns[cpid] = merge_status([campaigns.get(cpid, {}), status])
+        resp.text = json.dumps({
+            "campaigns": campaigns
+        })
+
+
+# Merge the metrics of the workers
+def merge_metrics(texts):
+    """ Group the samples of the workers by metric, with a shard label giving their worker
+
+    :param texts: metrics of each worker in the Prometheus text format
+    :return: merged metrics in the Prometheus text format
+    """
+    families = {}
+    for shard, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                family = families.setdefault(line.split()[2], ([], []))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                name, labels = line.split('{', 1)
+                family[1].append(f'{name}{{shard="{shard}",{labels}')
+    return ''.join('\n'.join(comments + samples) + '\n' for comments, samples in families.values())
+
+
+# Controller of the metrics of the workers
+class Metrics(object):
+    def __init__(self, router):
+        self.router = router
+
+    async def on_get(self, req, resp):
+        responses = await self.router.broadcast(req)
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.text = merge_metrics([content.decode() for _, content in responses])
+
+
+# Controller of the profilers of the workers
+class Profiles(object):
+    def __init__(self, router):
+        self.router = router
+
+    async def broadcast(self, req, resp):
+        responses = await self.router.broadcast(req)
+        resp.status = next((status for status, _ in responses if status != 200), responses[0][0])
+        resp.text = json.dumps({
+            "shards": [json.loads(content) for _, content in responses]
+        })
+
+    async def on_get(self, req, resp):
+        await self.broadcast(req, resp)
+
+    async def on_post(self, req, resp):
+        await self.broadcast(req, resp)
+
+    async def on_delete(self, req, resp):
+        await self.broadcast(req, resp)
+
+
+# Application of the router
+def create_app(ports):
+    """ Create the ASGI application routing the API to the workers
+
+    :param ports: ports of the workers
+    :return: falcon.asgi.App
+    """
+    router = Router(ports)
+    app = falcon.asgi.App()
+    app.add_route("/campaign", Campaigns(router))
+    app.add_route("/campaign/{cpid}/init", CampaignLineItems(router))
+    app.add_route("/provision", Provision(router))
+    campaign_status = CampaignStatus(router)
+    app.add_route("/campaign/{cpid}/status", campaign_status)
+    app.add_route("/status", campaign_status, suffix="tree")
+    app.add_route("/li", LineItems(router))
+    app.add_route("/metrics", Metrics(router))
+    app.add_route("/debug/profile", Profiles(router))
+    app.add_sink(router.line_item, r'^/li/(?P<liid>[^/]+)/')
+    return app
+
+
+# Workers are given to the routers of uvicorn by an environment variable
+if os.environ.get('PACING_SHARD_PORTS'):
+    api = create_app([int(port) for port in os.environ['PACING_SHARD_PORTS'].split(',')])
+
+
+# Start the workers of the line items
+def start_workers(port, nb_shards, checkpoint=None):
+    """ Start one api_asgi.py process per shard on the ports following the port of the router
+
+    :param port: port of the router
+    :param nb_shards: number of workers
+    :param checkpoint: prefix of the checkpoint files of the workers (optional)
+    :return: list of processes and list of ports
+    """
+    ports = [port + 1 + i for i in range(nb_shards)]
+    workers = []
+    for i, worker_port in enumerate(ports):
+        args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api_asgi.py'),
+                str(worker_port)]
+        if checkpoint is not None:
+            args.append(f"{checkpoint}.{i}")
+        workers.append(subprocess.Popen(args))
+    for worker_port in ports:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', worker_port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+    return workers, ports
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    nb_shards = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    nb_routers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    checkpoint = sys.argv[4] if len(sys.argv) > 4 else None
+    workers, ports = start_workers(port, nb_shards, checkpoint)
+    os.environ['PACING_SHARD_PORTS'] = ','.join(str(worker_port) for worker_port in ports)
+    try:
+        uvicorn.run('api_shards:api', host='127.0.0.1', port=port, workers=nb_routers, log_level='warning')
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+
+TIMEZONES = ["Europe/Paris", "America/New_York", "Asia/Tokyo", "Europe/London", "Australia/Sydney"]
+
+
+# Minimal HTTP/1.1 client that reuses its connection while the server keeps it open
+class Connection(object):
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def post(self, path, payload):
+        """ Send a POST request and return its status code
+
+        :param path: path of the route
+        :param payload: dictionary sent as JSON
+        """
+        if self.reader is None:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        body = json.dumps(payload).encode()
+        self.writer.write(f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                          f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode().split("\r\n")
+        headers = dict(line.lower().split(": ", 1) for line in lines[1:] if line)
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        else:
+            await self.reader.read()
+        if lines[0].startswith("HTTP/1.0") or headers.get('connection') == 'close':
+            self.writer.close()
+            self.reader = None
+        return int(lines[0].split()[1])
+
+
+async def load(port, nb_line_items, concurrency, duration, seed=0):
+    """ Send bid requests on several connections during a given time
+
+    :param port: port of the server
+    :param nb_line_items: number of line items receiving bid requests
+    :param concurrency: number of connections sending requests at the same time
+    :param duration: duration of the test in seconds
+    :param seed: seed of the random bid requests
+    :return: array of latencies in seconds and number of errors
+    """
+    setup = Connection(port)
+    today = datetime.now()
+    await setup.post("/campaign", {"cpid": "bench"})
+    for liid in range(nb_line_items):
+        await setup.post("/campaign/bench/init", {
+            "budget": 10000000,
+            "start": (today - timedelta(days=1)).strftime('%Y-%m-%d'),
+            "end": (today + timedelta(days=7)).strftime('%Y-%m-%d'),
+            "liid": str(liid)
+        })
+    rng = np.random.default_rng(seed)
+    latencies = []
+    errors = [0]
+    stop = time.perf_counter() + duration
+
+    async def client(worker):
+        connection = Connection(port)
+        brid = 0
+        while time.perf_counter() < stop:
+            brid += 1
+            liid = int(rng.integers(nb_line_items))
+            begin = time.perf_counter()
+            try:
+                status = await connection.post(f"/li/{liid}/br", {
+                    "tz": TIMEZONES[int(rng.integers(len(TIMEZONES)))],
+                    "brid": f"{worker}-{brid}",
+                    "imps": int(rng.integers(1, 5)),
+                    "cpm": float(rng.uniform(1, 10))
+                })
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection = Connection(port)
+                status = 0
+            latencies.append(time.perf_counter() - begin)
+            if status != 200:
+                errors[0] += 1
+
+    await asyncio.gather(*(client(worker) for worker in range(concurrency)))
+    return np.array(latencies), errors[0]
+
+
+# Load of one client process
+def run_load(port, nb_line_items, concurrency, duration, seed):
+    return asyncio.run(load(port, nb_line_items, concurrency, duration, seed))
+
+
+# Start a server, load it and stop it
+def bench_server(script, port, nb_line_items=10, concurrency=32, duration=10, args=(), clients=1):
+    """ Measure the sustained requests per second and the latency of a server
+
+    :param script: script of the server (api_rest.py, api_asgi.py or api_shards.py)
+    :param port: port of the server
+    :param nb_line_items: number of line items
+    :param concurrency: number of concurrent connections
+    :param duration: duration of the load in seconds
+    :param args: arguments given to the script after the port
+    :param clients: number of client processes, each one opening concurrency connections
+    :return: dictionary of results
+    """
+    server = subprocess.Popen([sys.executable, script, str(port), *args], stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        if clients == 1:
+            latencies, errors = run_load(port, nb_line_items, concurrency, duration, 0)
+        else:
+            with multiprocessing.Pool(clients) as pool:
+                loads = pool.starmap(run_load, [(port, nb_line_items, concurrency, duration, seed)
+                                                for seed in range(clients)])
+            latencies = np.concatenate([latencies for latencies, _ in loads])
+            errors = sum(errors for _, errors in loads)
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'server': script,
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_sec': len(latencies) / duration,
+        'mean_ms': latencies.mean() * 1000,
+        'p50_ms': np.percentile(latencies, 50) * 1000,
+        'p99_ms': np.percentile(latencies, 99) * 1000,
+        'max_ms': latencies.max() * 1000
+    }
+
+
+if __name__ == '__main__':
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    for script, port in [("api_rest.py", 8100), ("api_asgi.py", 8101)]:
+        result = bench_server(script, port, concurrency=concurrency, duration=duration)
+        print(f"{result['server']:12} {result['requests_per_sec']:7.0f} req/s   mean {result['mean_ms']:7.2f} ms   "
+              f"p50 {result['p50_ms']:7.2f} ms   p99 {result['p99_ms']:7.2f} ms   max {result['max_ms']:7.2f} ms   "
+              f"errors {result['errors']}")
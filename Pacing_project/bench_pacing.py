@@ -0,0 +1,300 @@
+import gc
+import json
+import pickle
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import falcon.testing
+import numpy as np
+import pytz
+from pacing_class_tz import Campaign, Pacing, GlobalPacing
+
+START = datetime(2020, 7, 1)
+END = datetime(2020, 7, 14)
+
+
+# Time and memory of the measured sections of a benchmark
+class Measure(object):
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.elapsed_ns = 0
+        self.blocks = 0
+        self.peak = 0
+
+    def __enter__(self):
+        gc.disable()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.start_blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *args):
+        self.elapsed_ns += time.perf_counter_ns() - self.start
+        self.blocks += sys.getallocatedblocks() - self.start_blocks
+        if self.track_memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self.memory)
+        gc.enable()
+
+
+# Synthetic bid requests
+def bid_requests(n, seed, timezones, days=2):
+    """ Bid requests spread over some days after the beginning of the campaign
+
+    :param n: number of bid requests
+    :param seed: seed of the generator
+    :param timezones: list of time zones
+    :param days: number of days
+    :return: lists of timestamps, time zones, cpm and impressions
+    """
+    rng = np.random.default_rng(seed)
+    ts = np.sort((START + timedelta(days=1)).timestamp() + rng.uniform(0, days * 86400, n))
+    tz = np.array(timezones)[rng.integers(0, len(timezones), n)]
+    return ts.tolist(), tz.tolist(), rng.uniform(1, 10, n).tolist(), rng.integers(1, 5, n).tolist()
+
+
+# Time zones of the benchmarks of the global pacing
+def timezones(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.choice(sorted(pytz.common_timezones), n, replace=False).tolist()
+
+
+def bench_buying_decision(measure, n=20000):
+    pacing = Pacing(total_budget=10000, start_date=START, end_date=END, timezone="Europe/Paris")
+    ts, _, cpm, imps = bid_requests(n, 0, ["Europe/Paris"])
+    prices = [c * i / 1000 for c, i in zip(cpm, imps)]
+    decide = pacing.buying_decision
+    with measure:
+        for br_id, (ts_br, price, imps_br) in enumerate(zip(ts, prices, imps)):
+            decide(ts_br, price, imps_br, br_id)
+    return n
+
+
+def bench_choose_pacing(measure, nb_timezones, n=20000):
+    pacing = GlobalPacing(total_budget=10000 * nb_timezones, start_date=START, end_date=END)
+    ts, tz, cpm, imps = bid_requests(n, 1, timezones(nb_timezones))
+    choose = pacing.choose_pacing
+    with measure:
+        for br_id, row in enumerate(zip(ts, tz, cpm, imps)):
+            choose(*row, br_id)
+    return n
+
+
+# Pacing that received bid requests during the 7 first days of the campaign
+def week_of_history():
+    pacing = Pacing(total_budget=10000, start_date=START, end_date=END, timezone="Europe/Paris")
+    ts, _, cpm, imps = bid_requests(50000, 2, ["Europe/Paris"], days=7)
+    for br_id, (ts_br, cpm_br, imps_br) in enumerate(zip(ts, cpm, imps)):
+        pacing.buying_decision(ts_br - 86400, cpm_br * imps_br / 1000, imps_br, br_id)
+    return pacing
+
+
+def bench_day_reset(measure, n=200):
+    state = pickle.dumps(week_of_history())
+    for _ in range(n):
+        pacing = pickle.loads(state)
+        day = pacing.day + 1
+        ts = pacing.tz_cache.midnight(day)
+        with measure:
+            pacing.day_reset(ts, day)
+    return n
+
+
+def bench_change_hour(measure, n=1000):
+    pacing = week_of_history()
+    day = pacing.day + 1
+    pacing.day_reset(pacing.tz_cache.midnight(day), day)
+    for _ in range(n):
+        pacing.current_hour = -1
+        pacing.budget_remaining_hourly = 0
+        pacing.surplus_hour = 0
+        with measure:
+            for _ in range(24):
+                pacing.change_hour()
+    return n * 24
+
+
+def bench_receive_notification(measure, n=20000):
+    pacing = Pacing(total_budget=10000, start_date=START, end_date=END, timezone="Europe/Paris")
+    rng = np.random.default_rng(3)
+    prices = rng.uniform(0.001, 0.04, n).tolist()
+    statuses = np.array(["win", "lose"])[rng.integers(0, 2, n)].tolist()
+    pacing.budget_engaged = sum(prices)
+    receive = pacing.receive_notification
+    with measure:
+        for status, price in zip(statuses, prices):
+            receive(status, price)
+    return n
+
+
+# Requests sent to the falcon application without server
+def bench_api(measure, route, n=5000):
+    import api_rest
+    today = datetime.utcnow()
+    api_rest.bdd.instances.clear()
+    api_rest.bdd.campaigns.clear()
+    api_rest.bdd.campaigns['bench'] = Campaign()
+    client = falcon.testing.TestClient(api_rest.api)
+    client.simulate_post("/campaign/bench/init", json={
+        "budget": 10000000,
+        "start": (today - timedelta(days=1)).strftime('%Y-%m-%d'),
+        "end": (today + timedelta(days=7)).strftime('%Y-%m-%d'),
+        "liid": "bench"
+    })
+    rng = np.random.default_rng(4)
+    tz = timezones(10)
+    bodies = [json.dumps({"tz": tz[i % 10], "brid": i, "imps": int(rng.integers(1, 5)),
+                          "cpm": float(rng.uniform(1, 10))}).encode() for i in range(n)]
+    api = api_rest.api
+
+    def start_response(status, headers):
+        pass
+
+    for body in bodies:
+        if route == 'br':
+            environ = falcon.testing.create_environ("/li/bench/br", method="POST", body=body)
+        else:
+            environ = falcon.testing.create_environ("/li/bench/status")
+        with measure:
+            b"".join(api(environ, start_response))
+    return n
+
+
+# Creation of line items one request at a time or in one bulk provisioning request
+def bench_provision(measure, bulk, n=2000, nb_campaigns=20):
+    import api_rest
+    from loguru import logger
+    today = datetime.utcnow()
+    api_rest.bdd.instances.clear()
+    api_rest.bdd.campaigns.clear()
+    dates = {"start": (today - timedelta(days=1)).strftime('%Y-%m-%d'),
+             "end": (today + timedelta(days=7)).strftime('%Y-%m-%d')}
+    rows = [{"cpid": f"bench{i % nb_campaigns}", "liid": f"bench{i}", "budget": 10000, **dates} for i in range(n)]
+    if bulk:
+        environs = [falcon.testing.create_environ("/provision", method="POST",
+                                                  body=b"\n".join(json.dumps(row).encode() for row in rows))]
+    else:
+        environs = [falcon.testing.create_environ("/campaign", method="POST",
+                                                  body=json.dumps({"cpid": f"bench{i}"}).encode())
+                    for i in range(nb_campaigns)]
+        environs += [falcon.testing.create_environ(f"/campaign/{row['cpid']}/init", method="POST",
+                                                   body=json.dumps({key: value for key, value in row.items()
+                                                                    if key != 'cpid'}).encode())
+                     for row in rows]
+    api = api_rest.api
+
+    def start_response(status, headers):
+        pass
+
+    # Both paths are measured without their logs
+    logger.disable('api_rest')
+    try:
+        for environ in environs:
+            with measure:
+                b"".join(api(environ, start_response))
+    finally:
+        logger.enable('api_rest')
+    assert len(api_rest.bdd.instances) == n
+    return n
+
+
+# Memory of the line items
+def instance_memory(n=50, nb_timezones=30):
+    """ Bytes per time zone instance of line items that received one bid request in each time zone
+
+    :param n: number of line items
+    :param nb_timezones: number of time zones per line item
+    :return: traced bytes per pacing instance (with its share of the line item)
+    """
+    tz = timezones(nb_timezones)
+    ts = (START + timedelta(days=2)).timestamp()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    line_items = []
+    for i in range(n):
+        pacing = GlobalPacing(total_budget=10000, start_date=START, end_date=END, notification_timeout=3600)
+        for j, tz_br in enumerate(tz):
+            pacing.choose_pacing(ts + j, tz_br, 2, 1, (i, j))
+        line_items.append(pacing)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size / (n * nb_timezones)
+
+
+BENCHMARKS = {
+    'buying_decision': bench_buying_decision,
+    'choose_pacing_1tz': lambda measure: bench_choose_pacing(measure, 1),
+    'choose_pacing_10tz': lambda measure: bench_choose_pacing(measure, 10),
+    'choose_pacing_100tz': lambda measure: bench_choose_pacing(measure, 100),
+    'day_reset_week': bench_day_reset,
+    'change_hour': bench_change_hour,
+    'receive_notification': bench_receive_notification,
+    'api_br': lambda measure: bench_api(measure, 'br'),
+    'api_status': lambda measure: bench_api(measure, 'status'),
+    'api_init_line_items': lambda measure: bench_provision(measure, False),
+    'api_provision': lambda measure: bench_provision(measure, True),
+}
+
+
+# Run the benchmarks
+def run(names=None, repeat=5):
+    """ Run each benchmark repeat times (best time kept) and once more to trace its memory: the net number of
+    memory blocks allocated per operation (what the operation keeps) and the peak of traced memory
+
+    :param names: names of the benchmarks (default is all)
+    :param repeat: number of timed runs
+    :return: dictionary of results per benchmark
+    """
+    results = {}
+    for name in names or BENCHMARKS:
+        times = []
+        for _ in range(repeat):
+            measure = Measure()
+            ops = BENCHMARKS[name](measure)
+            times.append(measure.elapsed_ns / ops)
+        tracemalloc.start()
+        measure = Measure(track_memory=True)
+        BENCHMARKS[name](measure)
+        tracemalloc.stop()
+        results[name] = {
+            'ops': ops,
+            'ns_per_op': min(times),
+            'median_ns_per_op': float(np.median(times)),
+            'net_blocks_per_op': measure.blocks / ops,
+            'peak_kib': measure.peak / 1024
+        }
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine()}
+
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else None
+    baseline = None
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)['benchmarks']
+    results = run()
+    memory = instance_memory()
+    print(f"{'instance_memory':22} {memory:10.0f} bytes per time zone instance")
+    for name, result in results.items():
+        line = (f"{name:22} {result['ns_per_op']:10.0f} ns/op   {result['net_blocks_per_op']:8.2f} net blocks/op   "
+                f"peak {result['peak_kib']:8.1f} KiB")
+        if baseline is not None and name in baseline:
+            line += f"   x{result['ns_per_op'] / baseline[name]['ns_per_op']:.2f} vs baseline"
+        print(line)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'meta': metadata(), 'benchmarks': results, 'instance_bytes': memory}, f, indent=2)
@@ -0,0 +1,54 @@
+import json
+import timeit
+import schemas
+from loguru import logger
+
+PAYLOADS = {
+    'bid_request': (schemas.bid_request, {"tz": "Europe/Paris", "brid": "42-1337", "imps": 3, "cpm": 4.52}),
+    'notification': (schemas.notification, {"status": "win", "brid": "42-1337"}),
+    'reset': (schemas.reset, {"new_budget": 5000}),
+    'line_item_init': (schemas.line_item_init, {"budget": 5000, "start": "2020-07-01", "end": "2020-07-14",
+                                                "liid": "1"})
+}
+
+
+# Parsing of the API before the schemas: decode, check the keys and log them
+def legacy_parse(body, required_argument):
+    """ Decode a body with json and check its arguments
+
+    :param body: body of the request
+    :param required_argument: set of required keys
+    :return: dictionary
+    """
+    data = json.loads(body)
+    missing_argument = required_argument.difference(data.keys())
+    if missing_argument:
+        raise KeyError(f"Missing argument {str(missing_argument)} in URL")
+    logger.info(f"Received arguments {data.keys()}")
+    return data
+
+
+# Compare the cost of parsing a request
+def bench(number=100000):
+    """ Measure the time to decode and validate each payload
+
+    :param number: number of requests parsed per measure
+    :return: dictionary of ns per request for each payload
+    """
+    results = {}
+    for name, (decoder, payload) in PAYLOADS.items():
+        body = json.dumps(payload).encode()
+        required_argument = set(payload)
+        legacy = min(timeit.repeat(lambda: legacy_parse(body, required_argument), number=number // 10, repeat=3))
+        compiled = min(timeit.repeat(lambda: decoder.decode(body), number=number, repeat=3))
+        results[name] = {'legacy_ns': legacy / (number // 10) * 1e9, 'schema_ns': compiled / number * 1e9}
+    return results
+
+
+if __name__ == '__main__':
+    # The legacy parsing logs every request: the logs are discarded to only measure their formatting
+    logger.remove()
+    logger.add(lambda message: None)
+    for name, result in bench().items():
+        print(f"{name:15} legacy {result['legacy_ns']:8.0f} ns   schema {result['schema_ns']:6.0f} ns   "
+              f"x{result['legacy_ns'] / result['schema_ns']:.1f}")
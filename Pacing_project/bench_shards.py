@@ -0,0 +1,34 @@
+import os
+import sys
+from bench_api import bench_server
+
+
+# Throughput of the sharded API for an increasing number of workers
+def bench_shards(max_shards, concurrency=32, duration=10, nb_line_items=64):
+    """ Load api_shards.py with 1, 2, 4... workers (and as many routers and client processes)
+
+    :param max_shards: maximum number of workers
+    :param concurrency: number of connections of each client process
+    :param duration: duration of each load in seconds
+    :param nb_line_items: number of line items, spread over the workers
+    :return: list of results of bench_server
+    """
+    results = []
+    nb_shards = 1
+    while nb_shards <= max_shards:
+        result = bench_server("api_shards.py", 8200, nb_line_items=nb_line_items, concurrency=concurrency,
+                              duration=duration, args=(str(nb_shards), str(nb_shards)), clients=nb_shards)
+        result['shards'] = nb_shards
+        results.append(result)
+        nb_shards *= 2
+    return results
+
+
+if __name__ == '__main__':
+    max_shards = int(sys.argv[1]) if len(sys.argv) > 1 else max(1, os.cpu_count() // 3)
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    results = bench_shards(max_shards, duration=duration)
+    for result in results:
+        print(f"{result['shards']:3} workers {result['requests_per_sec']:7.0f} req/s "
+              f"(x{result['requests_per_sec'] / results[0]['requests_per_sec']:.2f})   "
+              f"p50 {result['p50_ms']:7.2f} ms   p99 {result['p99_ms']:7.2f} ms   errors {result['errors']}")
@@ -0,0 +1,342 @@
+from datetime import datetime, timedelta
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytz
+from loguru import logger
+
+NS_PER_DAY = 86400 * 10 ** 9
+
+# Columns of the bid requests (the same as br_clean.pkl) and their type on disk. The time zones are stored as codes
+# of the list of time zones of the store.
+COLUMNS = {
+    'UTC_date': 'datetime64[ns]',
+    'ts': 'float64',
+    'TZ': 'int16',
+    'imps': 'float64',
+    'CPM': 'float64',
+    'price': 'float64',
+    'win': 'bool',
+    'seconds_notif': 'int32',
+    'id': 'int64'
+}
+
+# Relative traffic per local hour: low at night, peak in the evening
+DIURNAL = [0.35, 0.22, 0.15, 0.12, 0.12, 0.18, 0.35, 0.6, 0.8, 0.9, 0.95, 1.0,
+           1.05, 1.0, 0.95, 0.95, 1.0, 1.1, 1.25, 1.4, 1.5, 1.4, 1.05, 0.65]
+# Relative traffic per local weekday, from Monday to Sunday
+WEEKDAY = [1.0, 1.0, 1.0, 1.0, 1.05, 1.1, 1.0]
+
+# Share of the bid requests per time zone in the original dataset
+SHARES = {
+    'America/New_York': 0.3662,
+    'America/Chicago': 0.3121,
+    'America/Los_Angeles': 0.1151,
+    'America/Phoenix': 0.0406,
+    'America/Detroit': 0.035,
+    'America/Denver': 0.0077,
+    'Europe/Paris': 0.006,
+    'America/Indiana/Indianapolis': 0.0052,
+    'Europe/London': 0.003,
+    'America/Boise': 0.0018,
+    'America/Kentucky/Louisville': 0.0017
+}
+
+
+# Traffic of a time zone
+class TimezoneProfile:
+    """ Shape and values of the bid requests of a time zone
+    """
+
+    def __init__(self, requests_per_day, diurnal=DIURNAL, weekday=WEEKDAY, win_rate=0.6, notification_delay=120,
+                 cpm=9, imps_median=7, imps_sigma=1.2):
+        """Class constructor
+
+        :param requests_per_day: mean number of bid requests per day
+        :param diurnal: relative traffic of each local hour (24 values)
+        :param weekday: relative traffic of each local weekday from Monday (7 values)
+        :param win_rate: probability to win a bid request
+        :param notification_delay: mean delay of the notifications in seconds
+        :param cpm: CPM of the bid requests, or (low, high) to draw it uniformly
+        :param imps_median: median number of impressions of a bid request
+        :param imps_sigma: dispersion of the (log-normal) number of impressions
+        """
+        if len(diurnal) != 24 or len(weekday) != 7:
+            raise ValueError("A profile needs 24 hourly and 7 daily values")
+        self.requests_per_day = requests_per_day
+        # Normalized so that the mean day has requests_per_day bid requests
+        self.diurnal = np.asarray(diurnal, dtype=float) / np.mean(diurnal)
+        self.weekday = np.asarray(weekday, dtype=float) / np.mean(weekday)
+        self.win_rate = win_rate
+        self.notification_delay = notification_delay
+        self.cpm = cpm
+        self.imps_median = imps_median
+        self.imps_sigma = imps_sigma
+
+
+# Profiles of the time zones of the original dataset
+def default_profiles(requests_per_day=100000, **kwargs):
+    """ Split a number of bid requests per day over the time zones of the original dataset
+
+    :param requests_per_day: total number of bid requests per day
+    :param kwargs: other arguments of the profiles
+    :return: dictionary {time zone: TimezoneProfile}
+    """
+    total = sum(SHARES.values())
+    return {tz: TimezoneProfile(requests_per_day * share / total, **kwargs) for tz, share in SHARES.items()}
+
+
+# Synthetic bid requests
+def generate(profiles, start, end, seed=0, chunk_seconds=3600):
+    """ Generate the bid requests between two dates, chunk by chunk so that the memory does not depend on the length
+    of the stream. The number of bid requests of a chunk follows a Poisson law whose mean is given by the local hour
+    and weekday of each time zone.
+
+    :param profiles: dictionary {time zone: TimezoneProfile}
+    :param start: first UTC day (datetime)
+    :param end: UTC day after the last one (datetime)
+    :param seed: seed of the generator
+    :param chunk_seconds: duration of a chunk, it must divide a day
+    :return: generator of dictionaries of columns (time zones as codes of the sorted time zones), sorted by date
+    """
+    if 86400 % chunk_seconds:
+        raise ValueError("The duration of a chunk must divide a day")
+    rng = np.random.default_rng(seed)
+    names = sorted(profiles)
+    timezones = [pytz.timezone(tz) for tz in names]
+    start_ts = int(pytz.utc.localize(start).timestamp())
+    end_ts = int(pytz.utc.localize(end).timestamp())
+    next_id = 0
+    for chunk_ts in range(start_ts, end_ts, chunk_seconds):
+        middle = datetime.fromtimestamp(chunk_ts + chunk_seconds / 2, tz=pytz.utc)
+        counts = []
+        for tz, name in zip(timezones, names):
+            profile = profiles[name]
+            local = middle.astimezone(tz)
+            mean = (profile.requests_per_day * chunk_seconds / 86400 * profile.diurnal[local.hour] *
+                    profile.weekday[local.weekday()])
+            counts.append(rng.poisson(mean))
+        n = sum(counts)
+        codes = np.repeat(np.arange(len(names), dtype=np.int16), counts)
+        # Millisecond resolution, like the original dataset
+        ms = rng.integers(chunk_ts * 1000, (chunk_ts + chunk_seconds) * 1000, n)
+        order = np.argsort(ms, kind='stable')
+        ms = ms[order]
+        codes = codes[order]
+        imps = np.empty(n)
+        cpm = np.empty(n)
+        win = np.empty(n, dtype=bool)
+        seconds_notif = np.empty(n, dtype=np.int32)
+        for code, name in enumerate(names):
+            profile = profiles[name]
+            rows = codes == code
+            size = int(np.count_nonzero(rows))
+            imps[rows] = profile.imps_median * rng.lognormal(0, profile.imps_sigma, size)
+            if isinstance(profile.cpm, (tuple, list)):
+                cpm[rows] = rng.uniform(profile.cpm[0], profile.cpm[1], size)
+            else:
+                cpm[rows] = profile.cpm
+            win[rows] = rng.random(size) < profile.win_rate
+            seconds_notif[rows] = np.ceil(rng.exponential(profile.notification_delay, size))
+        yield {
+            'UTC_date': (ms * 1000000).astype('datetime64[ns]'),
+            'ts': ms / 1000,
+            'TZ': codes,
+            'imps': imps,
+            'CPM': cpm,
+            'price': imps * cpm / 1000,
+            'win': win,
+            'seconds_notif': seconds_notif,
+            'id': np.arange(next_id, next_id + n, dtype=np.int64)
+        }
+        next_id += n
+
+
+# Columnar store of bid requests partitioned by UTC day
+class StoreWriter:
+    """ Directory with one folder per UTC day and one raw file per column in each folder. Chunks are appended to the
+    files, so a store of any size is written with the memory of a chunk. A meta.json file gives the time zones, the
+    types of the columns and the number of rows of each day.
+    """
+
+    def __init__(self, path, timezones):
+        """Class constructor
+
+        :param path: directory of the store, it must not exist (chunks would be appended to an older store)
+        :param timezones: list of the time zones (the codes of the TZ column are indexes of this list)
+        """
+        self.path = path
+        self.timezones = list(timezones)
+        self.partitions = {}
+        os.makedirs(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, chunk):
+        """ Append a chunk of bid requests sorted by date
+
+        :param chunk: dictionary of columns
+        """
+        days = chunk['UTC_date'].astype(np.int64) // NS_PER_DAY
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        for rows in np.split(np.arange(len(days)), bounds):
+            if not len(rows):
+                continue
+            day = str(np.datetime64(int(days[rows[0]]), 'D'))
+            folder = os.path.join(self.path, day)
+            os.makedirs(folder, exist_ok=True)
+            for column, dtype in COLUMNS.items():
+                with open(os.path.join(folder, f"{column}.bin"), 'ab') as f:
+                    np.ascontiguousarray(chunk[column][rows[0]:rows[-1] + 1], dtype=dtype).tofile(f)
+            self.partitions[day] = self.partitions.get(day, 0) + len(rows)
+
+    def close(self):
+        """ Write the description of the store
+        """
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'columns': COLUMNS, 'timezones': self.timezones,
+                       'partitions': dict(sorted(self.partitions.items()))}, f, indent=2)
+
+
+# Generate a store
+def write_store(path, profiles, start, end, seed=0, chunk_seconds=3600):
+    """ Generate bid requests and write them in a columnar store
+
+    :param path: directory of the store
+    :param profiles: dictionary {time zone: TimezoneProfile}
+    :param start: first UTC day (datetime)
+    :param end: UTC day after the last one (datetime)
+    :param seed: seed of the generator
+    :param chunk_seconds: duration of a chunk in seconds
+    :return: number of bid requests
+    """
+    nb_rows = 0
+    with StoreWriter(path, sorted(profiles)) as writer:
+        for chunk in generate(profiles, start, end, seed, chunk_seconds):
+            writer.write(chunk)
+            nb_rows += len(chunk['id'])
+    return nb_rows
+
+
+# Memory-mapped reader of a store
+class BidRequestStore:
+    """ Read the bid requests of a store written by StoreWriter. The columns are memory-mapped: a date range only
+    touches its days, and the rows are read chunk by chunk, so the memory follows the chunks and not the store.
+    """
+
+    def __init__(self, path):
+        """Class constructor
+
+        :param path: directory of the store
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.columns = meta['columns']
+        self.timezones = meta['timezones']
+        self.partitions = meta['partitions']
+
+    def __len__(self):
+        return sum(self.partitions.values())
+
+    def column(self, day, column):
+        """ Map a column of a day
+
+        :param day: UTC day of the partition ('YYYY-MM-DD')
+        :param column: name of the column
+        :return: read-only np.memmap
+        """
+        return np.memmap(os.path.join(self.path, day, f"{column}.bin"), dtype=self.columns[column], mode='r',
+                         shape=(self.partitions[day],))
+
+    def ranges(self, start=None, end=None):
+        """ Rows of the days between two dates. The days outside the range are not opened, and the first and last
+        rows of the days at the bounds are found by a binary search on their dates.
+
+        :param start: first UTC date (included, string or datetime, default is the beginning of the store)
+        :param end: last UTC date (excluded, string or datetime, default is the end of the store)
+        :return: generator of (day, first row, end row)
+        """
+        start = None if start is None else pd.Timestamp(start).to_datetime64()
+        end = None if end is None else pd.Timestamp(end).to_datetime64()
+        for day, nb_rows in self.partitions.items():
+            day_start = np.datetime64(day, 'ns')
+            day_end = day_start + np.timedelta64(1, 'D')
+            if not nb_rows or (start is not None and day_end <= start) or (end is not None and day_start >= end):
+                continue
+            first, last = 0, nb_rows
+            if start is not None and start > day_start:
+                first = int(np.searchsorted(self.column(day, 'UTC_date'), start))
+            if end is not None and end < day_end:
+                last = int(np.searchsorted(self.column(day, 'UTC_date'), end))
+            if first < last:
+                yield day, first, last
+
+    def chunks(self, start=None, end=None, chunk_rows=1 << 20, columns=None):
+        """ Read the bid requests between two dates
+
+        :param start: first UTC date (included)
+        :param end: last UTC date (excluded)
+        :param chunk_rows: maximum number of rows of a chunk
+        :param columns: list of columns to read (default is all)
+        :return: generator of DataFrames indexed by UTC_date, in the order of the dates
+        """
+        columns = [column for column in self.columns if column != 'UTC_date' and (columns is None or column in columns)]
+        for day, first, last in self.ranges(start, end):
+            mapped = {column: self.column(day, column) for column in ['UTC_date'] + columns}
+            for begin in range(first, last, chunk_rows):
+                stop = min(begin + chunk_rows, last)
+                data = {column: np.array(mapped[column][begin:stop]) for column in columns}
+                if 'TZ' in data:
+                    data['TZ'] = pd.Categorical.from_codes(data['TZ'], self.timezones)
+                yield pd.DataFrame(data, index=pd.DatetimeIndex(np.array(mapped['UTC_date'][begin:stop]),
+                                                                name='UTC_date'))
+
+
+# Read a whole store
+def read_dataframe(path, start=None, end=None):
+    """ Load the bid requests of a store between two dates as a dataframe with the columns of br_clean.pkl
+
+    :param path: directory of the store
+    :param start: first UTC date (included)
+    :param end: last UTC date (excluded)
+    :return: DataFrame
+    """
+    store = BidRequestStore(path)
+    chunks = list(store.chunks(start, end))
+    if not chunks:
+        return pd.DataFrame({column: np.empty(0, dtype=dtype) for column, dtype in store.columns.items()})
+    return pd.concat(chunks).reset_index()
+
+
+if __name__ == '__main__':
+    # python br_store.py output first_day last_day [requests per day] [profiles.json] [seed]
+    output = sys.argv[1]
+    start = datetime.strptime(sys.argv[2], '%Y-%m-%d')
+    end = datetime.strptime(sys.argv[3], '%Y-%m-%d') + timedelta(days=1)
+    requests_per_day = float(sys.argv[4]) if len(sys.argv) > 4 else 100000
+    if len(sys.argv) > 5:
+        # {time zone: {argument of TimezoneProfile: value}}, the requests per day are a share of the total
+        with open(sys.argv[5]) as f:
+            config = json.load(f)
+        total = sum(profile.get('share', 1) for profile in config.values())
+        profiles = {tz: TimezoneProfile(requests_per_day * profile.pop('share', 1) / total, **profile)
+                    for tz, profile in config.items()}
+    else:
+        profiles = default_profiles(requests_per_day)
+    seed = int(sys.argv[6]) if len(sys.argv) > 6 else 0
+    if output.endswith('.pkl'):
+        # Same file as br_clean.pkl for the existing scripts, it must fit in memory
+        chunks = list(generate(profiles, start, end, seed))
+        df = pd.DataFrame({column: np.concatenate([chunk[column] for chunk in chunks]) for column in COLUMNS})
+        df['TZ'] = np.array(sorted(profiles), dtype=object)[df['TZ'].to_numpy()]
+        df.to_pickle(output)
+        logger.info(f"Wrote {len(df)} bid requests in {output}")
+    else:
+        logger.info(f"Wrote {write_store(output, profiles, start, end, seed)} bid requests in {output}")
@@ -0,0 +1,153 @@
+import gc
+import os
+import pickle
+import struct
+import time
+import zlib
+from loguru import logger
+
+# Header of a checkpoint file: magic, version of the format, length and checksum of the payload
+MAGIC = b'PACING'
+VERSION = 12
+HEADER = struct.Struct('<6sHQI')
+
+
+# Write the state of a database to a file
+def save(bdd, path):
+    """ Serialize the campaigns, the line items (GlobalPacing and Pacing instances) and the traffic profiles of a
+    database.
+    The file is written next to the previous checkpoint and renamed, so a checkpoint is never half written.
+
+    :param bdd: DataBase
+    :param path: path of the checkpoint file
+    :return: size of the file in bytes
+    """
+    payload = pickle.dumps((bdd.campaigns, bdd.instances, bdd.traffic_profiles), protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(payload), zlib.crc32(payload)))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return HEADER.size + len(payload)
+
+
+# Read the state of a database from a file
+def load(path):
+    """ Read a checkpoint written by save
+
+    :param path: path of the checkpoint file
+    :return: campaigns, instances and traffic profiles of the database
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is not a checkpoint")
+    magic, version, length, checksum = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a checkpoint")
+    if version != VERSION:
+        raise ValueError(f"Checkpoint version {version} is not supported (expected {VERSION})")
+    payload = memoryview(data)[HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        raise ValueError(f"Checkpoint {path} is corrupted")
+    # Unpickling creates a lot of objects, the garbage collector would run again and again for nothing
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(payload)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+# Periodic checkpoints of a database
+class Checkpoint(object):
+    """ Save a database every interval seconds. The state is written by a forked process: the server only pays for
+    the fork and keeps handling requests while the copy of its memory is serialized.
+    """
+
+    def __init__(self, bdd, path, interval=60, clock=time.monotonic):
+        """Class constructor
+
+        :param bdd: DataBase
+        :param path: path of the checkpoint file
+        :param interval: seconds between two checkpoints
+        :param clock: function returning the current time in seconds
+        """
+        self.bdd = bdd
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.next_save = clock() + interval
+        self.writer = None
+
+    def restore(self):
+        """ Load the checkpoint into the database if there is one
+
+        :return: True if the database has been restored
+        """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            campaigns, instances, traffic_profiles = load(self.path)
+        except Exception as e:
+            logger.warning(f"Unable to restore {self.path}: {e}")
+            return False
+        self.bdd.campaigns.clear()
+        self.bdd.campaigns.update(campaigns)
+        self.bdd.instances.clear()
+        self.bdd.instances.update(instances)
+        # The restored line items share the restored profiles
+        self.bdd.traffic_profiles = traffic_profiles
+        logger.info(f"Restored {len(campaigns)} campaigns and {len(instances)} line items from {self.path}")
+        return True
+
+    def tick(self):
+        """ Start a checkpoint if it is time to
+        """
+        if self.writer is not None:
+            pid, _ = os.waitpid(self.writer, os.WNOHANG)
+            if pid == 0:
+                return
+            self.writer = None
+        if self.clock() < self.next_save:
+            return
+        self.next_save = self.clock() + self.interval
+        self.save_in_background()
+
+    def save_in_background(self):
+        """ Write the checkpoint from a child process (or in place where fork is not available)
+        """
+        # No request is half handled while the locks of the database and of the line items are held
+        locks = [self.bdd.lock]
+        with self.bdd.lock:
+            locks.extend(instance.lock for instance in self.bdd.instances.values())
+        for lock in locks:
+            lock.acquire()
+        try:
+            if not hasattr(os, 'fork'):
+                save(self.bdd, self.path)
+                return
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    save(self.bdd, self.path)
+                except BaseException:
+                    status = 1
+                finally:
+                    os._exit(status)
+            self.writer = pid
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def close(self):
+        """ Wait for the running checkpoint and write a last one
+        """
+        if self.writer is not None:
+            os.waitpid(self.writer, 0)
+            self.writer = None
+        save(self.bdd, self.path)
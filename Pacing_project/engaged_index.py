@@ -0,0 +1,139 @@
+from array import array
+import math
+
+
+# Bid requests bought and waiting for their notification
+class EngagedIndex:
+    """ Price and owner of the bought bid requests, stored in arrays indexed by slot. A timer wheel gives the bid
+    requests whose notification did not come before a timeout.
+
+    The wheel has one bucket per resolution seconds and covers the timeout: a bid request is put in the bucket of its
+    deadline and is expired, at most resolution seconds late, when the time passes the bucket.
+    """
+
+    __slots__ = ('timeout', 'resolution', 'slots', 'free', 'br_ids', 'prices', 'owners', 'deadlines', 'nb_expired',
+                 'wheel', 'tick')
+
+    def __init__(self, timeout=None, resolution=60):
+        """Class constructor
+
+        :param timeout: seconds to wait for a notification (default is None: never expire)
+        :param resolution: width of a bucket of the wheel in seconds
+        """
+        self.timeout = timeout
+        self.resolution = resolution
+        # Slot of each bid request id, free slots are reused
+        self.slots = {}
+        self.free = []
+        self.br_ids = []
+        self.prices = array('d')
+        self.owners = array('i')
+        self.deadlines = array('d')
+        self.nb_expired = 0
+        # The wheel is created with the first bid request
+        self.wheel = None
+        self.tick = None
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, br_id):
+        return br_id in self.slots
+
+    def add(self, br_id, owner, price, ts):
+        """ Record a bought bid request. A bid request bought again before its notification replaces the previous
+        purchase, which is counted as expired.
+
+        :param br_id: id of the bid request
+        :param owner: integer code of the pacing instance that engaged the budget
+        :param price: engaged price
+        :param ts: timestamp of the purchase in seconds
+        :return: owner and price of the replaced purchase (None if the bid request was not waiting)
+        """
+        replaced = None
+        if br_id in self.slots:
+            replaced = self.pop(br_id)
+            self.nb_expired += 1
+        if self.free:
+            slot = self.free.pop()
+            self.br_ids[slot] = br_id
+            self.prices[slot] = price
+            self.owners[slot] = owner
+        else:
+            slot = len(self.br_ids)
+            self.br_ids.append(br_id)
+            self.prices.append(price)
+            self.owners.append(owner)
+            self.deadlines.append(0)
+        self.slots[br_id] = slot
+        if self.timeout is not None:
+            deadline = ts + self.timeout
+            self.deadlines[slot] = deadline
+            if self.tick is None:
+                self.wheel = [[] for _ in range(math.ceil(self.timeout / self.resolution) + 1)]
+                self.tick = int(ts // self.resolution)
+            self.wheel[int(deadline // self.resolution) % len(self.wheel)].append(slot)
+        return replaced
+
+    def release(self, slot):
+        """ Free a slot
+
+        :param slot: slot of a bid request
+        :return: owner and price of the bid request
+        """
+        br_id = self.br_ids[slot]
+        # The id may already point to a later slot
+        if self.slots.get(br_id) == slot:
+            del self.slots[br_id]
+        self.br_ids[slot] = None
+        owner = self.owners[slot]
+        self.owners[slot] = -1
+        self.free.append(slot)
+        return owner, self.prices[slot]
+
+    def pop(self, br_id):
+        """ Remove a bid request when its notification comes
+
+        :param br_id: id of the bid request
+        :return: owner and price of the bid request (KeyError if it is unknown or expired)
+        """
+        return self.release(self.slots[br_id])
+
+    def expire(self, ts):
+        """ Remove the bid requests whose deadline has passed
+
+        :param ts: current timestamp in seconds
+        :return: list of (owner, price) of the expired bid requests
+        """
+        if self.timeout is None or self.tick is None:
+            return []
+        now = int(ts // self.resolution)
+        if now <= self.tick:
+            return []
+        expired = []
+        size = len(self.wheel)
+        # The buckets of the elapsed ticks, each one at most once
+        for tick in range(max(self.tick, now - size), now):
+            bucket = self.wheel[tick % size]
+            if not bucket:
+                continue
+            waiting = []
+            for slot in bucket:
+                if self.owners[slot] < 0:
+                    continue
+                if self.deadlines[slot] // self.resolution < now:
+                    expired.append(self.release(slot))
+                else:
+                    # The slot has been reused by a bid request with a later deadline
+                    waiting.append(slot)
+            self.wheel[tick % size] = waiting
+        self.tick = now
+        self.nb_expired += len(expired)
+        return expired
+
+    def to_dict(self):
+        """ Return the bid requests waiting for their notification
+
+        :return: dictionary {br_id: (owner, price)}
+        """
+        return {br_id: (self.owners[slot], self.prices[slot]) for br_id, slot in self.slots.items()}
@@ -1,5 +1,7 @@
 import requests as req
 import pandas as pd
+import sys
+from br_store import BidRequestStore
 from datetime import datetime
 import pytz
 
@@ -8,7 +10,7 @@ import pytz
 def main(data, budget):
     """Function to simulate the API
 
-    :param data: Dataframe of br
+    :param data: Dataframe of br, or iterable of Dataframes of br (chunks of a store)
     :param budget: budget allocated to the line item
     :return:
     """
@@ -21,7 +23,9 @@ def main(data, budget):
         "liid": "1"
     })
     i = True
-    for utc, row in data.iterrows():
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    rows = (row for chunk in chunks for row in chunk.iterrows())
+    for utc, row in rows:
         if i and utc > datetime(2020, 7, 9):
             i = False
             # Simulate a reset in the budget
@@ -57,11 +61,15 @@ def main(data, budget):
 
 
 if __name__ == '__main__':
-    df = pd.read_pickle('data/br_clean.pkl')
-    df.set_index('UTC_date', inplace=True)
-    df.sort_index(inplace=True)
-    df['id'] = range(len(df))
-    databis = df['2020-07-08':'2020-07-13']
+    if len(sys.argv) > 1:
+        # Store written by br_store.py: only the simulated days are read, chunk by chunk
+        databis = BidRequestStore(sys.argv[1]).chunks('2020-07-08', '2020-07-14')
+    else:
+        df = pd.read_pickle('data/br_clean.pkl')
+        df.set_index('UTC_date', inplace=True)
+        df.sort_index(inplace=True)
+        df['id'] = range(len(df))
+        databis = df['2020-07-08':'2020-07-13']
     main(databis, 10000)
     req.get("http://127.0.0.1:8000/li/1/status/tz")
     req.get("http://127.0.0.1:8000/li/1/status")
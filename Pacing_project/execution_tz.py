@@ -1,11 +1,17 @@
 from external_functions_tz import main
+from br_store import BidRequestStore
 import pandas as pd
+import sys
 
 
 if __name__ == '__main__':
-    df = pd.read_pickle('br_clean.pkl')
-    df.set_index('UTC_date', inplace=True)
-    df.sort_index(inplace=True)
-    df['id'] = range(len(df))
-    df_slice = df['2020-07-08':'2020-07-13']
-    pacing_results = main(df_slice, 10000, 9, 12)
+    if len(sys.argv) > 1:
+        # Store written by br_store.py: only the simulated days are read, chunk by chunk
+        data = BidRequestStore(sys.argv[1]).chunks('2020-07-08', '2020-07-14')
+    else:
+        df = pd.read_pickle('br_clean.pkl')
+        df.set_index('UTC_date', inplace=True)
+        df.sort_index(inplace=True)
+        df['id'] = range(len(df))
+        data = df['2020-07-08':'2020-07-13']
+    pacing_results = main(data, 10000, 9, 12)
@@ -1,5 +1,8 @@
 from pacing_class_tz import GlobalPacing
-from datetime import datetime, timedelta
+from datetime import datetime
+import heapq
+import itertools
+import numpy as np
 import pandas as pd
 import pytz
 from loguru import logger
@@ -10,84 +13,162 @@ def send_pending_notifications(instance_obj, pending_notif, current_ts=None):
     """ Send notifications
 
     :param instance_obj: instance of the algorithm class
-    :param pending_notif: list of notifications
+    :param pending_notif: heap of notifications (timestamp, order of creation, id, status)
     :param current_ts: if None: will send all notifications, else send before current_ts
     """
-    while len(pending_notif) > 0 and (pending_notif[0]['timestamp'] <= current_ts if current_ts else True):
-        ev = pending_notif.pop(0)
-        instance_obj.dispatch_notifications(ev['id'], ev['status'])
+    while pending_notif and (current_ts is None or pending_notif[0][0] <= current_ts):
+        _, _, br_id, status = heapq.heappop(pending_notif)
+        instance_obj.dispatch_notifications(br_id, status)
 
 
-# Main function to simulate the algorithm
-def main(data, budget, day_start, day_end):
-    """ Function that simulates the algorithm on a dataframe of bid requests
+# Bid requests that are inside the campaign
+def campaign_mask(pacing, ts, tz_names):
+    """ Check the campaign bounds once per time zone instead of once per bid request
 
-    :param data: Dataframe of br
-    :param budget: budget of the line item
-    :param day_start: starting date
-    :param day_end: ending date
-    :return: Dataframe to see performances
+    :param pacing: GlobalPacing instance
+    :param ts: array of timestamps
+    :param tz_names: array of time zones
+    :return: boolean array, True if the bid request is inside the campaign
     """
-    logger.info(f"Start pacing on {len(data)} bid requests")
-    pacing = GlobalPacing(total_budget=budget, start_date=datetime(2020, 7, day_start),
-                          end_date=datetime(2020, 7, day_end))
+    codes, groups = np.unique(tz_names, return_inverse=True)
+    # Compare in microseconds, the resolution of the timestamps given to the pacing
+    ts_micro = np.round(ts * 1e6)
+    mask = np.zeros(len(ts), dtype=bool)
+    for code, tz in enumerate(codes.tolist()):
+        tz_cache = pacing.timezone_cache(tz)
+        rows = groups == code
+        mask[rows] = (ts_micro[rows] >= tz_cache.start_ts * 1e6) & (ts_micro[rows] <= tz_cache.end_ts * 1e6)
+    return mask
+
+
+# Simulate the algorithm on a chunk of bid requests
+def simulate_chunk(pacing, data, new_budget, pending_notifications, order, reset_pending):
+    """ Send the bid requests of a chunk to the pacing and the notifications that are due
+
+    :param pacing: GlobalPacing instance
+    :param data: Dataframe of br (chunk of the simulation)
+    :param new_budget: budget of the line item after the change of budget
+    :param pending_notifications: heap of the notifications that are not sent yet
+    :param order: counter of the notifications
+    :param reset_pending: True if the change of budget did not happen yet
+    :return: Dataframe of the decisions and reset_pending
+    """
+    # Columns of the bid requests
+    utc_dates = data.index
+    utc_ns = utc_dates.values.astype('datetime64[ns]').astype(np.int64)
+    ts = data['ts'].to_numpy(dtype=float)
+    tz_names = data['TZ'].to_numpy()
+    rows = np.flatnonzero(campaign_mask(pacing, ts, tz_names))
+    # Index of the bid request that triggers the change of budget
+    reset_row = None
+    if reset_pending:
+        after_reset = utc_ns > np.datetime64(datetime(2020, 7, 9), 'ns').astype(np.int64)
+        reset_row = np.argmax(after_reset) if after_reset.any() else None
+
+    # Only the bid requests of the campaign are iterated, as Python scalars
+    notif_ns = utc_ns + np.round(data['seconds_notif'].to_numpy(dtype=float) * 1e6).astype(np.int64) * 1000
+    columns = zip(rows.tolist(), utc_ns[rows].tolist(), ts[rows].tolist(), tz_names[rows].tolist(),
+                  data['price'].to_numpy()[rows].tolist(), data['imps'].to_numpy()[rows].tolist(),
+                  data['id'].to_numpy()[rows].tolist(), notif_ns[rows].tolist(),
+                  data['win'].to_numpy(dtype=bool)[rows].tolist())
+    tz_objects = {tz: pytz.timezone(tz) for tz in np.unique(tz_names[rows]).tolist()}
     records = []
-    pending_notifications = []
-    i = True
-    for utc, row in data.iterrows():
-        if i and utc > datetime(2020, 7, 9):
-            i = False
-            pacing.change_setup(budget + 1000)
-        tz = row['TZ']
-        ts = row['ts']
-        local = datetime.fromtimestamp(ts, tz=pytz.timezone(tz))
-
-        # Before the campaign?
-        if local < pytz.timezone(tz).localize(pacing.start_date):
-            continue
-
-        # End of the campaign?
-        if local > pytz.timezone(tz).localize(pacing.end_date + timedelta(days=1)):
-            continue
+    i = reset_row is not None
+    for row, utc, ts_br, tz, cpm, imps, br_id, next_notif_ts, win in columns:
+        if i and row >= reset_row:
+            i = reset_pending = False
+            pacing.update_budget(new_budget)
+        local = datetime.fromtimestamp(ts_br, tz=tz_objects[tz])
 
         # Send current notifications
         send_pending_notifications(pacing, pending_notifications, utc)
 
         # Receive BR and make a decision
-        buying, budget_remaining, spent_budget, budget_engaged, objective, prop = pacing.choose_pacing(
-            ts, tz, row['price'], row['imps'], row['id'])
+        price = (imps * cpm) / 1000
+        record = pacing.pacing_decision(ts_br, tz, price, imps, br_id)
 
         # Create notification
-        if buying:
-            next_notif_ts = utc + timedelta(seconds=row['seconds_notif'])
-            status = "win" if row['win'] else "lose"
-            br_id = row['id']
-            pending_notifications.append(
-                {"timestamp": next_notif_ts, "status": status,
-                 "br_price": row['price'], "id": br_id})
-            pending_notifications.sort(key=lambda x: x["timestamp"])
-        record = {
-            'utc_date': utc,
-            'local_date': local,
-            'tz': tz,
-            'buying': buying,
-            'remaining': budget_remaining,
-            'spent': spent_budget,
-            'engaged': budget_engaged,
-            'objective': objective,
-            'prop': prop
-        }
-        records.append(record)
+        if record[0]:
+            status = "win" if win else "lose"
+            heapq.heappush(pending_notifications, (next_notif_ts, next(order), br_id, status))
+        records.append((local,) + record)
+    if i:
+        reset_pending = False
+        pacing.update_budget(new_budget)
+
+    local_dates, buyings, remaining, spent, engaged, objective, prop = zip(*records) if records else [()] * 7
+    pacing_df = pd.DataFrame({
+        'local_date': list(local_dates),
+        'tz': tz_names[rows],
+        'buying': np.array(buyings, dtype=bool),
+        'remaining': np.array(remaining, dtype=float),
+        'spent': np.array(spent, dtype=float),
+        'engaged': np.array(engaged, dtype=float),
+        'objective': np.array(objective, dtype=float),
+        'prop': np.array(prop, dtype=float)
+    }, index=pd.Index(utc_dates[rows], name='utc_date'))
+    return pacing_df, reset_pending
+
+
+# Simulate the algorithm
+def simulate(data, budget, day_start, day_end, budget_change=1000, profiler=None, **settings):
+    """ Function that simulates the algorithm on a dataframe of bid requests
+
+    :param data: Dataframe of br, or iterable of Dataframes of br in the order of the dates (chunks of a store)
+    :param budget: budget of the line item
+    :param day_start: starting date
+    :param day_end: ending date
+    :param budget_change: budget added to the line item on July 9 (None: the budget does not change)
+    :param profiler: Profiler timing the stages of the decisions during the simulation (default is None: no profiling)
+    :param settings: settings of the pacing instances (coef, purchase_threshold, objective_ratio)
+    :return: GlobalPacing at the end of the campaign and Dataframe to see performances
+    """
+    if isinstance(data, pd.DataFrame):
+        logger.info(f"Start pacing on {len(data)} bid requests")
+        data = [data]
+    else:
+        logger.info("Start pacing on chunks of bid requests")
+    pacing = GlobalPacing(total_budget=budget, start_date=datetime(2020, 7, day_start),
+                          end_date=datetime(2020, 7, day_end), **settings)
+    pending_notifications = []
+    order = itertools.count()
+    reset_pending = budget_change is not None
+    new_budget = budget + (budget_change or 0)
+    results = []
+    if profiler is not None:
+        profiler.start()
+    try:
+        for chunk in data:
+            pacing_df, reset_pending = simulate_chunk(pacing, chunk, new_budget, pending_notifications, order,
+                                                      reset_pending)
+            results.append(pacing_df)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    if not results:
+        raise ValueError("No bid requests to simulate")
+    # Chunks outside the campaign give empty results
+    results = [pacing_df for pacing_df in results if len(pacing_df)] or results[:1]
     # Send remaining notifications
     send_pending_notifications(pacing, pending_notifications)
 
     # Get pacing performances
     spents = pacing.pacing_performance()
-
-    # Generate result DataFrame
-    pacing_df = pd.DataFrame.from_records(records)
-    pacing_df.set_index('utc_date', inplace=True)
     logger.info("End of the campaign")
     logger.info(f"Total budget spent: {sum(spents)}")
     logger.info(f"Remaining budget: {pacing.total_budget - sum(spents)}")
-    return pacing_df
+    return pacing, pd.concat(results) if len(results) > 1 else results[0]
+
+
+# Main function to simulate the algorithm
+def main(data, budget, day_start, day_end, **settings):
+    """ Function that simulates the algorithm on a dataframe of bid requests
+
+    :param data: Dataframe of br, or iterable of Dataframes of br in the order of the dates (chunks of a store)
+    :param budget: budget of the line item
+    :param day_start: starting date
+    :param day_end: ending date
+    :param settings: settings of the pacing instances (coef, purchase_threshold, objective_ratio)
+    :return: Dataframe to see performances
+    """
+    return simulate(data, budget, day_start, day_end, **settings)[1]
@@ -0,0 +1,155 @@
+from array import array
+from bisect import bisect_left
+import threading
+import time
+
+# Upper bounds of the buckets of the latency histograms in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+# Route of the requests that matched no route
+UNMATCHED = 'unmatched'
+
+
+# Escape a label value of the text format
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Latency histograms of the routes of the API
+class RequestMetrics(object):
+    """ Histogram of the latency of each route. Each thread counts in its own arrays, created at its first request:
+    a request only increments two cells, without lock, and the exposition sums the arrays of the threads.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Class constructor
+
+        :param buckets: upper bounds of the buckets in seconds
+        """
+        self.buckets = list(buckets)
+        self.routes = {UNMATCHED: 0}
+        # Cells of a route: one count per bucket (and +Inf), then the sum of the latencies
+        self.width = len(self.buckets) + 1
+        self.shards = {}
+
+    def register(self, uri_templates):
+        """ Give a row to each route, before the first request
+
+        :param uri_templates: uri templates of the routes
+        """
+        for uri_template in uri_templates:
+            self.routes.setdefault(uri_template, len(self.routes))
+
+    def shard(self):
+        """ Return the counts and the sums of the current thread
+        """
+        ident = threading.get_ident()
+        try:
+            return self.shards[ident]
+        except KeyError:
+            shard = self.shards[ident] = (array('Q', bytes(8 * len(self.routes) * self.width)),
+                                          array('d', bytes(8 * len(self.routes))))
+            return shard
+
+    def observe(self, uri_template, seconds):
+        """ Count a request
+
+        :param uri_template: uri template of the route (None if no route matched)
+        :param seconds: latency of the request
+        """
+        route = self.routes.get(uri_template, 0)
+        counts, sums = self.shard()
+        counts[route * self.width + bisect_left(self.buckets, seconds)] += 1
+        sums[route] += seconds
+
+    def process_request(self, req, resp):
+        req.context.start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = getattr(req.context, 'start', None)
+        if start is not None:
+            self.observe(req.uri_template, time.perf_counter() - start)
+
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
+    def render(self):
+        """ Histograms in the Prometheus text format
+
+        :return: list of lines
+        """
+        counts = array('Q', bytes(8 * len(self.routes) * self.width))
+        sums = [0.] * len(self.routes)
+        for shard_counts, shard_sums in list(self.shards.values()):
+            for i, count in enumerate(shard_counts):
+                counts[i] += count
+            for i, seconds in enumerate(shard_sums):
+                sums[i] += seconds
+        lines = ["# HELP pacing_request_duration_seconds Latency of the requests per route",
+                 "# TYPE pacing_request_duration_seconds histogram"]
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for route, row in self.routes.items():
+            name = f'route="{label(route)}"'
+            cumulative = 0
+            for bound, count in zip(bounds, counts[row * self.width:(row + 1) * self.width]):
+                cumulative += count
+                lines.append(f'pacing_request_duration_seconds_bucket{{{name},le="{bound}"}} {cumulative}')
+            lines.append(f'pacing_request_duration_seconds_sum{{{name}}} {sums[row]!r}')
+            lines.append(f'pacing_request_duration_seconds_count{{{name}}} {cumulative}')
+        return lines
+
+
+# Counters and gauges of the line items
+def pacing_metrics(bdd):
+    """ Counters of the line items and gauges of their time zones, read from the published snapshots without
+    taking the locks of the line items
+
+    :param bdd: DataBase
+    :return: list of lines in the Prometheus text format
+    """
+    counters = {
+        'pacing_bid_requests_total': ("Bid requests received by the pacing", []),
+        'pacing_buys_total': ("Bid requests bought", []),
+        'pacing_notifications_total': ("Notifications received", []),
+        'pacing_expired_total': ("Bought bid requests without notification after the timeout", [])
+    }
+    gauges = {
+        'pacing_budget_spent': ("Budget spent per time zone", []),
+        'pacing_budget_engaged': ("Budget engaged in bid requests waiting for their notification", []),
+        'pacing_budget_remaining': ("Remaining budget per time zone", []),
+        'pacing_prop_purchase': ("Proportion of bought bid requests per time zone", [])
+    }
+    for liid, pacing in list(bdd.instances.items()):
+        name = f'liid="{label(liid)}"'
+        total_budget, tz_status, nb_engaged, nb_expired, _, _ = pacing.snapshot
+        counters['pacing_bid_requests_total'][1].append(f'{{{name}}} {pacing.nb_br}')
+        counters['pacing_buys_total'][1].append(f'{{{name}}} {pacing.nb_buy}')
+        counters['pacing_notifications_total'][1].append(f'{{{name},status="win"}} {pacing.nb_win}')
+        counters['pacing_notifications_total'][1].append(f'{{{name},status="lose"}} {pacing.nb_lose}')
+        counters['pacing_expired_total'][1].append(f'{{{name}}} {nb_expired}')
+        for tz, (spent, engaged, remaining, _, prop) in tz_status.items():
+            labels = f'{{{name},tz="{label(tz)}"}}'
+            gauges['pacing_budget_spent'][1].append(f'{labels} {spent!r}')
+            gauges['pacing_budget_engaged'][1].append(f'{labels} {engaged!r}')
+            gauges['pacing_budget_remaining'][1].append(f'{labels} {remaining!r}')
+            gauges['pacing_prop_purchase'][1].append(f'{labels} {prop!r}')
+    lines = []
+    for kind, families in (('counter', counters), ('gauge', gauges)):
+        for metric, (description, samples) in families.items():
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.extend(metric + sample for sample in samples)
+    return lines
+
+
+# Controller of the metrics
+class MetricsEndpoint(object):
+    def __init__(self, bdd, request_metrics):
+        self.bdd = bdd
+        self.request_metrics = request_metrics
+
+    def on_get(self, req, resp):
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.text = '\n'.join(self.request_metrics.render() + pacing_metrics(self.bdd)) + '\n'
@@ -1,9 +1,11 @@
-from datetime import datetime
 from datetime import timedelta
-import pandas as pd
+import threading
+import numpy as np
 import pytz
-import itertools
-from statsmodels.formula.api import ols
+from traffic_model import UNIFORM_PROPORTIONS, UNIFORM_HOURS, TrafficProfile, TrafficProfiles
+from sliding_window import SlidingWindow
+from engaged_index import EngagedIndex
+from tz_cache import TimezoneCache, round_timestamp
 
 
 # Temporal pacing class
@@ -11,17 +13,31 @@ class Pacing:
     """ The temporal pacing algorithm class
     """
 
-    def __init__(self, total_budget, start_date, end_date, timezone):
+    # A line item has one instance per time zone: no __dict__ per instance
+    __slots__ = ('tz', 'tz_cache', 'start_date', 'end_date', 'total_days', 'coef', 'purchase_threshold',
+                 'objective_ratio', 'profile', 'remaining_days', 'budget_objective',
+                 'budget_engaged', 'budget_spent_total', 'budget_remaining', 'current_hour', 'budget_remaining_hourly',
+                 'budget_daily', 'surplus_hour', 'last_bs', 'acceleration', 'speed', 'prop_table',
+                 'hour_proportions', 'day', 'nb_br', 'nb_buy', 'prop_purchase', 'spent_per_sec', 'spent_hour',
+                 'new_objective', 'trigger_count', 'block_increase', 'first_br', 'first_day', 'ts_first_br', 'weekday',
+                 'remaining_hours', 'budget_hour', 'target', 'bs')
+
+    def __init__(self, total_budget, start_date, end_date, timezone, tz_cache=None, profile=None, coef=1,
+                 purchase_threshold=0.7, objective_ratio=0.85):
         """Class constructor"""
 
         # Fixed attributes
         self.tz = pytz.timezone(timezone)
+        self.tz_cache = tz_cache if tz_cache is not None else TimezoneCache(timezone, start_date, end_date)
         self.start_date = self.tz.localize(start_date)
         self.end_date = self.tz.localize(end_date + timedelta(days=1))
         self.total_days = (self.end_date - self.start_date).days
-        # data for the linear regression
-        self.buffer = list()
-        self.buffer_data = pd.DataFrame()
+        # Settings of the budget per second and of the check of the proportion of bought br
+        self.coef = coef
+        self.purchase_threshold = purchase_threshold
+        self.objective_ratio = objective_ratio
+        # Traffic of the time zone for the linear regression, possibly shared with other line items
+        self.profile = profile if profile is not None else TrafficProfile()
         # Initialise variables
         self.remaining_days = (self.end_date - self.start_date).days
         self.budget_objective = total_budget
@@ -33,19 +49,18 @@ class Pacing:
         self.budget_remaining_hourly = 0
         self.budget_daily = self.budget_remaining / self.remaining_days
         self.surplus_hour = 0
-        self.bs_history = [0]
-        self.ongoing_br = {}
-        self.acceleration = [{'ts': self.start_date,
-                              'A': 0}]
-        self.speed = [{'ts': self.start_date,
-                       'S': 0}]
-        self.size_acceleration = 1
-        self.sum_acceleration = 0
-        self.size_speed = 1
-        self.sum_speed = 0
-        self.prop_table, self.unif, self.without_weekday = self.meta_prop(self.buffer_data)
+        # Budget per second of the previous bid request of the day
+        self.last_bs = 0
+        # Moving windows of 30 minutes
+        self.acceleration = SlidingWindow(duration=1800)
+        self.acceleration.reset(self.tz_cache.start_ts)
+        self.speed = SlidingWindow(duration=1800)
+        self.speed.reset(self.tz_cache.start_ts)
         # Setup variables to begin pacing
-        self.day = self.start_date.day
+        self.day = self.start_date.toordinal()
+        self.prop_table = self.profile.proportions(self.day)
+        self.weekday = (self.day + 6) % 7
+        self.hour_proportions = self.day_proportions()
         self.nb_br = 0
         self.nb_buy = 0
         self.prop_purchase = 0
@@ -59,125 +74,48 @@ class Pacing:
         self.first_br = True
         self.first_day = True
 
-    # Functions for the linear regression
-    @staticmethod
-    def gen_prop_lr(br_object):
-        """Linear regression with hours and weekdays
-
-        :param br_object: historical data about bid requests to perform linear regression
-        :return: Dataframe
-        """
-        aggr = br_object.imps.groupby([br_object.index.date, br_object.index.weekday, br_object.index.hour]).sum()
-        aggr.index.names = ['date', 'weekday', 'hour']
-        # Here we keep the date column but note that it is irrelevant.
-        aggr = aggr.reset_index()
-        model = ols('imps ~ C(weekday) + C(hour)', data=aggr).fit()
-        weekday_list = range(7)
-        weekday_list = list(itertools.chain.from_iterable(itertools.repeat(x, 24) for x in weekday_list))
-        hour_list = list()
-        for i in range(7):
-            for z in range(24):
-                hour_list.append(z)
-        df_fitting = pd.DataFrame({'weekday': weekday_list, 'hour': hour_list})
-        prediction = model.predict(df_fitting)
-        df_fitting['fitted'] = prediction
-        pattern = df_fitting.pivot_table('fitted', index=df_fitting.hour, columns=df_fitting.weekday)
-        line, col = pattern.shape
-        for i in range(col):
-            pattern.iloc[:, i] = pattern.iloc[:, i] * 100 / pattern.iloc[:, i].sum()
-        return pattern
-
-    @staticmethod
-    def gen_prop_lr_hour(br_object):
-        """Linear regression with only hours
-
-        :param br_object: historical data about bid requests to perform linear regression
-        :return: Dataframe
+    # Proportion of impressions per hour of the current day
+    def day_proportions(self):
+        """ Return the column of the weekday as a tuple of floats, read once per hour by change_hour
         """
-        aggr = br_object.imps.groupby([br_object.index.date, br_object.index.hour]).sum().reset_index()
-        aggr.columns = ['date', 'hour', 'imps']
-        model = ols('imps ~ C(hour)', data=aggr).fit()
-        hour_list = list()
-        for z in range(24):
-            hour_list.append(z)
-        df_fitting = pd.DataFrame({'hour': hour_list})
-        prediction = model.predict(df_fitting)
-        df_fitting['fitted'] = prediction
-        df_fitting.index = df_fitting.hour
-        del df_fitting['hour']
-        df_fitting.iloc[:, 0] = df_fitting.iloc[:, 0] * 100 / df_fitting.iloc[:, 0].sum()
-        return df_fitting
-
-    def meta_prop(self, data):
-        """ Give the proportion of impressions per hour. The output type depends on the input.
-
-        :param data: a dataframe with a datetime as index
-        :return: an  integer, a Serie or a Dataframe
-        """
-        if data.empty or set(data.index.hour.unique()) != set(range(24)):
-            unif = True
-            without_weekday = True
-            prop = 1 / 24
-        else:
-            if set(data.index.weekday.unique()) != set(range(7)):
-                unif = False
-                without_weekday = True
-                prop = self.gen_prop_lr_hour(data)
-            else:
-                unif = False
-                without_weekday = False
-                prop = self.gen_prop_lr(data)
-        return prop, unif, without_weekday
+        if self.prop_table is UNIFORM_PROPORTIONS:
+            return UNIFORM_HOURS
+        return tuple(self.prop_table[:, self.weekday].tolist())
 
     # Function to reset variables when we start a new day
-    def day_reset(self, ts):
+    def day_reset(self, ts, day):
         """ Reset variables when there is a new day
 
         :param ts: timestamp
+        :param day: ordinal of the local day
         """
-        day = ts.day
-        month = ts.month
-        year = ts.year
-        self.remaining_days = (self.end_date - ts).days + 1  # +1 because we have to take the end of the day
-        if not self.buffer:
-            self.buffer_data = pd.DataFrame.from_records(self.buffer)
-        else:
+        # +1 because we have to take the end of the day
+        self.remaining_days = int((self.tz_cache.end_ts - ts) // 86400) + 1
+        if self.nb_br > 0:
             self.first_day = False
-            self.buffer_data = pd.DataFrame.from_records(self.buffer, index='Date')
         # Reinitialise some variables
         self.current_hour = -1
         self.budget_remaining_hourly = 0
         self.budget_daily = self.budget_remaining / self.remaining_days
         self.surplus_hour = 0
-        self.bs_history = [0]
-        self.acceleration = [{'ts': self.tz.localize(datetime(year, month, day, 0, 0, 0)),
-                              'A': 0}]
-        self.speed = [{'ts': self.tz.localize(datetime(year, month, day, 0, 0, 0)),
-                       'S': 0}]
-        self.size_acceleration = 1
-        self.sum_acceleration = 0
-        self.size_speed = 1
-        self.sum_speed = 0
-        self.prop_table, self.unif, self.without_weekday = self.meta_prop(self.buffer_data)
+        self.last_bs = 0
+        ts_day = self.tz_cache.midnight(day)
+        self.acceleration.reset(ts_day)
+        self.speed.reset(ts_day)
+        # The profile is fitted once per day for all the line items that share it
+        self.prop_table = self.profile.proportions(day)
+        self.weekday = (day + 6) % 7
+        self.hour_proportions = self.day_proportions()
 
     # Function when we change hour
-    def change_hour(self, weekday):
+    def change_hour(self):
         """ Reset budget for the following hour
-
-        :param weekday: week day integer
         """
         self.current_hour += 1
         self.remaining_hours = 24 - self.current_hour
         # Evolutive target
         self.surplus_hour += self.budget_remaining_hourly / self.remaining_hours
-        if self.unif:
-            self.budget_hour = (self.prop_table * self.budget_daily) + self.surplus_hour
-        elif self.without_weekday and not self.unif:
-            self.budget_hour = (self.prop_table.iloc[
-                                    self.current_hour, 0] / 100) * self.budget_daily + self.surplus_hour
-        else:
-            self.budget_hour = (self.prop_table.iloc[
-                                    self.current_hour, weekday] / 100) * self.budget_daily + self.surplus_hour
+        self.budget_hour = self.hour_proportions[self.current_hour] * self.budget_daily + self.surplus_hour
         self.target = self.budget_hour / 3600
         self.spent_hour = 0
         self.budget_remaining_hourly = self.budget_hour - self.spent_hour
@@ -186,13 +124,10 @@ class Pacing:
     def gen_mean_speed(self):
         """ Return the moving average of variation of the budget per second over 30 minutes
         """
-        created_time = self.speed[-1]['ts'] - timedelta(minutes=30)
-        while self.speed[0]['ts'] < created_time:
-            self.size_speed -= 1
-            self.sum_speed += self.speed[0]['S']
-            del self.speed[0]
+        self.speed.evict()
+        # The average is computed, as it always has been, with the sum of the values that left the window
         try:
-            average = self.sum_speed / self.size_speed
+            average = self.speed.expired_total / len(self.speed)
         except ZeroDivisionError:
             average = 0
         return average
@@ -201,25 +136,24 @@ class Pacing:
     def gen_mean_acceleration(self):
         """ Return the moving average of the speed of variation of the budget per second over 30 minutes
         """
-        created_time = self.acceleration[-1]['ts'] - timedelta(minutes=30)
-        while self.acceleration[0]['ts'] < created_time:
-            self.size_acceleration -= 1
-            self.sum_acceleration += self.acceleration[0]['A']
-            del self.acceleration[0]
+        self.acceleration.evict()
         try:
-            average = self.sum_acceleration / self.size_acceleration
+            average = self.acceleration.expired_total / len(self.acceleration)
         except ZeroDivisionError:
             average = 0
         return average
 
-    # Build the dataframe for the linear regression
-    def build_data_prop(self, ts, imps):
-        """ Build Dataframe for the proportion per hour linear regression
+    # Build the data for the linear regression
+    def build_data_prop(self, ts, day, hour, imps, br_id):
+        """ Add the bid request to the traffic profile used by the proportion per hour linear regression
 
-        :param ts: current timestamp
+        :param ts: timestamp of the bid request
+        :param day: ordinal of the local day
+        :param hour: local hour
         :param imps: number of impressions
+        :param br_id: id of the bid request
         """
-        self.buffer.append({'Date': ts, 'imps': imps})
+        self.profile.add(ts, day, hour, imps, br_id)
 
     def bs_calculation(self, average_acceleration, average_speed, remaining_time, coef=1):
         """ Calculate the available budget per second
@@ -242,7 +176,7 @@ class Pacing:
     def buying_decision(self, ts, price, imps, br_id):
         """From a BR, decide whether to buy or not
 
-        :param ts: timestamp of the BR
+        :param ts: timestamp of the BR in seconds
         :param price: price of the BR
         :param imps: number of impressions
         :param br_id: id of bid request
@@ -260,52 +194,44 @@ class Pacing:
         if imps < 0:
             return False
 
+        ts = round_timestamp(ts)
         if self.first_br:
             self.first_br = False
-            self.ts_first_br = datetime.timestamp(ts)
+            self.ts_first_br = ts
 
             # Enough time to check proportion
-        if datetime.timestamp(ts) - self.ts_first_br >= 3600:
+        if ts - self.ts_first_br >= 3600:
             self.trigger_count = True
 
         # TS de la BR
-        self.weekday = ts.weekday()
-        day = ts.day
-        month = ts.month
-        year = ts.year
-        hour = ts.hour
+        day, self.weekday, hour, end_hour = self.tz_cache.local(ts)
 
         # If we begin a new day, we reset variables
         if self.day != day:
-            self.day_reset(ts)
+            self.day_reset(ts, day)
         self.day = day
 
         # Changement of hour
         while hour != self.current_hour:
-            self.change_hour(self.weekday)
+            self.change_hour()
 
         # Build data for proportion lr
-        self.build_data_prop(ts, imps)
+        self.build_data_prop(ts, day, hour, imps, br_id)
 
         # Remaining time before the end of the hour
-        end_hour = self.tz.localize(datetime(year, month, day, hour, 59, 59, 999999))
-        remaining_time = datetime.timestamp(end_hour) - datetime.timestamp(ts)
+        remaining_time = end_hour - ts
 
         # Calculation of the budget per second (bs)
         average_acceleration = self.gen_mean_acceleration()
         average_speed = self.gen_mean_speed()
-        self.bs = self.bs_calculation(average_acceleration, average_speed, remaining_time)
+        self.bs = self.bs_calculation(average_acceleration, average_speed, remaining_time, self.coef)
 
         # Calculation of vt and at
-        self.bs_history.append(self.bs)
-        vt = self.bs_history[-1] - self.bs_history[-2]
-        self.speed.append({'ts': ts,
-                           'S': vt})
-        self.size_speed += 1  # We calculate the size without using len() for micro optimisation
-        at = self.speed[-1]['S'] - self.speed[-2]['S']
-        self.acceleration.append({'ts': ts,
-                                  'A': at})
-        self.size_acceleration += 1  # We calculate the size without using len() for micro optimisation
+        vt = self.bs - self.last_bs
+        self.last_bs = self.bs
+        at = vt - self.speed.last
+        self.speed.push(ts, vt)
+        self.acceleration.push(ts, at)
 
         # Buying decision
         if (self.bs >= self.target) and (self.budget_remaining_hourly - price) >= 0:
@@ -313,7 +239,6 @@ class Pacing:
             self.budget_engaged += price
             self.spent_hour += price
             self.nb_buy += 1
-            self.ongoing_br[br_id] = price
         else:
             buying = False
         self.budget_remaining_hourly = self.budget_hour - self.spent_hour
@@ -332,19 +257,19 @@ class Pacing:
     def check_proportion(self, ts):
         """ Check if the algorithm needs to buy a high volume of bid requests to reach the objective
 
-        :param ts: current timestamp
+        :param ts: current timestamp in seconds
         :return: New objective if we have to lower the budget or none if it is already ok
         """
         self.prop_purchase = self.nb_buy / self.nb_br
-        if not self.first_day and self.trigger_count and self.prop_purchase >= 0.7:
-            elapsed_time = datetime.timestamp(ts) - datetime.timestamp(self.start_date)
+        if not self.first_day and self.trigger_count and self.prop_purchase >= self.purchase_threshold:
+            elapsed_time = ts - self.tz_cache.start_ts
             spent_per_sec = self.budget_spent_total / elapsed_time
-            remaining_time = datetime.timestamp(self.end_date) - datetime.timestamp(ts)
-            new_objective = (spent_per_sec * remaining_time) * 0.85
+            remaining_time = self.tz_cache.end_ts - ts
+            new_objective = (spent_per_sec * remaining_time) * self.objective_ratio
             if (self.budget_spent_total + self.budget_engaged) < new_objective < self.budget_objective:
                 self.block_increase = True
                 self.trigger_count = False
-                self.ts_first_br = datetime.timestamp(ts)
+                self.ts_first_br = ts
                 return new_objective
 
     # Function to reset the spend objective
@@ -359,26 +284,18 @@ class Pacing:
         if self.budget_remaining < 0:
             self.budget_remaining = 0
         self.budget_daily = self.budget_remaining / self.remaining_days
-        if self.unif:
-            self.budget_hour = (self.prop_table * self.budget_daily) + self.surplus_hour
-        elif self.without_weekday and not self.unif:
-            self.budget_hour = (self.prop_table.iloc[
-                                    self.current_hour, 0] / 100) * self.budget_daily + self.surplus_hour
-        else:
-            self.budget_hour = (self.prop_table.iloc[
-                                    self.current_hour, self.weekday] / 100) * self.budget_daily + self.surplus_hour
+        self.budget_hour = self.hour_proportions[self.current_hour] * self.budget_daily + self.surplus_hour
         self.target = self.budget_hour / 3600
         self.spent_hour = 0
         self.budget_remaining_hourly = self.budget_hour - self.spent_hour
 
     # Function to handle the reception of a notification
-    def receive_notification(self, status, br_id):
+    def receive_notification(self, status, br_price):
         """ From a notification, take into account the status (win/lose)
 
         :param status: 'win' or 'lose'
-        :param br_id: id of the bid request
+        :param br_price: price of the bid request
         """
-        br_price = self.ongoing_br[br_id]
         if status == 'win':
             self.budget_engaged -= br_price
             self.budget_spent_total += br_price
@@ -387,26 +304,102 @@ class Pacing:
             self.spent_hour -= br_price
         self.budget_remaining = self.budget_objective - (
                 self.budget_engaged + self.budget_spent_total)
-        del self.ongoing_br[br_id]
 
 
 # Class to create handle  different time zones. It allows a dynamic budget reallocation between instances
 class GlobalPacing(object):
-    def __init__(self, total_budget, start_date, end_date):
+    __slots__ = ('total_budget', 'start_date', 'end_date', 'tz_list', 'tz_objective', 'tz_codes', 'instances',
+                 'tz_caches', 'traffic_profiles', 'engaged', 'expired_status', 'settings', 'nb_br', 'nb_buy', 'nb_win',
+                 'nb_lose', 'spent_total', 'engaged_total', 'campaign', 'lock', 'snapshot')
+
+    def __init__(self, total_budget, start_date, end_date, notification_timeout=None, expired_status='lose', coef=1,
+                 purchase_threshold=0.7, objective_ratio=0.85, traffic_profiles=None):
 
         # Raise errors in parameters
         if total_budget < 0:
             raise ValueError("Budget cannot be negative!")
         if start_date > end_date:
             raise ValueError("Start date cannot be later than end date!")
+        if expired_status not in ('win', 'lose'):
+            raise ValueError("Expired status should be win or lose!")
 
         self.total_budget = total_budget
         self.start_date = start_date
         self.end_date = end_date
         self.tz_list = []
-        self.tz_objective = []
-        self.timezones = {}
+        # Time zones whose objective can still increase, in order of arrival (dictionary used as an ordered set)
+        self.tz_objective = {}
+        # Index of each time zone in tz_list
+        self.tz_codes = {}
         self.instances = {}
+        self.tz_caches = {}
+        # Traffic of the time zones, shared with the other line items of the registry (default is its own registry)
+        self.traffic_profiles = traffic_profiles if traffic_profiles is not None else TrafficProfiles()
+        # Bought bid requests waiting for their notification, owned by the index of their time zone in tz_list.
+        # Without notification after the timeout, the bid request is taken as expired_status.
+        self.engaged = EngagedIndex(notification_timeout)
+        self.expired_status = expired_status
+        # Settings of the pacing instances
+        self.settings = {'coef': coef, 'purchase_threshold': purchase_threshold, 'objective_ratio': objective_ratio}
+        # Counters of the bid requests and of the notifications
+        self.nb_br = 0
+        self.nb_buy = 0
+        self.nb_win = 0
+        self.nb_lose = 0
+        # Budget spent and engaged by all the time zones, updated with each purchase and notification
+        self.spent_total = 0
+        self.engaged_total = 0
+        # Campaign whose totals follow those of the line item (set by Campaign.add)
+        self.campaign = None
+        # Decisions and notifications of the line item are serialized, status reads use the last snapshot
+        self.lock = threading.RLock()
+        self.snapshot = (self.total_budget, {}, 0, 0, 0, 0)
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != 'lock'}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.lock = threading.RLock()
+
+    # Publish the budgets of the time zones
+    def publish(self, changed=None):
+        """ Replace the snapshot read by the status requests. Must be called with the lock held.
+        The totals of a snapshot are an immutable tuple published by each decision and notification. The status of
+        each time zone is an immutable tuple too, replaced in the dictionary of the time zones: the dictionary is only
+        rebuilt when a time zone is added, so a reader iterating over it never sees its size change.
+
+        :param changed: time zones that changed (default is all time zones)
+        """
+        tz_status = self.snapshot[1]
+        if changed is None:
+            changed = self.tz_list
+            if len(tz_status) != len(self.tz_list):
+                tz_status = {}
+        for key in changed:
+            instance = self.instances[key]
+            tz_status[key] = (instance.budget_spent_total, instance.budget_engaged, instance.budget_remaining,
+                              instance.budget_objective, instance.prop_purchase)
+        previous = self.snapshot
+        self.snapshot = snapshot = (self.total_budget, tz_status, len(self.engaged), self.engaged.nb_expired,
+                                    self.spent_total, self.engaged_total)
+        # The campaign only receives the changes of the totals
+        if self.campaign is not None and (snapshot[0] != previous[0] or snapshot[2:] != previous[2:]):
+            self.campaign.update(snapshot[0] - previous[0], snapshot[4] - previous[4], snapshot[5] - previous[5],
+                                 snapshot[2] - previous[2], snapshot[3] - previous[3])
+
+    # Local calendar of a time zone over the campaign
+    def timezone_cache(self, tz):
+        """ Return the cache of offset transitions and campaign bounds of a time zone (created at first use)
+
+        :param tz: name of the time zone
+        """
+        try:
+            return self.tz_caches[tz]
+        except KeyError:
+            tz_cache = self.tz_caches[tz] = TimezoneCache(tz, self.start_date, self.end_date)
+            return tz_cache
 
     # If we need to change the setup
     def update_budget(self, new_budget):
@@ -415,10 +408,14 @@ class GlobalPacing(object):
         :param new_budget: new budget to be spent
         :return:
         """
-        self.total_budget = new_budget
-        budget_tz = self.total_budget / len(self.tz_list)
-        for key in self.tz_list:
-            self.instances[key].reallocate_budget(budget_tz)
+        with self.lock:
+            self.total_budget = new_budget
+            # Without time zone yet, the first one receives the new budget when it is created
+            if self.tz_list:
+                budget_tz = self.total_budget / len(self.tz_list)
+                for key in self.tz_list:
+                    self.instances[key].reallocate_budget(budget_tz)
+            self.publish()
 
     # When we receive a bid request from a timezone that we have never met
     def new_instance(self, new_tz):
@@ -426,21 +423,26 @@ class GlobalPacing(object):
 
         :param new_tz: name of the new timezone
         """
+        self.tz_codes[new_tz] = len(self.tz_list)
         if len(self.instances) == 0:
             self.tz_list.append(new_tz)
-            self.tz_objective.append(new_tz)
+            self.tz_objective[new_tz] = None
             self.instances[new_tz] = Pacing(total_budget=self.total_budget,
                                             start_date=self.start_date,
-                                            end_date=self.end_date, timezone=new_tz)
+                                            end_date=self.end_date, timezone=new_tz,
+                                            tz_cache=self.timezone_cache(new_tz),
+                                            profile=self.traffic_profiles.get(new_tz), **self.settings)
         else:
             budget_tz = self.total_budget / (len(self.tz_list) + 1)
             self.instances[new_tz] = Pacing(total_budget=budget_tz,
                                             start_date=self.start_date,
-                                            end_date=self.end_date, timezone=new_tz)
+                                            end_date=self.end_date, timezone=new_tz,
+                                            tz_cache=self.timezone_cache(new_tz),
+                                            profile=self.traffic_profiles.get(new_tz), **self.settings)
             for key in self.tz_list:
                 self.instances[key].reallocate_budget(budget_tz)
             self.tz_list.append(new_tz)
-            self.tz_objective.append(new_tz)
+            self.tz_objective[new_tz] = None
 
     # Main function to select the good pacing instance and make the buying decision
     def choose_pacing(self, ts, tz, cpm, imps, br_id):
@@ -454,27 +456,106 @@ class GlobalPacing(object):
         :return: buying decision with some statistics
         """
         price = (imps * cpm) / 1000
-        local_date = datetime.fromtimestamp(ts, tz=pytz.timezone(tz))
+        tz_cache = self.timezone_cache(tz)
+        ts = round_timestamp(ts)
         # Before the campaign?
-        if local_date < pytz.timezone(tz).localize(self.start_date):
+        if ts < tz_cache.start_ts:
             raise ValueError("BR before campaign start date")
         # End of the campaign?
-        if local_date > pytz.timezone(tz).localize(self.end_date + timedelta(days=1)):
+        if ts > tz_cache.end_ts:
             raise ValueError("BR after campaign end date")
+        return self.pacing_decision(ts, tz, price, imps, br_id)
+
+    # Buying decision of a bid request already checked against the campaign bounds
+    def pacing_decision(self, ts, tz, price, imps, br_id):
+        """ Select the good pacing instance and return the buying decision. The bid request must be in the campaign.
+
+        :param ts: timestamp of the br
+        :param tz: time zone of the br
+        :param price: price of the br
+        :param imps: number of impressions
+        :param br_id: id of the br
+        :return: buying decision with some statistics
+        """
+        with self.lock:
+            result, changed = self._decide(ts, tz, price, imps, br_id)
+            self.publish(changed)
+        return result
+
+    # Buying decisions for a batch of bid requests
+    def choose_pacing_batch(self, ts, tz_codes, cpm, imps, br_ids, tz_names):
+        """ Make the buying decisions of a batch of bid requests. The results are the same as calling choose_pacing
+        on each bid request in order, but the time zone caches are looked up once per time zone.
+        Bid requests outside the campaign are not bought and their statistics are NaN.
+
+        :param ts: array of timestamps of the br
+        :param tz_codes: array of integer codes of the time zones
+        :param cpm: array of cost per mile
+        :param imps: array of number of impressions
+        :param br_ids: array of ids of the br
+        :param tz_names: sequence giving the name of the time zone of each code
+        :return: array of buying decisions with arrays of statistics (same order as choose_pacing)
+        """
+        size = len(ts)
+        prices = (np.asarray(imps, dtype=float) * np.asarray(cpm, dtype=float)) / 1000
+        buying = np.zeros(size, dtype=bool)
+        stats = np.full((5, size), np.nan)
+        remaining, spent, engaged, objective, prop = stats
+        # Work done once per time zone of the batch
+        codes, groups = np.unique(np.asarray(tz_codes), return_inverse=True)
+        names = [tz_names[code] for code in codes.tolist()]
+        tz_caches = [self.timezone_cache(tz) for tz in names]
+        starts = [tz_cache.start_ts for tz_cache in tz_caches]
+        ends = [tz_cache.end_ts for tz_cache in tz_caches]
+        # Pacing instances must see the bid requests in order because they share the budget
+        rows = zip(groups.tolist(), np.asarray(ts, dtype=float).tolist(), prices.tolist(),
+                   np.asarray(imps).tolist(), np.asarray(br_ids).tolist())
+        with self.lock:
+            for i, (group, ts_br, price, imps_br, br_id) in enumerate(rows):
+                ts_br = round_timestamp(ts_br)
+                if ts_br < starts[group] or ts_br > ends[group]:
+                    continue
+                (buying[i], remaining[i], spent[i], engaged[i], objective[i], prop[i]), _ = \
+                    self._decide(ts_br, names[group], price, imps_br, br_id)
+            self.publish()
+        return buying, remaining, spent, engaged, objective, prop
+
+    # Buying decision shared by pacing_decision and choose_pacing_batch
+    def _decide(self, ts, tz, price, imps, br_id):
+        """ Expire the late notifications, make the buying decision of the bid request and reallocate the budget if
+        the objective of its time zone changed. Must be called with the lock held.
+
+        :param ts: timestamp of the br
+        :param tz: time zone of the br
+        :param price: price of the br
+        :param imps: number of impressions
+        :param br_id: id of the br
+        :return: buying decision with some statistics, and the time zones that changed (None if the budget was
+        reallocated)
+        """
+        # Only the time zone of the bid request and those of the expired bid requests change, unless the budget is
+        # reallocated
+        changed = self.expire(ts)
+        changed.add(tz)
         if tz not in self.instances.keys():
             self.new_instance(tz)
-        buying = self.instances[tz].buying_decision(local_date, price, imps, br_id)
+            changed = None
+        instance = self.instances[tz]
+        buying = instance.buying_decision(ts, price, imps, br_id)
+        self.nb_br += 1
         if buying:
-            self.timezones[br_id] = tz
-        budget_remaining = self.instances[tz].budget_remaining
-        spent_budget = self.instances[tz].budget_spent_total
-        budget_engaged = self.instances[tz].budget_engaged
-        prop = self.instances[tz].prop_purchase
-        if self.instances[tz].new_objective is not None:
-            self.set_new_objectives(self.instances[tz].budget_objective,
-                                    self.instances[tz].new_objective, tz)
-        objective = self.instances[tz].budget_objective
-        return buying, budget_remaining, spent_budget, budget_engaged, objective, prop
+            replaced = self.engage(br_id, tz, price, ts)
+            if replaced is not None and changed is not None:
+                changed.add(replaced)
+        budget_remaining = instance.budget_remaining
+        spent_budget = instance.budget_spent_total
+        budget_engaged = instance.budget_engaged
+        prop = instance.prop_purchase
+        if instance.new_objective is not None:
+            self.set_new_objectives(instance.budget_objective, instance.new_objective, tz)
+            changed = None
+        objective = instance.budget_objective
+        return (buying, budget_remaining, spent_budget, budget_engaged, objective, prop), changed
 
     # Function called when we have to set new objectives of spend
     def set_new_objectives(self, old_budget, new_budget, tz):
@@ -484,13 +565,9 @@ class GlobalPacing(object):
         :param new_budget: new budget objective
         :param tz: timezone related to the changement
         """
-        for key in self.tz_list:
-            # We delete the tz from the list to block the increase
-            if self.instances[key].block_increase:
-                try:
-                    self.tz_objective.remove(key)
-                except ValueError:
-                    pass
+        # We delete the tz from the list to block the increase: only check_proportion blocks a time zone, just before
+        # this call
+        self.tz_objective.pop(tz, None)
         # We check if there is at least one timezone to dispatch the surplus budget
         if len(self.tz_objective) > 0:
             surplus_budget = (old_budget - new_budget) / len(self.tz_objective)
@@ -506,9 +583,62 @@ class GlobalPacing(object):
         :param br_id: id of the br
         :param status: 'win' or 'lose'
         """
-        tz = self.timezones[br_id]
-        del self.timezones[br_id]
-        self.instances[tz].receive_notification(status, br_id)
+        with self.lock:
+            owner, price = self.engaged.pop(br_id)
+            tz = self.receive(owner, status, price)
+            if status == 'win':
+                self.nb_win += 1
+            elif status == 'lose':
+                self.nb_lose += 1
+            self.publish((tz,))
+
+    # Engage the budget of a bought bid request
+    def engage(self, br_id, tz, price, ts):
+        """ Record a purchase until its notification comes. A bid request bought again before its notification
+        replaces the previous purchase, whose budget is released as expired_status. Must be called with the lock held.
+
+        :param br_id: id of the br
+        :param tz: time zone of the br
+        :param price: price of the br
+        :param ts: timestamp of the purchase
+        :return: time zone of the replaced purchase (None if there is none)
+        """
+        self.nb_buy += 1
+        self.engaged_total += price
+        replaced = self.engaged.add(br_id, self.tz_codes[tz], price, ts)
+        if replaced is not None:
+            owner, replaced_price = replaced
+            return self.receive(owner, self.expired_status, replaced_price)
+        return None
+
+    # Release the budget engaged in a bid request
+    def receive(self, owner, status, price):
+        """ Send the notification of a bid request to its pacing instance and update the totals of the line item.
+        Must be called with the lock held.
+
+        :param owner: index of the time zone of the bid request in tz_list
+        :param status: 'win' or 'lose'
+        :param price: engaged price
+        :return: time zone of the bid request
+        """
+        tz = self.tz_list[owner]
+        self.instances[tz].receive_notification(status, price)
+        if status == 'win':
+            self.engaged_total -= price
+            self.spent_total += price
+        elif status == 'lose':
+            self.engaged_total -= price
+        return tz
+
+    # Release the budget of the bid requests without notification
+    def expire(self, ts):
+        """ Take the bid requests whose notification did not come before the timeout as expired_status.
+        Must be called with the lock held.
+
+        :param ts: current timestamp in seconds
+        :return: set of the time zones of the expired bid requests
+        """
+        return {self.receive(owner, self.expired_status, price) for owner, price in self.engaged.expire(ts)}
 
     # Function to see the current spent of all time zones
     def pacing_performance(self):
@@ -519,3 +649,66 @@ class GlobalPacing(object):
         for key in self.tz_list:
             spents.append(self.instances[key].budget_spent_total)
         return spents
+
+
+# Line items of a campaign and their budget totals
+class Campaign(object):
+    """ Ids of the line items of a campaign and the sums of their totals. Each publication of a line item adds the
+    changes of its totals, so the status of a campaign is read without visiting its line items.
+    """
+
+    __slots__ = ('line_items', 'totals', 'lock')
+
+    def __init__(self):
+        """Class constructor"""
+        self.line_items = []
+        # Budget, spent budget, engaged budget, bid requests waiting for their notification and expired bid requests,
+        # replaced at each change and read without the lock
+        self.totals = (0, 0, 0, 0, 0)
+        # The line items of the campaign publish from different threads
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return self.line_items, self.totals
+
+    def __setstate__(self, state):
+        self.line_items, self.totals = state
+        self.lock = threading.Lock()
+
+    def update(self, budget, spent, engaged, nb_engaged, nb_expired):
+        """ Add the changes of the totals of a line item
+
+        :param budget: change of the budget
+        :param spent: change of the spent budget
+        :param engaged: change of the engaged budget
+        :param nb_engaged: change of the number of bid requests waiting for their notification
+        :param nb_expired: change of the number of expired bid requests
+        """
+        with self.lock:
+            total_budget, total_spent, total_engaged, total_nb_engaged, total_nb_expired = self.totals
+            self.totals = (total_budget + budget, total_spent + spent, total_engaged + engaged,
+                           total_nb_engaged + nb_engaged, total_nb_expired + nb_expired)
+
+    def add(self, liid, pacing):
+        """ Attach a line item: its totals are added to those of the campaign
+
+        :param liid: id of the line item
+        :param pacing: GlobalPacing
+        """
+        with pacing.lock:
+            pacing.campaign = self
+            self.line_items.append(liid)
+            total_budget, _, nb_engaged, nb_expired, spent, engaged = pacing.snapshot
+            self.update(total_budget, spent, engaged, nb_engaged, nb_expired)
+
+    def remove(self, liid, pacing):
+        """ Detach a line item: its totals are subtracted from those of the campaign
+
+        :param liid: id of the line item
+        :param pacing: GlobalPacing
+        """
+        with pacing.lock:
+            self.line_items.remove(liid)
+            pacing.campaign = None
+            total_budget, _, nb_engaged, nb_expired, spent, engaged = pacing.snapshot
+            self.update(-total_budget, -spent, -engaged, -nb_engaged, -nb_expired)
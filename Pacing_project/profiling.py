@@ -0,0 +1,209 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
+import functools
+import inspect
+import json
+import threading
+import time
+import falcon
+import schemas
+from pacing_class_tz import Pacing, GlobalPacing
+
+# Upper bounds of the buckets of the stage histograms in seconds
+STAGE_BUCKETS = (1e-06, 2.5e-06, 5e-06, 1e-05, 2.5e-05, 5e-05, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1)
+# Decisions timed by the profiler, with the time zone of a call (from the instance and the bound arguments)
+CALLS = {
+    (GlobalPacing, 'choose_pacing'): lambda instance, arguments: arguments.get('tz'),
+    (GlobalPacing, 'pacing_decision'): lambda instance, arguments: arguments.get('tz'),
+    (Pacing, 'buying_decision'): lambda instance, arguments: instance.tz.zone
+}
+# Stages of the decisions
+STAGES = [(GlobalPacing, 'expire'), (GlobalPacing, 'new_instance'), (GlobalPacing, 'set_new_objectives'),
+          (GlobalPacing, 'publish'), (Pacing, 'day_reset'), (Pacing, 'change_hour'), (Pacing, 'build_data_prop'),
+          (Pacing, 'gen_mean_acceleration'), (Pacing, 'gen_mean_speed'), (Pacing, 'bs_calculation'),
+          (Pacing, 'check_proportion')]
+
+# Running profiler of the process
+active = None
+
+
+# Timer of the stages of the buying decisions
+class Profiler(object):
+    """ Time the decisions of the pacing and their stages. While it runs, the methods of the pacing classes are
+    replaced by timed wrappers; they are restored when it stops, so the pacing costs nothing more when it is not
+    profiled. A histogram is kept per decision and per stage, and the decisions slower than a threshold are logged with
+    their time zone, their timestamp and the time of each stage.
+    """
+
+    def __init__(self, slow_threshold=0.001, max_samples=100, buckets=STAGE_BUCKETS):
+        """Class constructor
+
+        :param slow_threshold: seconds above which a decision is logged
+        :param max_samples: number of slow decisions kept (the oldest are dropped)
+        :param buckets: upper bounds of the buckets in seconds
+        """
+        self.slow_threshold = slow_threshold
+        self.buckets = list(buckets)
+        # {name: [count, sum, max, counts per bucket]}
+        self.stats = {}
+        self.slow_calls = deque(maxlen=max_samples)
+        self.lock = threading.Lock()
+        # Decisions being timed by each thread, each one with the time spent in its stages
+        self.local = threading.local()
+        self.originals = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def running(self):
+        return self.originals is not None
+
+    def start(self):
+        """ Replace the methods of the pacing classes by their timed wrappers
+        """
+        global active
+        if active is not None:
+            raise RuntimeError("A profiler is already running")
+        active = self
+        self.originals = {}
+        for (cls, name), timezone in CALLS.items():
+            self.originals[cls, name] = function = cls.__dict__[name]
+            setattr(cls, name, self.timed(name, function, timezone))
+        for cls, name in STAGES:
+            self.originals[cls, name] = function = cls.__dict__[name]
+            setattr(cls, name, self.timed(name, function))
+
+    def stop(self):
+        """ Restore the methods of the pacing classes
+        """
+        global active
+        if not self.running:
+            return
+        for (cls, name), function in self.originals.items():
+            setattr(cls, name, function)
+        self.originals = None
+        if active is self:
+            active = None
+
+    def timed(self, name, function, timezone=None):
+        """ Wrap a method of the pacing
+
+        :param name: name of the decision or of the stage
+        :param function: method
+        :param timezone: function giving the time zone of a decision (None for a stage)
+        :return: timed method
+        """
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(instance, *args, **kwargs):
+            frames = self.frames()
+            if timezone is not None:
+                frames.append({})
+            start = time.perf_counter()
+            try:
+                return function(instance, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                stages = frames.pop() if timezone is not None else None
+                for frame in frames:
+                    frame[name] = frame.get(name, 0) + seconds
+                self.observe(name, seconds)
+                # Only the outermost decision is logged, with the stages of the decisions it made
+                if stages is not None and not frames and seconds >= self.slow_threshold:
+                    try:
+                        arguments = signature.bind(instance, *args, **kwargs).arguments
+                    except TypeError:
+                        # The call failed on its arguments, its error is raised as is
+                        arguments = {}
+                    self.slow_calls.append({'call': name, 'tz': timezone(instance, arguments),
+                                            'ts': arguments.get('ts'), 'seconds': seconds, 'stages': stages})
+        return wrapper
+
+    def frames(self):
+        try:
+            return self.local.frames
+        except AttributeError:
+            frames = self.local.frames = []
+            return frames
+
+    def observe(self, name, seconds):
+        """ Add a duration to the histogram of a decision or of a stage
+
+        :param name: name of the decision or of the stage
+        :param seconds: duration
+        """
+        with self.lock:
+            try:
+                stat = self.stats[name]
+            except KeyError:
+                stat = self.stats[name] = [0, 0., 0., array('Q', bytes(8 * (len(self.buckets) + 1)))]
+            stat[0] += 1
+            stat[1] += seconds
+            if seconds > stat[2]:
+                stat[2] = seconds
+            stat[3][bisect_left(self.buckets, seconds)] += 1
+
+    def reset(self):
+        """ Forget the histograms and the slow decisions
+        """
+        with self.lock:
+            self.stats = {}
+            self.slow_calls.clear()
+
+    def report(self):
+        """ Histograms of the decisions and of the stages, and the slow decisions
+
+        :return: dictionary {'running', 'slow_threshold', 'stages': {name: statistics}, 'slow_calls': list}, the buckets
+        of a histogram give the number of durations up to each bound (not cumulative)
+        """
+        with self.lock:
+            stages = {}
+            bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+            for name, (count, total, longest, counts) in self.stats.items():
+                stages[name] = {'count': count, 'total_seconds': total, 'mean_seconds': total / count,
+                                'max_seconds': longest, 'buckets': dict(zip(bounds, counts.tolist()))}
+            slow_calls = list(self.slow_calls)
+        return {'running': self.running, 'slow_threshold': self.slow_threshold, 'stages': stages,
+                'slow_calls': slow_calls}
+
+
+# Controller of the profiler of the process
+class ProfileEndpoint(object):
+    def on_get(self, req, resp):
+        if active is None:
+            raise falcon.HTTPNotFound(description="No profiler is running")
+        resp.text = json.dumps({
+            'status': 'ok',
+            'profile': active.report()
+        })
+
+    def on_post(self, req, resp):
+        body = req.bounded_stream.read()
+        try:
+            data = schemas.profile.decode(body) if body.strip() else schemas.Profile()
+        except schemas.PayloadError as e:
+            raise falcon.HTTPUnprocessableEntity(description=str(e))
+        try:
+            Profiler(data.slow_threshold, data.max_samples).start()
+        except RuntimeError as e:
+            raise falcon.HTTPConflict(description=str(e))
+        resp.text = json.dumps({
+            'status': 'ok'
+        })
+
+    def on_delete(self, req, resp):
+        profiler = active
+        if profiler is None:
+            raise falcon.HTTPNotFound(description="No profiler is running")
+        profiler.stop()
+        resp.text = json.dumps({
+            'status': 'ok',
+            'profile': profiler.report()
+        })
@@ -0,0 +1,70 @@
+import sys
+import time
+import requests as req
+from loguru import logger
+
+# Rows sent in a request (the creation of the line items of a request holds the lock of the database)
+CHUNK_SIZE = 5000
+
+
+# Read the rows of a provisioning file by chunks
+def chunks(path, size=CHUNK_SIZE):
+    """ Split a CSV file (with a header line) or an NDJSON file (one JSON object per line) in bodies of at most size
+    rows. Each row is on its own line.
+
+    :param path: path of the file, read as CSV if its name ends with .csv
+    :param size: number of rows per body
+    :return: generator of (line numbers of the rows, body, content type)
+    """
+    with open(path, 'rb') as f:
+        header = f.readline() if path.endswith('.csv') else b''
+        content_type = 'text/csv' if header else 'application/x-ndjson'
+        lines = []
+        rows = []
+        for number, line in enumerate(f, 2 if header else 1):
+            if not line.strip():
+                continue
+            lines.append(number)
+            rows.append(line if line.endswith(b'\n') else line + b'\n')
+            if len(rows) == size:
+                yield lines, header + b''.join(rows), content_type
+                lines = []
+                rows = []
+        if rows:
+            yield lines, header + b''.join(rows), content_type
+
+
+# Send a provisioning file to the API
+def provision(path, url="http://127.0.0.1:8000", size=CHUNK_SIZE):
+    """ Create the campaigns and the line items of a file with the bulk provisioning route
+
+    :param path: CSV or NDJSON file of rows (cpid, liid, budget, start, end, and optionally notification_timeout and
+    expired_status); a row without liid only creates its campaign
+    :param url: url of the API
+    :param size: number of rows per request
+    :return: number of rows sent and list of (line number, description) of the rejected rows
+    """
+    session = req.Session()
+    nb_rows = 0
+    errors = []
+    for lines, body, content_type in chunks(path, size):
+        response = session.post(f"{url}/provision", data=body, headers={'content-type': content_type})
+        response.raise_for_status()
+        for number, result in zip(lines, response.json()['results']):
+            if result['status'] != 'ok':
+                errors.append((number, result['description']))
+        nb_rows += len(lines)
+    return nb_rows, errors
+
+
+if __name__ == '__main__':
+    # python provision.py rows.csv|rows.ndjson [url] [rows per request]
+    path = sys.argv[1]
+    url = sys.argv[2] if len(sys.argv) > 2 else "http://127.0.0.1:8000"
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else CHUNK_SIZE
+    start = time.perf_counter()
+    nb_rows, errors = provision(path, url, size)
+    for number, description in errors:
+        logger.error(f"{path}:{number}: {description}")
+    logger.info(f"Sent {nb_rows} rows in {time.perf_counter() - start:.2f} s, {len(errors)} rejected")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,116 @@
+import csv
+from typing import Annotated, List, Literal, Optional, Union
+import msgspec
+
+
+# Payloads of the API. Decoders are compiled once: JSON decoding and validation are done in a single pass.
+class BidRequest(msgspec.Struct):
+    tz: str
+    cpm: float
+    imps: float
+    brid: Union[str, int, float]
+
+
+class Notification(msgspec.Struct):
+    status: Literal['win', 'lose']
+    brid: Union[str, int, float]
+
+
+class Reset(msgspec.Struct):
+    new_budget: float
+
+    def __post_init__(self):
+        if self.new_budget < 0:
+            raise ValueError("New budget cannot be negative")
+
+
+class Campaign(msgspec.Struct):
+    cpid: Union[str, int]
+
+
+class LineItemInit(msgspec.Struct):
+    budget: Union[int, float, str]
+    start: str
+    end: str
+    liid: Union[str, int]
+    # Seconds before a bought bid request without notification is taken as expired_status (null: never)
+    notification_timeout: Optional[Annotated[float, msgspec.Meta(gt=0)]] = 3600
+    expired_status: Literal['win', 'lose'] = 'lose'
+
+
+class LineItemId(msgspec.Struct):
+    liid: Union[str, int]
+
+
+# Row of a bulk provisioning: a line item and its campaign, or only the campaign when there is no liid
+class ProvisionRow(msgspec.Struct):
+    cpid: Union[str, int]
+    liid: Optional[Union[str, int]] = None
+    budget: Optional[Union[int, float]] = None
+    start: Optional[str] = None
+    end: Optional[str] = None
+    notification_timeout: Optional[Annotated[float, msgspec.Meta(gt=0)]] = 3600
+    expired_status: Literal['win', 'lose'] = 'lose'
+
+
+class Profile(msgspec.Struct):
+    # Seconds above which a decision is logged, and number of slow decisions kept
+    slow_threshold: Annotated[float, msgspec.Meta(ge=0)] = 0.001
+    max_samples: Annotated[int, msgspec.Meta(gt=0)] = 100
+
+
+bid_request = msgspec.json.Decoder(BidRequest)
+notification = msgspec.json.Decoder(Notification)
+reset = msgspec.json.Decoder(Reset)
+campaign = msgspec.json.Decoder(Campaign)
+line_item_init = msgspec.json.Decoder(LineItemInit)
+line_item_id = msgspec.json.Decoder(LineItemId)
+provision_row = msgspec.json.Decoder(ProvisionRow)
+profile = msgspec.json.Decoder(Profile)
+# Items of a batch are kept raw to be validated one by one
+batch = msgspec.json.Decoder(List[msgspec.Raw])
+
+# Error raised by the decoders when a payload is not valid
+PayloadError = msgspec.DecodeError
+
+
+# Decode the items of a batch
+def decode_batch(body, decoder):
+    """ Parse a JSON array or NDJSON (one JSON object per line) body
+
+    :param body: bytes of the body
+    :param decoder: decoder of an item
+    :return: list of items, an item that cannot be decoded is replaced by the exception
+    """
+    if body.lstrip().startswith(b'['):
+        raw_items = batch.decode(body)
+    else:
+        raw_items = [line for line in body.splitlines() if line.strip()]
+    items = []
+    for raw_item in raw_items:
+        try:
+            items.append(decoder.decode(raw_item))
+        except PayloadError as e:
+            items.append(e)
+    return items
+
+
+# Decode the rows of a bulk provisioning
+def decode_provision(body, content_type=None):
+    """ Parse the rows of a bulk provisioning, in CSV with a header line (content type text/csv) or in JSON. The
+    cells of a CSV row are converted to the types of the row, an empty cell takes the default value.
+
+    :param body: bytes of the body
+    :param content_type: content type of the body
+    :return: list of ProvisionRow, a row that cannot be decoded is replaced by the exception
+    """
+    if not (content_type or '').startswith('text/csv'):
+        return decode_batch(body, provision_row)
+    rows = []
+    for cells in csv.DictReader(body.decode().splitlines()):
+        try:
+            rows.append(msgspec.convert({key: value for key, value in cells.items() if key and value},
+                                        ProvisionRow, strict=False))
+        except PayloadError as e:
+            rows.append(e)
+    return rows
@@ -0,0 +1,119 @@
+from array import array
+
+
+# Time-based sliding window used for the moving averages of the pacing
+class SlidingWindow:
+    """ Values indexed by timestamp over a sliding window of time, stored in a ring buffer of floats.
+
+    Push, eviction and mean are O(1) amortized: the buffer only grows (doubling its capacity) when the window holds
+    more values than it has ever held before.
+    """
+
+    __slots__ = ('duration', 'times', 'values', 'mask', 'head', 'size', 'total', 'expired_total')
+
+    def __init__(self, duration, capacity=8):
+        """Class constructor
+
+        :param duration: length of the window in seconds
+        :param capacity: initial number of values the ring buffer can hold (rounded up to a power of two)
+        """
+        self.duration = duration
+        size = 1
+        while size < capacity:
+            size *= 2
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.mask = size - 1
+        self.head = 0
+        self.size = 0
+        self.total = 0
+        self.expired_total = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        # Only the values in the window are saved, from the oldest to the newest
+        return self.duration, self._unroll(self.times), self._unroll(self.values), self.total, self.expired_total
+
+    def __setstate__(self, state):
+        self.duration, times, values, self.total, self.expired_total = state
+        self.size = len(times)
+        size = 1
+        while size < self.size:
+            size *= 2
+        self.times = times + array('d', bytes(8 * (size - self.size)))
+        self.values = values + array('d', bytes(8 * (size - self.size)))
+        self.mask = size - 1
+        self.head = 0
+
+    def _unroll(self, buffer):
+        end = self.head + self.size
+        if end <= self.mask + 1:
+            return buffer[self.head:end]
+        return buffer[self.head:] + buffer[:end & self.mask]
+
+    def reset(self, ts, value=0):
+        """ Empty the window and start it again with one value
+
+        :param ts: timestamp in seconds
+        :param value: first value of the window
+        """
+        self.head = 0
+        self.size = 0
+        self.total = 0
+        self.expired_total = 0
+        self.push(ts, value)
+
+    def _grow(self):
+        capacity = self.mask + 1
+        # Unroll the ring so that the oldest value is at index 0
+        self.times = self._unroll(self.times) + array('d', bytes(8 * capacity))
+        self.values = self._unroll(self.values) + array('d', bytes(8 * capacity))
+        self.mask = 2 * capacity - 1
+        self.head = 0
+
+    def push(self, ts, value):
+        """ Add a value at the end of the window
+
+        :param ts: timestamp in seconds (not lower than the previous one)
+        :param value: value
+        """
+        if self.size > self.mask:
+            self._grow()
+        index = (self.head + self.size) & self.mask
+        self.times[index] = ts
+        self.values[index] = value
+        self.size += 1
+        self.total += value
+
+    def evict(self, now=None):
+        """ Remove the values older than the duration of the window
+
+        :param now: current timestamp in seconds (default is the timestamp of the last value)
+        """
+        if now is None:
+            now = self.last_ts
+        limit = now - self.duration
+        times = self.times
+        while self.size > 0 and times[self.head] < limit:
+            value = self.values[self.head]
+            self.total -= value
+            self.expired_total += value
+            self.head = (self.head + 1) & self.mask
+            self.size -= 1
+
+    def mean(self):
+        """ Return the mean of the values in the window (0 if it is empty)
+        """
+        if self.size == 0:
+            return 0
+        return self.total / self.size
+
+    @property
+    def last_ts(self):
+        return self.times[(self.head + self.size - 1) & self.mask]
+
+    @property
+    def last(self):
+        return self.values[(self.head + self.size - 1) & self.mask]
@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+from loguru import logger
+from br_store import BidRequestStore
+from external_functions_tz import simulate
+
+# Parameters of a run and their default value
+PARAMETERS = {
+    'budget': 10000,
+    'day_start': 9,
+    'day_end': 12,
+    # Budget added on July 9, like the reset of the original simulation (None: no change of budget)
+    'budget_change': None,
+    'coef': 1,
+    'purchase_threshold': 0.7,
+    'objective_ratio': 0.85
+}
+METRICS = ['nb_br', 'nb_buy', 'spent', 'remaining', 'spent_ratio', 'hourly_cv', 'daily_cv', 'seconds', 'error']
+
+# Store of the bid requests, opened once by each worker
+store = None
+
+
+# Runs of a grid of parameters
+def grid_runs(grid):
+    """ Cartesian product of the values of the parameters
+
+    :param grid: dictionary {parameter: list of values}, missing parameters take their default value
+    :return: list of dictionaries of parameters
+    """
+    unknown = set(grid).difference(PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters {unknown}")
+    values = [grid.get(name, [default]) for name, default in PARAMETERS.items()]
+    return [dict(zip(PARAMETERS, run)) for run in itertools.product(*values)]
+
+
+# Identifier of a run in the results table
+def run_key(params):
+    return json.dumps([params[name] for name in PARAMETERS])
+
+
+# Smoothness of the delivery
+def delivery_metrics(pacing, pacing_df):
+    """ Spent budget of a simulation and regularity of its delivery: coefficient of variation of the budget spent
+    per UTC hour and per UTC day of the campaign (0 is a perfectly flat delivery)
+
+    :param pacing: GlobalPacing at the end of the simulation
+    :param pacing_df: Dataframe of the decisions
+    :return: dictionary of metrics
+    """
+    spent = sum(pacing.pacing_performance())
+    metrics = {
+        'nb_br': len(pacing_df),
+        'nb_buy': int(pacing_df['buying'].sum()),
+        'spent': spent,
+        'remaining': pacing.total_budget - spent,
+        'spent_ratio': spent / pacing.total_budget if pacing.total_budget else np.nan
+    }
+    # Spent budget of each time zone at the end of each hour, summed over the time zones
+    for name, freq in (('hourly_cv', 'h'), ('daily_cv', 'D')):
+        if not len(pacing_df):
+            metrics[name] = np.nan
+            continue
+        cumulative = (pacing_df.groupby([pacing_df.index.floor(freq), 'tz'])['spent'].last()
+                      .unstack().ffill().fillna(0).sum(axis=1))
+        delivery = np.diff(cumulative.to_numpy(), prepend=0)
+        mean = delivery.mean()
+        metrics[name] = delivery.std() / mean if mean > 0 else np.nan
+    return metrics
+
+
+# Open the store in a worker of the pool
+def init_worker(path):
+    global store
+    # The columns are memory-mapped: the workers share the pages of the store instead of receiving a copy
+    store = BidRequestStore(path)
+    logger.remove()
+
+
+# Simulation of a worker
+def run(params):
+    """ Simulate one set of parameters
+
+    :param params: dictionary of parameters
+    :return: parameters and metrics, with the error of a failed simulation (empty if it succeeded)
+    """
+    start = time.perf_counter()
+    settings = {name: params[name] for name in ('coef', 'purchase_threshold', 'objective_ratio')}
+    # A local day of the campaign spans two UTC days
+    chunks = store.chunks(datetime(2020, 7, params['day_start']) - timedelta(days=1),
+                          datetime(2020, 7, params['day_end']) + timedelta(days=2))
+    # A failed simulation is recorded in its row instead of stopping the other simulations of the pool
+    try:
+        pacing, pacing_df = simulate(chunks, params['budget'], params['day_start'], params['day_end'],
+                                     params['budget_change'], **settings)
+        metrics = delivery_metrics(pacing, pacing_df)
+        metrics['error'] = ''
+    except Exception as error:
+        metrics = dict.fromkeys(METRICS[:-2], np.nan)
+        metrics['error'] = repr(error)
+    metrics['seconds'] = time.perf_counter() - start
+    return {**params, **metrics}
+
+
+# Run a grid of simulations on a pool of processes
+def sweep(store_path, results_path, grid, processes=None):
+    """ Run the simulations of a grid that are not in the results table yet, and append each result to the table as
+    soon as it is done: an interrupted sweep resumes where it stopped.
+
+    :param store_path: directory of the store of bid requests (br_store.py)
+    :param results_path: CSV file of the results
+    :param grid: dictionary {parameter: list of values}
+    :param processes: number of processes (default is the number of cores)
+    :return: number of simulations run
+    """
+    done = set()
+    if os.path.exists(results_path):
+        # A line cut by an interruption is removed, the new rows are appended after the last complete one
+        with open(results_path, 'rb+') as f:
+            content = f.read()
+            f.truncate(content.rfind(b'\n') + 1)
+        with open(results_path, newline='') as f:
+            for row in csv.DictReader(f):
+                done.add(run_key({name: json.loads(row[name]) for name in PARAMETERS}))
+    runs = [params for params in grid_runs(grid) if run_key(params) not in done]
+    logger.info(f"{len(runs)} simulations to run, {len(done)} already done")
+    if not runs:
+        return 0
+    new_file = not os.path.exists(results_path) or not os.path.getsize(results_path)
+    with open(results_path, 'a', newline='') as f, \
+            multiprocessing.Pool(processes, initializer=init_worker, initargs=(store_path,)) as pool:
+        writer = csv.DictWriter(f, fieldnames=list(PARAMETERS) + METRICS)
+        if new_file:
+            writer.writeheader()
+        for i, result in enumerate(pool.imap_unordered(run, runs)):
+            writer.writerow({name: json.dumps(value) if name in PARAMETERS else value
+                             for name, value in result.items()})
+            f.flush()
+            if result['error']:
+                logger.error(f"{i + 1}/{len(runs)} {run_key(result)}: {result['error']}")
+            else:
+                logger.info(f"{i + 1}/{len(runs)} {run_key(result)}: spent {result['spent']:.2f}")
+    return len(runs)
+
+
+if __name__ == '__main__':
+    # python sweep.py store results.csv grid.json [processes]
+    with open(sys.argv[3]) as f:
+        grid = json.load(f)
+    sweep(sys.argv[1], sys.argv[2], grid, int(sys.argv[4]) if len(sys.argv) > 4 else None)
@@ -76,3 +76,22 @@ def test_buying_br(init_li):
     assert response_br_body["buying"]
     assert response_status_before_notif_body["spent"] == 0
     assert pytest.approx(response_status_after_notif_body["spent"], 0.001) == 0.333
+
+
+def test_batch_br_and_notif(init_li):
+    response_br = req.post("http://127.0.0.1:8000/li/1/br/batch", json=[
+        {"tz": "America/New_York", "brid": 1, "imps": 1, "cpm": 1},
+        {"tz": "America/New_York", "brid": 2, "imps": 1},
+        {"tz": "Europe/Paris", "brid": 3, "imps": 1, "cpm": 1}
+    ])
+    results = response_br.json()["results"]
+    assert response_br.status_code == 200
+    assert [result["status"] for result in results] == ["ok", "error", "ok"]
+    assert results[0]["buying"]
+    ndjson = '{"status": "win", "brid": 1}\n{"status": "win", "brid": 2}\nnot json\n{"status": "lose", "brid": 3}\n'
+    response_notif = req.post("http://127.0.0.1:8000/li/1/notif/batch", data=ndjson,
+                              headers={"content-type": "application/x-ndjson"})
+    results = response_notif.json()["results"]
+    assert [result["status"] for result in results] == ["ok", "error", "error", "ok"]
+    response_status = req.get("http://127.0.0.1:8000/li/1/status").json()
+    assert pytest.approx(response_status["spent"], 0.001) == 0.001
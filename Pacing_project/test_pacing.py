@@ -0,0 +1,648 @@
+import asyncio
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+import sys
+import threading
+from datetime import date, datetime, timedelta
+from statsmodels.formula.api import ols
+from traffic_model import DEDUP_WINDOW, TrafficModel, TrafficProfile
+from sliding_window import SlidingWindow
+from engaged_index import EngagedIndex
+from pacing_class_tz import Campaign, Pacing, GlobalPacing
+from api_rest import DataBase, routes
+from api_shards import Provision as ShardsProvision, Router, Shard, merge_status
+import br_store
+import checkpoint
+import falcon
+import falcon.asgi
+import falcon.testing
+from metrics import RequestMetrics
+from profiling import Profiler, ProfileEndpoint
+import external_functions_tz
+import sweep
+from tz_cache import TimezoneCache, round_timestamp
+
+
+@pytest.fixture()
+def local_brs():
+    tz = pytz.timezone("Europe/Paris")
+    start = tz.localize(datetime(2020, 7, 9))
+    return [(start + timedelta(minutes=37 * i), (i % 5) + 1) for i in range(400)]
+
+
+def test_traffic_profile_folds_the_days_like_a_groupby(local_brs):
+    profile = TrafficProfile()
+    for br_id, (ts, imps) in enumerate(local_brs):
+        profile.add(ts.timestamp(), ts.toordinal(), ts.hour, imps, br_id)
+    buffer = pd.DataFrame.from_records([{'Date': ts, 'imps': imps} for ts, imps in local_brs], index='Date')
+    expected = buffer.imps.groupby([buffer.index.date, buffer.index.weekday, buffer.index.hour]).sum()
+    last_day = buffer.index[-1].date()
+    closed = expected[expected.index.get_level_values(0) < last_day]
+    # The closed days are folded in the model, one observation per observed hour
+    sums = closed.groupby(level=[1, 2]).sum()
+    assert np.allclose(profile.model.sums[sums.index.get_level_values(0), sums.index.get_level_values(1)], sums.values)
+    assert profile.model.sums.sum() == pytest.approx(sums.sum())
+    assert profile.model.counts.sum() == len(closed)
+    assert np.array_equal(np.flatnonzero(profile.counts), expected[last_day].index.get_level_values(1))
+    assert list(profile.imps[profile.counts > 0]) == list(expected[last_day].values)
+
+
+def test_traffic_profile_ignores_late_and_repeated_bid_requests(local_brs):
+    profile = TrafficProfile()
+    ts, imps = local_brs[100]
+    profile.add(ts.timestamp(), ts.toordinal(), ts.hour, imps, "br")
+    profile.add(ts.timestamp(), ts.toordinal(), ts.hour, imps, "br")
+    assert profile.counts.sum() == 1 and profile.imps.sum() == imps
+    profile.add(ts.timestamp() - 86400, ts.toordinal() - 1, 10, 5, "late")
+    assert profile.counts.sum() == 1 and not profile.model.counts.any()
+    # Only the ids of the last seconds are kept, and they are not saved
+    profile.add(ts.timestamp() + DEDUP_WINDOW + 1, ts.toordinal(), ts.hour, 1, "next")
+    assert list(profile.seen) == ["next"] and len(profile.recent) == 1
+    state = profile.__getstate__()
+    assert 'seen' not in state and 'recent' not in state
+
+
+def test_traffic_model_matches_ols():
+    rng = np.random.default_rng(0)
+    first_day = date(2020, 7, 9)
+    counts = rng.integers(0, 3, (16, 24))
+    imps = rng.integers(1, 100, (16, 24)) * (counts > 0)
+    model = TrafficModel()
+    for day in range(16):
+        model.add_day((first_day.weekday() + day) % 7, imps[day], counts[day])
+    days, hours = np.nonzero(counts)
+    aggr = pd.DataFrame({'weekday': (first_day.weekday() + days) % 7, 'hour': hours, 'imps': imps[days, hours]})
+    grid = pd.DataFrame({'weekday': np.repeat(range(7), 24), 'hour': np.tile(range(24), 7)})
+    grid['fitted'] = ols('imps ~ C(weekday) + C(hour)', data=aggr).fit().predict(grid)
+    pattern = grid.pivot_table('fitted', index='hour', columns='weekday')
+    assert np.allclose(model.fit_hour_weekday(), pattern * 100 / pattern.sum())
+    fitted = ols('imps ~ C(hour)', data=aggr).fit().predict(pd.DataFrame({'hour': range(24)})).values
+    assert np.allclose(model.fit_hour()[:, 0], fitted * 100 / fitted.sum())
+
+
+def test_proportions_are_a_dense_hour_weekday_table():
+    pacing = Pacing(total_budget=240, start_date=datetime(2020, 7, 9), end_date=datetime(2020, 7, 30),
+                    timezone="Europe/Paris")
+    assert pacing.prop_table.shape == (24, 7) and pacing.hour_proportions == (1 / 24,) * 24
+    model = TrafficModel()
+    model.add_day(3, np.arange(1, 25), np.ones(24))
+    hours = model.proportions()
+    assert np.array_equal(hours, np.repeat(model.fit_hour() / 100, 7, axis=1))
+    for weekday in range(7):
+        model.add_day(weekday, np.arange(1, 25) * (weekday + 1), np.ones(24))
+    assert np.allclose(model.proportions().sum(axis=0), 1)
+    pacing.change_hour()
+    assert pacing.budget_hour == pytest.approx(240 / pacing.remaining_days / 24)
+
+
+def test_sliding_window_eviction_and_growth():
+    window = SlidingWindow(duration=10, capacity=4)
+    window.reset(0)
+    for ts in range(1, 30):
+        window.push(ts, ts)
+        window.evict()
+        assert window.mean() == pytest.approx(sum(range(max(ts - 10, 0), ts + 1)) / len(window))
+    assert len(window) == 11
+    assert window.last == 29
+    assert window.expired_total == sum(range(19))
+
+
+def test_engaged_index_expires_like_a_scan():
+    rng = np.random.default_rng(3)
+    index = EngagedIndex(timeout=600, resolution=60)
+    pending = {}
+    ts = 0
+    for i in range(20000):
+        ts += rng.exponential(5)
+        if pending and rng.random() < 0.4:
+            br_id = list(pending)[rng.integers(len(pending))]
+            assert index.pop(br_id) == pending.pop(br_id)[:2]
+        index.add(i, i % 3, float(i), ts)
+        pending[i] = (i % 3, float(i), ts + 600)
+        expired = index.expire(ts)
+        # A bid request expires once the bucket of its deadline has passed
+        expected = [br_id for br_id, (_, _, deadline) in pending.items() if deadline // 60 < ts // 60]
+        assert sorted(expired) == sorted(pending[br_id][:2] for br_id in expected)
+        for br_id in expected:
+            del pending[br_id]
+    assert len(index) == len(pending)
+    assert len(index.prices) < 1000
+
+
+@pytest.mark.parametrize("expired_status", ["lose", "win"])
+def test_lost_notification_releases_engaged_budget(expired_status):
+    pacing = GlobalPacing(total_budget=1000, start_date=datetime(2020, 7, 9), end_date=datetime(2020, 7, 12),
+                          notification_timeout=600, expired_status=expired_status)
+    start = datetime(2020, 7, 9, 12).timestamp()
+    buying, _, _, engaged, _, _ = pacing.choose_pacing(start, "Europe/Paris", 5000, 1, "lost")
+    assert buying and engaged == 5
+    pacing.choose_pacing(start + 300, "Europe/Paris", 0, 1, "early")
+    assert "lost" in pacing.engaged
+    _, _, spent, engaged, _, _ = pacing.choose_pacing(start + 700, "Europe/Paris", 0, 1, "late")
+    assert engaged == 0
+    assert spent == (5 if expired_status == "win" else 0)
+    assert "lost" not in pacing.engaged
+    assert pacing.snapshot[3] == pacing.engaged.nb_expired == 1
+    with pytest.raises(KeyError):
+        pacing.dispatch_notifications("lost", "win")
+
+
+def test_bid_request_bought_twice_replaces_its_purchase():
+    pacing = GlobalPacing(total_budget=1000, start_date=datetime(2020, 7, 9), end_date=datetime(2020, 7, 12),
+                          notification_timeout=600)
+    start = datetime(2020, 7, 9, 12).timestamp()
+    for i in range(5):
+        assert pacing.choose_pacing(start + i, "Europe/Paris", 2, 1, "dup")[0]
+    # The previous purchases are released as expired, only the last one waits for its notification
+    assert len(pacing.engaged) == 1 and pacing.engaged.nb_expired == 4
+    assert pacing.engaged_total == pytest.approx(0.002)
+    pacing.dispatch_notifications("dup", "win")
+    for i in range(3):
+        _, _, spent, engaged, _, _ = pacing.choose_pacing(start + 800 + 100 * i, "Europe/Paris", 0, 1, f"late{i}")
+    assert spent == pytest.approx(0.002)
+    assert engaged == pytest.approx(0, abs=1e-12) and pacing.engaged_total == pytest.approx(0, abs=1e-12)
+    assert "dup" not in pacing.engaged and pacing.snapshot[3] == 4
+
+
+@pytest.mark.parametrize("expired_status", ["win", "lose"])
+def test_choose_pacing_batch_matches_choose_pacing(expired_status):
+    rng = np.random.default_rng(1)
+    tz_names = ["Europe/Paris", "America/New_York", "Asia/Tokyo"]
+    size = 3000
+    ts = np.sort(datetime(2020, 7, 9).timestamp() + rng.uniform(-3600, 2.5 * 86400, size))
+    tz_codes = rng.integers(0, 3, size)
+    cpm = rng.uniform(-1, 10, size)
+    imps = rng.integers(1, 5, size)
+    br_ids = np.arange(size)
+    # The purchases without notification expire, the others are notified after the batch that bought them
+    settings = dict(total_budget=20, start_date=datetime(2020, 7, 9), end_date=datetime(2020, 7, 11),
+                    notification_timeout=600, expired_status=expired_status)
+    single = GlobalPacing(**settings)
+    batch = GlobalPacing(**settings)
+    expected = []
+    results = []
+    for chunk in np.array_split(np.arange(size), 30):
+        for row in zip(ts[chunk], tz_codes[chunk], cpm[chunk], imps[chunk], br_ids[chunk]):
+            try:
+                expected.append(single.choose_pacing(row[0], tz_names[row[1]], *row[2:]))
+            except ValueError:
+                expected.append((False,) + (np.nan,) * 5)
+        result = batch.choose_pacing_batch(ts[chunk], tz_codes[chunk], cpm[chunk], imps[chunk], br_ids[chunk], tz_names)
+        assert result[0].dtype == bool
+        results.append(np.column_stack(result))
+        for br_id in chunk[chunk % 3 == 0].tolist():
+            if br_id in single.engaged:
+                single.dispatch_notifications(br_id, "win" if br_id % 2 else "lose")
+                batch.dispatch_notifications(br_id, "win" if br_id % 2 else "lose")
+    assert np.array_equal(np.concatenate(results), np.array(expected, dtype=float), equal_nan=True)
+    assert batch.engaged.to_dict() == single.engaged.to_dict()
+    assert batch.snapshot == single.snapshot
+    # Budget was reallocated between the time zones and purchases expired
+    assert len(batch.tz_objective) < len(tz_names) and batch.engaged.nb_expired > 0
+
+
+def test_checkpoint_restores_the_same_pacing(tmp_path):
+    rng = np.random.default_rng(2)
+    tz_names = ["Europe/Paris", "America/New_York", "Asia/Tokyo"]
+    size = 4000
+    ts = np.sort(datetime(2020, 7, 9, 12).timestamp() + rng.uniform(0, 3 * 86400, size))
+    rows = list(zip(ts, rng.integers(0, 3, size), rng.uniform(0, 10, size), rng.integers(1, 5, size),
+                    np.arange(size), rng.random(size) < 0.5))
+
+    def replay(pacing, rows):
+        results = []
+        for ts_br, tz, cpm, imps, br_id, win in rows:
+            results.append(pacing.choose_pacing(ts_br, tz_names[tz], cpm, imps, br_id))
+            # Every other bought br stays ongoing
+            if results[-1][0] and br_id % 2:
+                pacing.dispatch_notifications(br_id, "win" if win else "lose")
+        return results
+
+    bdd = DataBase()
+    bdd.campaigns['1'] = Campaign()
+    bdd.instances['1'] = GlobalPacing(total_budget=500, start_date=datetime(2020, 7, 9),
+                                      end_date=datetime(2020, 7, 12))
+    bdd.campaigns['1'].add('1', bdd.instances['1'])
+    replay(bdd.instances['1'], rows[:size // 2])
+    path = tmp_path / "pacing.ckpt"
+    checkpoint.save(bdd, path)
+    restored = DataBase()
+    assert checkpoint.Checkpoint(restored, path).restore()
+    assert restored.campaigns['1'].line_items == ['1']
+    assert restored.campaigns['1'].totals == bdd.campaigns['1'].totals
+    assert restored.instances['1'].campaign is restored.campaigns['1']
+    assert replay(restored.instances['1'], rows[size // 2:]) == replay(bdd.instances['1'], rows[size // 2:])
+    assert restored.instances['1'].engaged.to_dict() == bdd.instances['1'].engaged.to_dict()
+    # A damaged file is refused
+    data = path.read_bytes()
+    path.write_bytes(data[:-1] + bytes([data[-1] ^ 1]))
+    with pytest.raises(ValueError):
+        checkpoint.load(path)
+
+
+def test_line_item_is_consistent_under_threads():
+    tz_names = ["Europe/Paris", "America/New_York", "Asia/Tokyo"]
+    pacing = GlobalPacing(total_budget=10 ** 6, start_date=datetime(2020, 7, 9), end_date=datetime(2020, 7, 12))
+    campaign = Campaign()
+    campaign.add("1", pacing)
+    start = datetime(2020, 7, 9, 12).timestamp()
+    nb_threads, size = 8, 1500
+    bought = [[] for _ in range(nb_threads)]
+    errors = []
+    done = threading.Event()
+
+    def send(worker):
+        rng = np.random.default_rng(worker)
+        for i in range(size):
+            br_id = f"{worker}-{i}"
+            price = rng.uniform(0, 10) / 1000
+            # The bid requests of the threads interleave in the same hour
+            buying, *_ = pacing.choose_pacing(start + rng.uniform(0, 3000), tz_names[i % 3], price * 1000, 1, br_id)
+            if buying:
+                win = rng.random() < 0.5
+                pacing.dispatch_notifications(br_id, "win" if win else "lose")
+                bought[worker].append(price if win else 0)
+
+    def read():
+        while not done.is_set():
+            # The statuses of the time zones are replaced while they are read, each one is consistent
+            for spent, engaged, remaining, objective, _ in pacing.snapshot[1].values():
+                if remaining != max(objective - (engaged + spent), 0) and remaining != objective - (engaged + spent):
+                    errors.append((spent, engaged, remaining, objective))
+
+    # An exception in a thread fails the test instead of only ending the thread
+    def guarded(target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        reader = threading.Thread(target=guarded, args=(read,))
+        reader.start()
+        threads = [threading.Thread(target=guarded, args=(send, worker)) for worker in range(nb_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        reader.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert not errors
+    assert not len(pacing.engaged)
+    spent = sum(pacing.pacing_performance())
+    assert spent == pytest.approx(sum(sum(prices) for prices in bought))
+    assert pacing.snapshot[4] == pacing.spent_total == pytest.approx(spent)
+    # Once the decisions are done, the time zones of the snapshot add up to its totals
+    tz_status = pacing.snapshot[1]
+    assert sum(status[0] for status in tz_status.values()) == pytest.approx(pacing.snapshot[4])
+    assert sum(status[1] for status in tz_status.values()) == pytest.approx(pacing.snapshot[5], abs=1e-9)
+    assert pacing.engaged_total == pytest.approx(0, abs=1e-9)
+    assert campaign.totals == (10 ** 6, pytest.approx(spent), pytest.approx(0, abs=1e-9), 0, 0)
+    for instance in pacing.instances.values():
+        assert instance.budget_engaged == pytest.approx(0, abs=1e-9)
+
+
+def test_generated_store_has_the_columns_of_the_dataset(tmp_path):
+    profiles = {"Europe/Paris": br_store.TimezoneProfile(20000, win_rate=0.3),
+                "America/New_York": br_store.TimezoneProfile(5000, cpm=(1, 10))}
+    nb_rows = br_store.write_store(tmp_path / "store", profiles, datetime(2020, 7, 8), datetime(2020, 7, 10), seed=3)
+    df = br_store.read_dataframe(tmp_path / "store")
+    assert len(df) == nb_rows
+    assert list(df.columns) == list(br_store.COLUMNS)
+    assert df['UTC_date'].is_monotonic_increasing
+    assert list(df['id']) == list(range(nb_rows))
+    assert np.allclose(df['ts'], df['UTC_date'].astype(np.int64) / 1e9)
+    assert np.allclose(df['price'], df['imps'] * df['CPM'] / 1000)
+    paris = df[df['TZ'] == "Europe/Paris"]
+    assert paris['win'].mean() == pytest.approx(0.3, abs=0.02)
+    assert (paris['CPM'] == 9).all() and df['CPM'].between(1, 10).all()
+    # The traffic follows the local hours: evening peak, few bid requests at night
+    hours = paris['UTC_date'].dt.tz_localize('UTC').dt.tz_convert("Europe/Paris").dt.hour.value_counts()
+    assert hours[20] > 3 * hours[4]
+    # Same seed, same stream
+    assert br_store.write_store(tmp_path / "again", profiles, datetime(2020, 7, 8), datetime(2020, 7, 10),
+                                seed=3) == nb_rows
+    assert br_store.read_dataframe(tmp_path / "again").equals(df)
+
+
+def test_simulation_reads_the_store_by_chunks(tmp_path):
+    profiles = {"Europe/Paris": br_store.TimezoneProfile(4000), "America/New_York": br_store.TimezoneProfile(4000)}
+    br_store.write_store(tmp_path / "store", profiles, datetime(2020, 7, 7), datetime(2020, 7, 14))
+    store = br_store.BidRequestStore(tmp_path / "store")
+    df = br_store.read_dataframe(tmp_path / "store").set_index('UTC_date')
+    # Only the days of the range are read
+    ranges = list(store.ranges('2020-07-08 12:00', '2020-07-10'))
+    assert [day for day, _, _ in ranges] == ['2020-07-08', '2020-07-09']
+    window = pd.concat(store.chunks('2020-07-08 12:00', '2020-07-10', chunk_rows=1000))
+    pd.testing.assert_frame_equal(window, df['2020-07-08 12:00':'2020-07-09'])
+    # The simulation gives the same results on the whole dataframe and on the chunks
+    expected = external_functions_tz.main(df['2020-07-08':'2020-07-11'], 100, 9, 10)
+    chunks = store.chunks('2020-07-08', '2020-07-12', chunk_rows=777)
+    pd.testing.assert_frame_equal(external_functions_tz.main(chunks, 100, 9, 10), expected)
+
+
+def test_sweep_resumes_after_an_interruption(tmp_path):
+    profiles = {"Europe/Paris": br_store.TimezoneProfile(3000), "America/New_York": br_store.TimezoneProfile(3000)}
+    br_store.write_store(tmp_path / "store", profiles, datetime(2020, 7, 8), datetime(2020, 7, 12))
+    grid = {'budget': [50, 100], 'day_end': [10], 'coef': [1, 2]}
+    results = tmp_path / "results.csv"
+    assert sweep.sweep(tmp_path / "store", results, grid, processes=2) == 4
+    table = pd.read_csv(results)
+    assert len(table) == 4 and (table['spent'] <= table['budget'] + 1e-9).all()
+    # Same metrics as a simulation in this process
+    sweep.init_worker(tmp_path / "store")
+    expected = sweep.run(dict(sweep.PARAMETERS, budget=100, day_end=10, coef=2))
+    row = table[(table['budget'] == 100) & (table['coef'] == 2)].iloc[0]
+    assert row['spent'] == pytest.approx(expected['spent'])
+    assert row['hourly_cv'] == pytest.approx(expected['hourly_cv'])
+    # A sweep interrupted after two runs only runs the two others
+    lines = results.read_text().splitlines(keepends=True)
+    results.write_text("".join(lines[:3]) + lines[3][:10])
+    assert sweep.sweep(tmp_path / "store", results, grid, processes=2) == 2
+    assert sweep.sweep(tmp_path / "store", results, grid, processes=2) == 0
+    assert len(pd.read_csv(results)) == 4
+
+
+def test_sweep_records_a_failed_simulation(tmp_path):
+    profiles = {"Europe/Paris": br_store.TimezoneProfile(3000)}
+    br_store.write_store(tmp_path / "store", profiles, datetime(2020, 7, 8), datetime(2020, 7, 13))
+    # The change of budget happens before the first time zone of a campaign starting after July 9
+    sweep.init_worker(tmp_path / "store")
+    result = sweep.run(dict(sweep.PARAMETERS, budget_change=1000, day_start=10, day_end=12))
+    assert result['error'] == '' and 0 < result['spent'] <= 1000
+    # A negative budget fails without stopping the other simulations
+    results = tmp_path / "results.csv"
+    assert sweep.sweep(tmp_path / "store", results, {'budget': [-1, 50], 'day_end': [10]}, processes=2) == 2
+    table = pd.read_csv(results).set_index('budget')
+    assert "Budget cannot be negative" in table.loc[-1, 'error'] and np.isnan(table.loc[-1, 'spent'])
+    assert table.loc[50, 'spent'] > 0 and pd.isna(table.loc[50, 'error'])
+
+
+def test_line_items_share_the_traffic_profile_of_a_time_zone(tmp_path):
+    bdd = DataBase()
+    start = datetime(2020, 7, 9)
+    first = GlobalPacing(total_budget=100, start_date=start, end_date=datetime(2020, 7, 20),
+                         traffic_profiles=bdd.traffic_profiles)
+    private = GlobalPacing(total_budget=100, start_date=start, end_date=datetime(2020, 7, 20))
+    ts = pytz.timezone("Asia/Tokyo").localize(start).timestamp()
+    for br_id, ts_br in enumerate(np.arange(ts, ts + 2 * 86400, 600).tolist()):
+        first.choose_pacing(ts_br, "Asia/Tokyo", 2, 1 + br_id % 24, br_id)
+        private.choose_pacing(ts_br, "Asia/Tokyo", 2, 1 + br_id % 24, br_id)
+    # A line item of the same registry starts from the learned proportions, fitted once for both
+    second = GlobalPacing(total_budget=100, start_date=start, end_date=datetime(2020, 7, 20),
+                          traffic_profiles=bdd.traffic_profiles)
+    second.choose_pacing(ts + 2 * 86400, "Asia/Tokyo", 2, 1, "second")
+    first.choose_pacing(ts + 2 * 86400 + 1, "Asia/Tokyo", 2, 1, "first")
+    assert second.instances["Asia/Tokyo"].prop_table is first.instances["Asia/Tokyo"].prop_table
+    assert np.array_equal(second.instances["Asia/Tokyo"].prop_table, private.instances["Asia/Tokyo"].prop_table)
+    assert second.instances["Asia/Tokyo"].hour_proportions != (1 / 24,) * 24
+    bdd.instances.update({'1': first, '2': second})
+    checkpoint.save(bdd, tmp_path / "pacing.ckpt")
+    restored = DataBase()
+    assert checkpoint.Checkpoint(restored, tmp_path / "pacing.ckpt").restore()
+    profile = restored.traffic_profiles.get("Asia/Tokyo")
+    assert restored.instances['1'].instances["Asia/Tokyo"].profile is profile
+    assert restored.instances['2'].instances["Asia/Tokyo"].profile is profile
+
+
+def test_shared_traffic_profile_counts_a_bid_request_once():
+    traffic_profiles = DataBase().traffic_profiles
+    start = datetime(2020, 7, 9)
+    first = GlobalPacing(total_budget=100, start_date=start, end_date=datetime(2020, 7, 20),
+                         traffic_profiles=traffic_profiles)
+    second = None
+    ts = pytz.timezone("Asia/Tokyo").localize(start).timestamp()
+    # Uniform traffic, the second line item starts at noon and evaluates the same bid requests
+    for br_id, ts_br in enumerate(np.arange(ts, ts + 86400 + 60, 600).tolist()):
+        if second is None and ts_br >= ts + 12 * 3600:
+            second = GlobalPacing(total_budget=100, start_date=start, end_date=datetime(2020, 7, 20),
+                                  traffic_profiles=traffic_profiles)
+        for pacing in (first, second) if second is not None else (first,):
+            pacing.choose_pacing(ts_br, "Asia/Tokyo", 2, 1, br_id)
+    assert np.allclose(first.instances["Asia/Tokyo"].hour_proportions, 1 / 24)
+
+
+def test_idle_time_zone_instances_are_compact():
+    import bench_pacing
+    pacing = GlobalPacing(total_budget=100, start_date=datetime(2020, 7, 9), end_date=datetime(2020, 7, 12))
+    pacing.choose_pacing(datetime(2020, 7, 10).timestamp(), "Europe/Paris", 2, 1, 0)
+    assert not hasattr(pacing, '__dict__') and not hasattr(pacing.instances["Europe/Paris"], '__dict__')
+    assert bench_pacing.instance_memory(n=10, nb_timezones=10) < 16 * 1024
+
+
+def test_metrics_expose_latencies_counters_and_gauges():
+    bdd = DataBase()
+    request_metrics = RequestMetrics()
+    app = falcon.App(middleware=[request_metrics])
+    for uri_template, controller, suffix in routes(bdd, request_metrics):
+        request_metrics.register([uri_template])
+        app.add_route(uri_template, controller, suffix=suffix)
+    client = falcon.testing.TestClient(app)
+    today = datetime.utcnow()
+    client.simulate_post("/campaign", json={"cpid": "1"})
+    client.simulate_post("/campaign/1/init", json={"budget": 1000, "liid": "1",
+                                                   "start": (today - timedelta(days=1)).strftime('%Y-%m-%d'),
+                                                   "end": (today + timedelta(days=1)).strftime('%Y-%m-%d')})
+    for br_id in range(3):
+        client.simulate_post("/li/1/br", json={"tz": "Europe/Paris", "brid": br_id, "imps": 1, "cpm": 2})
+    client.simulate_post("/li/1/notif", json={"status": "win", "brid": 0})
+    result = client.simulate_get("/metrics")
+    assert result.headers['content-type'].startswith('text/plain; version=0.0.4')
+    samples = dict(line.rsplit(' ', 1) for line in result.text.splitlines() if not line.startswith('#'))
+    assert samples['pacing_request_duration_seconds_count{route="/li/{liid}/br"}'] == '3'
+    assert samples['pacing_request_duration_seconds_bucket{route="/li/{liid}/br",le="+Inf"}'] == '3'
+    assert samples['pacing_bid_requests_total{liid="1"}'] == '3'
+    assert samples['pacing_buys_total{liid="1"}'] == '3'
+    assert samples['pacing_notifications_total{liid="1",status="win"}'] == '1'
+    assert float(samples['pacing_budget_spent{liid="1",tz="Europe/Paris"}']) == pytest.approx(0.002)
+    assert float(samples['pacing_budget_engaged{liid="1",tz="Europe/Paris"}']) == pytest.approx(0.004)
+    assert float(samples['pacing_prop_purchase{liid="1",tz="Europe/Paris"}']) == 1
+
+
+def test_campaign_totals_follow_its_line_items():
+    bdd = DataBase()
+    app = falcon.App()
+    for uri_template, controller, suffix in routes(bdd, RequestMetrics()):
+        app.add_route(uri_template, controller, suffix=suffix)
+    client = falcon.testing.TestClient(app)
+    today = datetime.utcnow()
+    dates = {"start": (today - timedelta(days=1)).strftime('%Y-%m-%d'),
+             "end": (today + timedelta(days=1)).strftime('%Y-%m-%d')}
+    client.simulate_post("/campaign", json={"cpid": "1"})
+    for liid, budget in (("a", 1000), ("b", 500), ("c", 100)):
+        client.simulate_post("/campaign/1/init", json={"budget": budget, "liid": liid, **dates})
+        for br_id, tz in enumerate(["Europe/Paris", "Asia/Tokyo"]):
+            client.simulate_post(f"/li/{liid}/br", json={"tz": tz, "brid": br_id, "imps": 1, "cpm": 2})
+        client.simulate_post(f"/li/{liid}/notif", json={"status": "win", "brid": 0})
+    client.simulate_post("/li/a/reset", json={"new_budget": 2000})
+    client.simulate_delete("/campaign/1/init", json={"liid": "c"})
+    # The totals are kept by the campaign, the line items are only visited for the detail
+    status = client.simulate_get("/campaign/1/status").json
+    assert 'line_items' not in status
+    assert status['budget'] == 2500 and status['engaged_br'] == 2
+    assert status['spent'] == pytest.approx(0.004) and status['engaged'] == pytest.approx(0.004)
+    assert status['remaining'] == pytest.approx(2500 - 0.004)
+    detail = client.simulate_get("/campaign/1/status", params={"detail": "line_items"}).json
+    assert detail['line_items']['b'] == client.simulate_get("/li/b/status").json | {'budget': 500,
+                                                                                     'engaged': pytest.approx(0.002)}
+    assert 'tz' not in detail['line_items']['a']
+    assert client.simulate_get("/status").json == {'campaigns': {'1': status}}
+    tree = client.simulate_get("/status", params={"detail": "tz"}).json['campaigns']
+    assert tree['1']['line_items']['b']['tz']['Asia/Tokyo'] == {'spent': 0, 'remaining': 250}
+    assert client.simulate_get("/status", params={"detail": "all"}).status_code == 400
+    assert client.simulate_get("/campaign/2/status").status_code == 404
+    # The router of the sharded API sums the workers
+    halves = [{'budget': 2, 'spent': 1.5, 'line_items': {'a': {'budget': 2}}},
+              {'budget': 1, 'spent': 0, 'line_items': {'b': {'budget': 1}}}]
+    assert merge_status(halves) == {'budget': 3, 'spent': 1.5, 'line_items': {'a': {'budget': 2}, 'b': {'budget': 1}}}
+
+
+def test_provisioning_creates_the_rows_and_reports_the_rejected_ones():
+    bdd = DataBase()
+    app = falcon.App()
+    for uri_template, controller, suffix in routes(bdd, RequestMetrics()):
+        app.add_route(uri_template, controller, suffix=suffix)
+    client = falcon.testing.TestClient(app)
+    client.simulate_post("/campaign", json={"cpid": "1"})
+    client.simulate_post("/campaign/1/init", json={"budget": 10, "start": "2020-07-01", "end": "2020-07-14",
+                                                   "liid": "a"})
+    rows = ("cpid,liid,budget,start,end,notification_timeout\n"
+            "1,b,100.5,2020-07-01,2020-07-14,\n"
+            "2,c,200,2020-07-01,2020-07-14,60\n"
+            "1,a,100,2020-07-01,2020-07-14,\n"
+            "2,c,100,2020-07-01,2020-07-14,\n"
+            "3,d,abc,2020-07-01,2020-07-14,\n"
+            "3,e,100,2020-07-14,2020-07-01,\n"
+            "4,,,,,\n")
+    results = client.simulate_post("/provision", body=rows, headers={"content-type": "text/csv"}).json['results']
+    assert [result['status'] for result in results] == ['ok', 'ok', 'error', 'error', 'error', 'error', 'ok']
+    assert results[2]['description'] == "Line item a already created"
+    assert results[3]['description'] == "Line item c already created"
+    # A campaign is only created by a valid row
+    assert {cpid: campaign.line_items for cpid, campaign in bdd.campaigns.items()} == \
+           {"1": ["a", "b"], "2": ["c"], "4": []}
+    assert bdd.campaigns["1"].totals[0] == 110
+    assert bdd.instances["b"].total_budget == 100 and bdd.instances["c"].engaged.timeout == 60
+    assert bdd.instances["c"].traffic_profiles is bdd.traffic_profiles
+    # JSON rows, and the line items can be used as if they were created one by one
+    body = '{"cpid": "1", "liid": "f", "budget": 50, "start": "2020-07-01", "end": "2020-07-14"}\n{"liid": "g"}'
+    results = client.simulate_post("/provision", body=body).json['results']
+    assert results[0] == {'status': 'ok'} and results[1]['status'] == 'error'
+    assert client.simulate_get("/campaign/1/status").json['budget'] == 160
+    assert client.simulate_post("/provision", body="[{").status_code == 422
+
+
+@pytest.mark.parametrize("failure", ["status", "rows"])
+def test_provisioning_router_reports_the_campaigns_a_worker_missed(failure):
+    # Worker that creates its line items but fails to create the campaigns
+    class FailingShard(object):
+        async def request(self, method, path, body=b''):
+            rows = json.loads(body)
+            if any(row.get('liid') is not None for row in rows):
+                return 200, json.dumps({'status': 'ok', 'results': [{'status': 'ok'} for _ in rows]}).encode()
+            if failure == "status":
+                return 503, b'{"title": "503 Service Unavailable"}'
+            return 200, json.dumps({'status': 'ok', 'results': [{'status': 'error', 'description': 'full'}
+                                                                for _ in rows]}).encode()
+
+    router = Router([])
+    router.shards = [FailingShard(), FailingShard()]
+    app = falcon.asgi.App()
+    app.add_route("/provision", ShardsProvision(router))
+    rows = [{"cpid": "1", "liid": liid, "budget": 10, "start": "2020-07-01", "end": "2020-07-14"}
+            for liid in ("a", "b", "c")]
+    result = falcon.testing.TestClient(app).simulate_post("/provision", json=rows)
+    if failure == "status":
+        assert result.status_code == 503
+    else:
+        assert result.json['results'] == [{'status': 'error', 'description': 'full'}] * 3
+
+
+@pytest.mark.parametrize("race", [False, True])
+def test_router_reconnects_after_the_keep_alive_timeout_of_a_worker(race):
+    # Worker closing the connections idle for 0.1 s, or (race) closing a kept connection on its next request, before
+    # the router sees it closed
+    async def scenario():
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(writer)
+            nb_requests = 0
+            while True:
+                try:
+                    await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), None if race else 0.1)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                if race and nb_requests:
+                    break
+                nb_requests += 1
+                writer.write(b"HTTP/1.1 200 OK\r\ncontent-length: 2\r\n\r\nok")
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        shard = Shard(server.sockets[0].getsockname()[1])
+        assert await shard.request('GET', '/') == (200, b'ok')
+        await asyncio.sleep(0.3)
+        assert await shard.request('GET', '/') == (200, b'ok')
+        server.close()
+        return len(connections)
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_profiler_times_the_stages_and_restores_the_pacing():
+    buying_decision = Pacing.buying_decision
+    pacing = GlobalPacing(total_budget=100, start_date=datetime(2020, 7, 9), end_date=datetime(2020, 7, 12))
+    ts = datetime(2020, 7, 10).timestamp()
+    with Profiler(slow_threshold=0, max_samples=2) as profiler:
+        # The error of a call is not hidden by the profiler
+        with pytest.raises(TypeError):
+            pacing.choose_pacing(ts=ts, tz="Asia/Tokyo")
+        for br_id in range(2):
+            pacing.choose_pacing(ts + br_id, "Asia/Tokyo", 2, 1, br_id)
+        pacing.choose_pacing(ts=ts + 2, tz="Asia/Tokyo", cpm=2, imps=1, br_id=2)
+        with pytest.raises(RuntimeError):
+            Profiler().start()
+    assert Pacing.buying_decision is buying_decision
+    report = profiler.report()
+    assert not report['running']
+    for name in ('choose_pacing', 'buying_decision', 'day_reset', 'change_hour', 'bs_calculation', 'check_proportion'):
+        assert report['stages'][name]['count'] >= 1
+    assert report['stages']['buying_decision']['count'] == 3
+    assert sum(report['stages']['buying_decision']['buckets'].values()) == 3
+    # Only the outermost call is logged
+    assert [(call['call'], call['tz'], call['ts']) for call in report['slow_calls']] == \
+           [('choose_pacing', "Asia/Tokyo", ts + 1), ('choose_pacing', "Asia/Tokyo", ts + 2)]
+    assert {'pacing_decision', 'buying_decision', 'gen_mean_speed'} <= set(report['slow_calls'][0]['stages'])
+
+    client = falcon.testing.TestClient(falcon.App())
+    client.app.add_route("/debug/profile", ProfileEndpoint())
+    assert client.simulate_get("/debug/profile").status_code == 404
+    assert client.simulate_post("/debug/profile", json={"slow_threshold": 0}).status_code == 200
+    assert client.simulate_post("/debug/profile").status_code == 409
+    pacing.choose_pacing(ts + 3, "Asia/Tokyo", 2, 1, 3)
+    assert client.simulate_get("/debug/profile").json['profile']['stages']['choose_pacing']['count'] == 1
+    result = client.simulate_delete("/debug/profile")
+    assert result.json['profile']['slow_calls'][0]['tz'] == "Asia/Tokyo"
+    assert Pacing.buying_decision is buying_decision
+
+
+@pytest.mark.parametrize("timezone", ["Europe/Paris", "America/Santiago", "Australia/Lord_Howe", "UTC"])
+def test_timezone_cache_matches_datetime(timezone):
+    tz = pytz.timezone(timezone)
+    tz_cache = TimezoneCache(timezone, datetime(2020, 3, 20), datetime(2020, 11, 10))
+    for ts in np.arange(tz_cache.start_ts, tz_cache.end_ts, 997.123457):
+        ts = round_timestamp(ts)
+        local = datetime.fromtimestamp(ts, tz=tz)
+        end_hour = tz.localize(datetime(local.year, local.month, local.day, local.hour, 59, 59, 999999))
+        day, weekday, hour, end_ts = tz_cache.local(ts)
+        assert (day, weekday, hour) == (local.toordinal(), local.weekday(), local.hour)
+        assert end_ts == datetime.timestamp(end_hour)
+        assert tz_cache.midnight(day) == datetime.timestamp(tz.localize(datetime(local.year, local.month, local.day)))
@@ -0,0 +1,223 @@
+import threading
+from collections import deque
+import numpy as np
+
+# Proportion of the daily budget in each hour (rows) of each weekday (columns) when the traffic is not known yet,
+# shared by the pacing instances
+UNIFORM_PROPORTIONS = np.full((24, 7), 1 / 24)
+UNIFORM_PROPORTIONS.flags.writeable = False
+UNIFORM_HOURS = tuple(UNIFORM_PROPORTIONS[:, 0].tolist())
+# Seconds during which a bid request already added by a line item is recognized: the line items evaluate a bid
+# request at its timestamp, so only the latest ids are kept
+DEDUP_WINDOW = 10
+
+
+# Linear regression of the impressions per hour updated incrementally
+class TrafficModel:
+    """ Additive model imps ~ C(weekday) + C(hour) fitted by least squares from sufficient statistics.
+
+    An observation is the number of impressions of one closed hour of one day. The normal equations only depend
+    on the number of observations and the sum of impressions per (weekday, hour) cell, so closed days are folded
+    into two 7x24 arrays and the fit never goes back to the history.
+    """
+
+    __slots__ = ('counts', 'sums')
+
+    def __init__(self):
+        """Class constructor"""
+        # Number of observations of each cell, the fit reads them as floats
+        self.counts = np.zeros((7, 24), dtype=np.int32)
+        self.sums = np.zeros((7, 24))
+
+    def __getstate__(self):
+        # Only the observed cells are saved
+        cells = np.flatnonzero(self.counts)
+        return (cells.astype(np.uint8).tobytes(), self.counts.ravel()[cells].tobytes(),
+                self.sums.ravel()[cells].tobytes())
+
+    def __setstate__(self, state):
+        cells, counts, sums = state
+        cells = np.frombuffer(cells, dtype=np.uint8)
+        self.counts = np.zeros((7, 24), dtype=np.int32)
+        self.sums = np.zeros((7, 24))
+        self.counts.ravel()[cells] = np.frombuffer(counts, dtype=np.int32)
+        self.sums.ravel()[cells] = np.frombuffer(sums)
+
+    def add_day(self, weekday, imps, counts):
+        """ Fold the hours of a closed day
+
+        :param weekday: weekday of the day
+        :param imps: array of the impressions of each hour of the day
+        :param counts: array of the number of bid requests of each hour of the day
+        """
+        hours = np.nonzero(counts)[0]
+        self.counts[weekday, hours] += 1
+        self.sums[weekday, hours] += imps[hours]
+
+    def hours_observed(self):
+        """ Return True if every hour of the day has at least one observation
+        """
+        return bool(self.counts.any(axis=0).all())
+
+    def weekdays_observed(self):
+        """ Return True if every weekday has at least one observation
+        """
+        return bool(self.counts.any(axis=1).all())
+
+    def fit_hour_weekday(self):
+        """ Proportion of impressions per hour for each weekday (model with hours and weekdays)
+
+        :return: array of shape (24, 7), each column sums to 100
+        """
+        n_weekday = self.counts.sum(axis=1)
+        n_hour = self.counts.sum(axis=0)
+        # Treatment coding as in statsmodels: intercept, weekdays 1..6 and hours 1..23
+        xtx = np.empty((30, 30))
+        xtx[0, 0] = n_weekday.sum()
+        xtx[0, 1:7] = xtx[1:7, 0] = n_weekday[1:]
+        xtx[0, 7:] = xtx[7:, 0] = n_hour[1:]
+        xtx[1:7, 1:7] = np.diag(n_weekday[1:])
+        xtx[7:, 7:] = np.diag(n_hour[1:])
+        xtx[1:7, 7:] = self.counts[1:, 1:]
+        xtx[7:, 1:7] = self.counts[1:, 1:].T
+        xty = np.concatenate(([self.sums.sum()], self.sums.sum(axis=1)[1:], self.sums.sum(axis=0)[1:]))
+        try:
+            params = np.linalg.solve(xtx, xty)
+        except np.linalg.LinAlgError:
+            # Rank deficient design: minimum norm solution, like the pseudo-inverse used by statsmodels
+            params = np.linalg.lstsq(xtx, xty, rcond=None)[0]
+        weekday_effect = np.concatenate(([0], params[1:7]))
+        hour_effect = np.concatenate(([0], params[7:]))
+        fitted = params[0] + hour_effect[:, None] + weekday_effect[None, :]
+        return fitted * 100 / fitted.sum(axis=0)
+
+    def fit_hour(self):
+        """ Proportion of impressions per hour (model with only hours)
+
+        :return: array of shape (24, 1) that sums to 100
+        """
+        fitted = self.sums.sum(axis=0) / self.counts.sum(axis=0)
+        return (fitted * 100 / fitted.sum())[:, None]
+
+    def proportions(self):
+        """ Give the proportion of impressions per hour of each weekday: uniform until every hour is observed, then
+        the same for every weekday until every weekday is observed.
+
+        :return: array (24, 7) of proportions, each column sums to 1
+        """
+        if not self.hours_observed():
+            return UNIFORM_PROPORTIONS
+        if not self.weekdays_observed():
+            return np.repeat(self.fit_hour() / 100, 7, axis=1)
+        return self.fit_hour_weekday() / 100
+
+
+# Traffic of a time zone shared by the line items
+class TrafficProfile:
+    """ Impressions per hour of the open local day and model of the closed days of a time zone, fed by the pacing
+    instances of every line item that shares the profile. A bid request evaluated by several line items is counted
+    once, so the profile measures the traffic and not the number of line items. The proportions are fitted at most
+    once per local day.
+    """
+
+    __slots__ = ('model', 'day', 'imps', 'counts', 'recent', 'seen', 'table_day', 'table', 'lock')
+
+    def __init__(self):
+        """Class constructor"""
+        self.model = TrafficModel()
+        # Open local day, folded in the model when a later day begins
+        self.day = None
+        self.imps = np.zeros(24)
+        self.counts = np.zeros(24, dtype=np.int32)
+        # Bid requests of the last DEDUP_WINDOW seconds: (timestamp, id) in order of arrival and set of the ids
+        self.recent = deque()
+        self.seen = set()
+        # Proportions fitted at the beginning of table_day
+        self.table_day = None
+        self.table = UNIFORM_PROPORTIONS
+        # Line items of a time zone add their bid requests from different threads
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # The recent ids are not saved: they are only useful for a few seconds
+        return {name: getattr(self, name) for name in self.__slots__ if name not in ('recent', 'seen', 'lock')}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.recent = deque()
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def close(self, day):
+        """ Fold the open day in the model and open a later day. Must be called with the lock held.
+
+        :param day: ordinal of the new local day
+        """
+        if self.day is not None and self.counts.any():
+            self.model.add_day((self.day + 6) % 7, self.imps, self.counts)
+            self.imps[:] = 0
+            self.counts[:] = 0
+        self.day = day
+
+    def add(self, ts, day, hour, imps, br_id):
+        """ Add the impressions of a bid request, unless another line item already added it
+
+        :param ts: timestamp of the bid request
+        :param day: ordinal of the local day of the bid request
+        :param hour: local hour of the bid request
+        :param imps: number of impressions
+        :param br_id: id of the bid request
+        """
+        with self.lock:
+            if day != self.day:
+                # A late bid request of a closed day is not taken into account
+                if self.day is not None and day < self.day:
+                    return
+                self.close(day)
+            recent = self.recent
+            while recent and recent[0][0] < ts - DEDUP_WINDOW:
+                self.seen.discard(recent.popleft()[1])
+            if br_id in self.seen:
+                return
+            self.seen.add(br_id)
+            recent.append((ts, br_id))
+            self.imps[hour] += imps
+            self.counts[hour] += 1
+
+    def proportions(self, day):
+        """ Return the proportions of impressions per hour of each weekday, fitted on the days closed before a day
+
+        :param day: ordinal of the current local day
+        :return: array (24, 7) of proportions (read only, shared by the line items)
+        """
+        with self.lock:
+            if self.table_day is None or day > self.table_day:
+                if self.day is None or day > self.day:
+                    self.close(day)
+                self.table = self.model.proportions()
+                self.table_day = day
+            return self.table
+
+
+# Traffic profiles of the time zones
+class TrafficProfiles:
+    """ One TrafficProfile per time zone. A registry shared by line items makes them learn the traffic together,
+    and a new line item starts from the proportions already learned instead of the uniform ones.
+    """
+
+    __slots__ = ('profiles',)
+
+    def __init__(self):
+        """Class constructor"""
+        self.profiles = {}
+
+    def get(self, tz):
+        """ Return the profile of a time zone (created at first use)
+
+        :param tz: name of the time zone
+        """
+        try:
+            return self.profiles[tz]
+        except KeyError:
+            return self.profiles.setdefault(tz, TrafficProfile())
@@ -0,0 +1,85 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+import math
+import pytz
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+# Resolution of the datetimes
+def round_timestamp(ts):
+    """ Round a timestamp to the microsecond, like datetime.fromtimestamp does
+
+    :param ts: timestamp in seconds
+    :return: timestamp in seconds
+    """
+    fraction, seconds = math.modf(ts)
+    return (int(seconds) * 1000000 + round(fraction * 1e6)) / 1000000
+
+
+# Local calendar of a time zone computed from its UTC offset transitions
+class TimezoneCache:
+    """ Offset transitions of a time zone over the window of a campaign. A timestamp is converted to its local day,
+    weekday, hour and end of hour with a binary search on the transitions, without creating datetimes.
+    """
+
+    __slots__ = ('tz', 'start_ts', 'end_ts', 'transitions', 'offsets', 'segment_start', 'segment_end', 'segment')
+
+    def __init__(self, timezone, start_date, end_date):
+        """Class constructor
+
+        :param timezone: name of the time zone
+        :param start_date: first day of the campaign (naive datetime)
+        :param end_date: last day of the campaign (naive datetime)
+        """
+        self.tz = pytz.timezone(timezone)
+        # Campaign bounds as timestamps
+        self.start_ts = datetime.timestamp(self.tz.localize(start_date))
+        self.end_ts = datetime.timestamp(self.tz.localize(end_date + timedelta(days=1)))
+        # Transitions in the window (with one day of margin), the first one covers everything before
+        self.transitions = [-math.inf]
+        self.offsets = [self.tz.utcoffset(None).total_seconds() if not hasattr(self.tz, '_utc_transition_times')
+                        else None]
+        for utc, (offset, _, _) in zip(getattr(self.tz, '_utc_transition_times', []),
+                                       getattr(self.tz, '_transition_info', [])):
+            ts = (utc - EPOCH).total_seconds()
+            if ts <= self.start_ts - 86400:
+                self.offsets[0] = offset.total_seconds()
+            elif ts <= self.end_ts + 86400:
+                self.transitions.append(ts)
+                self.offsets.append(offset.total_seconds())
+        # Hour of the last conversion: [segment_start, segment_end[ share the same local hour
+        self.segment_start = math.inf
+        self.segment_end = -math.inf
+        self.segment = None
+
+    def local(self, ts):
+        """ Convert a timestamp to its local calendar
+
+        :param ts: timestamp in seconds
+        :return: (ordinal of the local day, weekday, hour, timestamp of the end of the hour)
+        """
+        if self.segment_start <= ts < self.segment_end:
+            return self.segment
+        i = bisect_right(self.transitions, ts) - 1
+        offset = self.offsets[i]
+        days, seconds = divmod(math.floor(ts + offset), 86400)
+        hour = seconds // 3600
+        wall_start = days * 86400 + hour * 3600
+        self.segment_start = max(wall_start - offset, self.transitions[i])
+        self.segment_end = wall_start + 3600 - offset
+        if i + 1 < len(self.transitions):
+            self.segment_end = min(self.segment_end, self.transitions[i + 1])
+        day = days + EPOCH_ORDINAL
+        # Once per hour, the end of the hour is localized like the pacing always did
+        end_hour = datetime.fromordinal(day).replace(hour=hour, minute=59, second=59, microsecond=999999)
+        self.segment = (day, (day + 6) % 7, hour, datetime.timestamp(self.tz.localize(end_hour)))
+        return self.segment
+
+    def midnight(self, day):
+        """ Return the timestamp of the beginning of a local day
+
+        :param day: ordinal of the local day
+        """
+        return datetime.timestamp(self.tz.localize(datetime.fromordinal(day)))